@@ -4,7 +4,7 @@ import dataclasses
 
 import stim
 
-from _util import complex_key, sorted_complex
+from _util import sorted_complex, sorted_complex_pairs
 
 
 T = TypeVar("T")
@@ -203,22 +203,14 @@ class Builder:
         self.circuit.append('TICK')
 
     def cx(self, pairs: List[Tuple[complex, complex]]) -> None:
-        sorted_pairs = []
-        for a, b in pairs:
-            sorted_pairs.append((a, b))
-        sorted_pairs = sorted(sorted_pairs, key=lambda e: (complex_key(e[0]), complex_key(e[1])))
-        for a, b in sorted_pairs:
-            self.circuit.append('CX', [self.q2i[a], self.q2i[b]])
+        sorted_pairs = sorted_complex_pairs(pairs)
+        if sorted_pairs:
+            self.circuit.append('CX', [self.q2i[q] for pair in sorted_pairs for q in pair])
 
     def cz(self, pairs: List[Tuple[complex, complex]]) -> None:
-        sorted_pairs = []
-        for a, b in pairs:
-            if complex_key(a) > complex_key(b):
-                a, b = b, a
-            sorted_pairs.append((a, b))
-        sorted_pairs = sorted(sorted_pairs, key=lambda e: (complex_key(e[0]), complex_key(e[1])))
-        for a, b in sorted_pairs:
-            self.circuit.append('CZ', [self.q2i[a], self.q2i[b]])
+        sorted_pairs = sorted_complex_pairs(sorted_complex(pair) for pair in pairs)
+        if sorted_pairs:
+            self.circuit.append('CZ', [self.q2i[q] for pair in sorted_pairs for q in pair])
 
     def classical_paulis(self,
                          *,
@@ -0,0 +1,551 @@
+import collections
+import dataclasses
+import functools
+import json
+import math
+import os
+import pathlib
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+import numpy as np
+import stim
+from sinter.decoding import DECODER_METHODS
+
+from _trace import labels, model_labels, span
+
+if TYPE_CHECKING:
+    import pymatching
+
+# Worker processes append a json line per decoding call to the file named by this environment
+# variable (if it's set). Environment variables reach workers whether they are forked or spawned.
+_TIMINGS_PATH_ENV = 'HEAVY_HEX_DECODER_TIMINGS'
+# How many matching graphs each process keeps around.
+_MAX_CACHED_GRAPHS = 4
+
+
+@dataclasses.dataclass
+class DecoderTimings:
+    """Time a process spent building decoders versus decoding with them."""
+    calls: int = 0
+    builds: int = 0
+    shots: int = 0
+    build_seconds: float = 0
+    decode_seconds: float = 0
+
+    def __add__(self, other: 'DecoderTimings') -> 'DecoderTimings':
+        return DecoderTimings(**{
+            field.name: getattr(self, field.name) + getattr(other, field.name)
+            for field in dataclasses.fields(self)
+        })
+
+
+class PackedMatcher:
+    """Decodes bit packed shots using a pymatching graph of a detector error model."""
+
+    def __init__(self, model: stim.DetectorErrorModel, *, enable_correlations: bool = False):
+        import pymatching
+        self.matching = pymatching.Matching.from_detector_error_model(
+            model, enable_correlations=enable_correlations)
+        self.enable_correlations = enable_correlations
+
+    def decode_packed(self, dets: np.ndarray) -> np.ndarray:
+        """Predicts bit packed observable flips from bit packed detection events (one row per shot)."""
+        return self.matching.decode_batch(
+            dets,
+            bit_packed_shots=True,
+            bit_packed_predictions=True,
+            enable_correlations=self.enable_correlations,
+        )
+
+
+def flag_detectors(model: stim.DetectorErrorModel) -> np.ndarray:
+    """Returns the ids of a model's flag detectors.
+
+    `make_cx_based_round` places each flag detector a quarter step off of the lattice (at
+    `flag + 0.25 + 0.25j`), which is how they are told apart from the stabilizer detectors.
+    """
+    return np.array(sorted(
+        k for k, coords in model.get_detector_coordinates().items()
+        if coords and coords[0] % 0.5 == 0.25
+    ), dtype=np.int64)
+
+
+def _iter_dem_errors(model: stim.DetectorErrorModel, offset: int = 0):
+    """Yields (probability, components) for each error of a model.
+
+    Each component is a (detectors, observables) pair of lists, with absolute detector ids.
+    """
+    for instruction in model:
+        if isinstance(instruction, stim.DemRepeatBlock):
+            body = instruction.body_copy()
+            shift = _detector_shift(body)
+            # Parse the body once, then shift its detectors for each repetition.
+            body_errors = list(_iter_dem_errors(body))
+            for _ in range(instruction.repeat_count):
+                for p, components in body_errors:
+                    yield p, [([d + offset for d in dets], list(obs)) for dets, obs in components]
+                offset += shift
+        elif instruction.type == 'shift_detectors':
+            offset += instruction.targets_copy()[0]
+        elif instruction.type == 'error':
+            components = [([], [])]
+            for t in instruction.targets_copy():
+                if t.is_separator():
+                    components.append(([], []))
+                elif t.is_relative_detector_id():
+                    components[-1][0].append(t.val + offset)
+                elif t.is_logical_observable_id():
+                    components[-1][1].append(t.val)
+            yield instruction.args_copy()[0], components
+
+
+def _detector_shift(model: stim.DetectorErrorModel) -> int:
+    shift = 0
+    for instruction in model:
+        if isinstance(instruction, stim.DemRepeatBlock):
+            shift += _detector_shift(instruction.body_copy()) * instruction.repeat_count
+        elif instruction.type == 'shift_detectors':
+            shift += instruction.targets_copy()[0]
+    return shift
+
+
+def flag_correlated_model(model: stim.DetectorErrorModel) -> stim.DetectorErrorModel:
+    """Keeps only the correlations between decomposed components that involve a flag detector.
+
+    Decomposed errors that fire a flag detector are kept whole. Every other decomposed error is
+    split into its components, listed as independent errors. The matching graph of the result is the
+    same as the original's, but correlated matching on it only reacts to flags.
+    """
+    flags = set(flag_detectors(model).tolist())
+    lines = []
+
+    def component_text(component) -> str:
+        dets, obs = component
+        return ' '.join([f'D{d}' for d in dets] + [f'L{k}' for k in obs])
+
+    for p, components in _iter_dem_errors(model):
+        if any(d in flags for dets, _ in components for d in dets):
+            lines.append(f'error({p!r}) ' + ' ^ '.join(component_text(c) for c in components))
+        else:
+            lines.extend(f'error({p!r}) {component_text(c)}' for c in components if c[0] or c[1])
+    if model.num_detectors:
+        lines.append(f'detector D{model.num_detectors - 1}')
+    if model.num_observables:
+        lines.append(f'logical_observable L{model.num_observables - 1}')
+    return stim.DetectorErrorModel('\n'.join(lines))
+
+
+class FlagAwareMatcher:
+    """Matches shots with pymatching, lowering the weights of the data edges that fired flags point to.
+
+    An error that fires a flag detector (e.g. a hook error of a measurement qubit) is decomposed
+    into a component ending at the flag and components elsewhere in the matching graph. When the
+    flag fires, the matching pairs it up through one of its edges, and pymatching's correlated
+    second pass then makes the error's other components cheap for that shot. Correlations that
+    don't involve flags are removed first (see `flag_correlated_model`), so only flags change
+    weights. The reweighting happens per shot inside pymatching, on batches of shots, without
+    rebuilding the graph.
+    """
+
+    def __init__(self, model: stim.DetectorErrorModel):
+        import pymatching
+        self.flags = flag_detectors(model)
+        self.matching = pymatching.Matching.from_detector_error_model(
+            flag_correlated_model(model) if len(self.flags) else model,
+            enable_correlations=bool(len(self.flags)))
+
+    def decode_packed(self, dets: np.ndarray) -> np.ndarray:
+        """Predicts bit packed observable flips from bit packed detection events (one row per shot)."""
+        return self.matching.decode_batch(
+            dets,
+            bit_packed_shots=True,
+            bit_packed_predictions=True,
+            enable_correlations=bool(len(self.flags)),
+        )
+
+
+@dataclasses.dataclass
+class _Window:
+    detectors: np.ndarray
+    # Whether each of the window's detectors is in a layer the window commits.
+    committed: List[bool]
+    matching: 'pymatching.Matching'
+    # Each edge's observables, and (for edges cut off by the top of the window) the detector at the
+    # far end, relative to the window's first detector. None for edges that don't leave the window.
+    edge_targets: Dict[Tuple[int, int], Tuple[int, Optional[int]]]
+
+
+class WindowedMatcher:
+    """Matches shots window by window along the time coordinate of the detectors (sliding window decoding).
+
+    Detectors are grouped into layers by their last coordinate, which the circuits advance with
+    `builder.shift_coords(dt=1)` (twice per round). Window k covers layers
+    [k * commit_layers, k * commit_layers + commit_layers + buffer_layers). It's matched using the
+    errors inside it: errors that reach later layers become boundary edges (a defect near the top
+    of the window may be explained by an error the window can't see), and errors that reach earlier
+    layers are dropped (those layers are already committed). Matched edges touching the window's
+    oldest `commit_layers` layers are committed: their observables are added to the prediction,
+    and their other ends (including the far ends of cut off edges) are flipped in the syndrome
+    given to later windows. The final window commits everything.
+
+    Only one window's worth of detection events is matched at a time, so matching time grows
+    linearly with the number of rounds, and windows with the same shape (every window in the bulk
+    of a memory experiment) share one graph.
+    """
+
+    def __init__(self,
+                 model: stim.DetectorErrorModel,
+                 *,
+                 commit_layers: Optional[int] = None,
+                 buffer_layers: Optional[int] = None):
+        """
+        Args:
+            model: A detector error model with graphlike (decomposed) errors, whose detectors all
+                have coordinates ending with a time coordinate.
+            commit_layers: How many layers each window commits. Defaults to twice the spatial extent
+                of the detectors, which for these circuits is about d rounds.
+            buffer_layers: How many layers past the committed ones each window looks at. Defaults to
+                the same as commit_layers.
+        """
+        coords = model.get_detector_coordinates()
+        if any(not coords.get(k) for k in range(model.num_detectors)):
+            raise ValueError("Windowed matching needs every detector to have coordinates.")
+        times = np.array([coords[k][-1] for k in range(model.num_detectors)])
+        if commit_layers is None:
+            xs = [c[0] for c in coords.values() if len(c) > 1]
+            commit_layers = 2 * max(1, math.ceil(max(xs) - min(xs))) if xs else 1
+        if buffer_layers is None:
+            buffer_layers = commit_layers
+        if commit_layers < 1 or buffer_layers < 0:
+            raise ValueError(f"{commit_layers=} must be positive and {buffer_layers=} can't be negative.")
+
+        layer_times, layers = np.unique(times, return_inverse=True)
+        probabilities, firsts, seconds, observables = [], [], [], []
+        for p, error_components in _iter_dem_errors(model):
+            for dets, obs in error_components:
+                if len(dets) > 2:
+                    raise ValueError(f"Error component with more than two detectors: {dets}. Decompose errors.")
+                if dets:
+                    probabilities.append(p)
+                    firsts.append(dets[0])
+                    seconds.append(dets[1] if len(dets) == 2 else -1)
+                    observables.append(sum(1 << k for k in obs))
+        firsts = np.array(firsts, dtype=np.int64)
+        seconds = np.array(seconds, dtype=np.int64)
+        first_layers = layers[firsts]
+        second_layers = np.where(seconds >= 0, layers[seconds], first_layers)
+        # Components sorted by their earliest layer, so each window can slice out the ones starting in it.
+        order = np.argsort(np.minimum(first_layers, second_layers), kind='stable')
+        earliest = np.minimum(first_layers, second_layers)[order]
+
+        self.num_detectors = model.num_detectors
+        self.num_observables = model.num_observables
+        self.windows: List[_Window] = []
+        shared: Dict[Any, Tuple['pymatching.Matching', Dict[Tuple[int, int], int]]] = {}
+        start = 0
+        while True:
+            end = start + commit_layers + buffer_layers
+            last = end >= len(layer_times)
+            detectors = np.flatnonzero((layers >= start) & (layers < end))
+            # Detector indices needn't follow time order, so commitment goes by each detector's layer.
+            committed = [True] * len(detectors) if last else (layers[detectors] < start + commit_layers).tolist()
+            edges: Dict[Tuple[int, int], Tuple[float, int, Optional[int]]] = {}
+            selected = order[np.searchsorted(earliest, start):np.searchsorted(earliest, end)]
+            # Local node of each end of each component, or -1 when it's past the window (or absent).
+            first_inside = first_layers[selected] < end
+            second_inside = (seconds[selected] >= 0) & (second_layers[selected] < end)
+            local_firsts = np.where(first_inside, np.searchsorted(detectors, firsts[selected]), -1)
+            local_seconds = np.where(second_inside, np.searchsorted(detectors, seconds[selected]), -1)
+            # The detector past the window, for components cut off by its top.
+            offset = int(detectors[0]) if detectors.size else 0
+            far_ends = np.where(~first_inside, firsts[selected], np.where(
+                (seconds[selected] >= 0) & ~second_inside, seconds[selected], -1))
+            for k, u, v, far in zip(selected.tolist(), local_firsts.tolist(), local_seconds.tolist(), far_ends.tolist()):
+                key = (min(u, v), max(u, v)) if u >= 0 and v >= 0 else (max(u, v), -1)
+                p, obs, far = probabilities[k], observables[k], (far - offset if far >= 0 else None)
+                if key in edges:
+                    # Parallel edges with the same effect combine. Otherwise the most likely one is kept,
+                    # since matching only reports which pair of nodes it matched.
+                    p2, obs2, far2 = edges[key]
+                    if (obs2, far2) == (obs, far):
+                        p = p * (1 - p2) + p2 * (1 - p)
+                    elif p2 >= p:
+                        continue
+                edges[key] = (p, obs, far)
+            signature = (tuple(committed), tuple(sorted(edges.items(), key=lambda e: e[0])))
+            if signature not in shared:
+                shared[signature] = (self._build_matching(edges, len(detectors)),
+                                     {key: (obs, far) for key, (_, obs, far) in edges.items()})
+            matching, edge_targets = shared[signature]
+            self.windows.append(_Window(detectors, committed, matching, edge_targets))
+            if last:
+                break
+            start += commit_layers
+
+    @staticmethod
+    def _build_matching(edges: Dict[Tuple[int, int], Tuple[float, int, Optional[int]]],
+                        num_nodes: int) -> 'pymatching.Matching':
+        import pymatching
+        matching = pymatching.Matching()
+        for (u, v), (p, obs, _) in edges.items():
+            if p <= 0:
+                continue
+            p = min(p, 1 - 1e-12)
+            fault_ids = {k for k in range(obs.bit_length()) if obs >> k & 1}
+            if v == -1:
+                matching.add_boundary_edge(u, fault_ids=fault_ids, weight=math.log((1 - p) / p), error_probability=p)
+            else:
+                matching.add_edge(u, v, fault_ids=fault_ids, weight=math.log((1 - p) / p), error_probability=p)
+        if matching.num_detectors < num_nodes:
+            # Nodes without edges still need to exist, so that syndromes have the window's length.
+            matching.add_boundary_edge(num_nodes - 1, weight=1e9, merge_strategy='keep-original')
+        return matching
+
+    def decode_packed(self, dets: np.ndarray) -> np.ndarray:
+        """Predicts bit packed observable flips from bit packed detection events (one row per shot)."""
+        events = np.unpackbits(dets, axis=1, bitorder='little', count=self.num_detectors).astype(np.bool_)
+        predictions = np.zeros((dets.shape[0], self.num_observables), dtype=np.bool_)
+        for shot, row in enumerate(events):
+            observables = 0
+            for window in self.windows:
+                committed = window.committed
+                syndrome = row[window.detectors]
+                if not syndrome.any():
+                    continue
+                for u, v in window.matching.decode_to_edges_array(syndrome):
+                    if not committed[u] and (v == -1 or not committed[v]):
+                        continue
+                    key = (u, v) if v == -1 else (min(u, v), max(u, v))
+                    edge_observables, far = window.edge_targets[key]
+                    observables ^= edge_observables
+                    for node in key:
+                        if node >= 0 and not committed[node]:
+                            row[window.detectors[node]] ^= True
+                    if far is not None:
+                        row[window.detectors[0] + far] ^= True
+            for k in range(self.num_observables):
+                predictions[shot, k] = observables >> k & 1
+        return np.packbits(predictions, axis=1, bitorder='little')
+
+
+class MatchingCache:
+    """Decoders of recently seen detector error models.
+
+    Sinter hands a decoder the task's error model on every batch of shots, and its own pymatching
+    decoder rebuilds the graph (through networkx) each time. This cache instead looks for an equal
+    model among the recently used ones (a cheap comparison done by stim), and only builds a new
+    decoder when there isn't one.
+    """
+
+    def __init__(self, build: Callable[[stim.DetectorErrorModel], Any], *, max_size: int = _MAX_CACHED_GRAPHS):
+        """
+        Args:
+            build: Makes a decoder (with a `decode_packed` method, like PackedMatcher) for a model.
+            max_size: How many decoders are kept.
+        """
+        self.build = build
+        self.max_size = max_size
+        self._entries: List[Tuple[stim.DetectorErrorModel, Any]] = []
+        self.timings = DecoderTimings()
+
+    def decoder(self, model: stim.DetectorErrorModel) -> Tuple[Any, bool]:
+        """Returns a decoder for the model, and whether it had to be built."""
+        for k, (cached_model, decoder) in enumerate(self._entries):
+            if cached_model.num_detectors == model.num_detectors and cached_model == model:
+                self._entries.append(self._entries.pop(k))
+                return decoder, False
+
+        start = time.monotonic()
+        with span('build_decoder', num_detectors=model.num_detectors):
+            decoder = self.build(model)
+        self.timings.build_seconds += time.monotonic() - start
+        self.timings.builds += 1
+        self._entries.append((model, decoder))
+        del self._entries[:-self.max_size]
+        return decoder, True
+
+
+_MATCHING_CACHES = {
+    'pymatching_cached': MatchingCache(PackedMatcher),
+    'pymatching_correlated': MatchingCache(functools.partial(PackedMatcher, enable_correlations=True)),
+    'pymatching_flagged': MatchingCache(FlagAwareMatcher),
+    'pymatching_windowed': MatchingCache(WindowedMatcher),
+}
+
+
+def _decode_b8_file(*,
+                    decoder: str,
+                    num_shots: int,
+                    num_dets: int,
+                    num_obs: int,
+                    error_model: stim.DetectorErrorModel,
+                    dets_b8_in_path: pathlib.Path,
+                    obs_predictions_b8_out_path: pathlib.Path) -> None:
+    cache = _MATCHING_CACHES[decoder]
+    timings = cache.timings
+    build_seconds = timings.build_seconds
+    # Sinter's workers don't say which task the shots came from, so the spans are labelled by model.
+    trace_labels = model_labels(error_model)
+    with labels(**trace_labels):
+        decoder_object, built = cache.decoder(error_model)
+
+    start = time.monotonic()
+    with labels(**trace_labels), span('decode', decoder=decoder, num_detectors=num_dets, shots=num_shots):
+        dets = np.fromfile(dets_b8_in_path, dtype=np.uint8, count=num_shots * math.ceil(num_dets / 8))
+        dets.shape = (num_shots, math.ceil(num_dets / 8))
+        predictions = np.zeros((num_shots, math.ceil(num_obs / 8)), dtype=np.uint8)
+        if num_shots:
+            packed = decoder_object.decode_packed(dets)
+            predictions[:, :packed.shape[1]] = packed[:, :predictions.shape[1]]
+        predictions.tofile(obs_predictions_b8_out_path)
+    decode_seconds = time.monotonic() - start
+
+    timings.calls += 1
+    timings.shots += num_shots
+    timings.decode_seconds += decode_seconds
+    timings_path = os.environ.get(_TIMINGS_PATH_ENV)
+    if timings_path:
+        with open(timings_path, 'a') as f:
+            print(json.dumps({
+                'pid': os.getpid(),
+                'decoder': decoder,
+                'num_dets': num_dets,
+                'shots': num_shots,
+                'built': built,
+                'build_seconds': timings.build_seconds - build_seconds,
+                'decode_seconds': decode_seconds,
+            }), file=f)
+
+
+def decode_using_cached_pymatching(*,
+                                   num_shots: int,
+                                   num_dets: int,
+                                   num_obs: int,
+                                   error_model: stim.DetectorErrorModel,
+                                   dets_b8_in_path: pathlib.Path,
+                                   obs_predictions_b8_out_path: pathlib.Path,
+                                   tmp_dir: pathlib.Path) -> None:
+    """Decodes with pymatching, reusing this process's matching graph when the error model repeats."""
+    _decode_b8_file(
+        decoder='pymatching_cached',
+        num_shots=num_shots,
+        num_dets=num_dets,
+        num_obs=num_obs,
+        error_model=error_model,
+        dets_b8_in_path=dets_b8_in_path,
+        obs_predictions_b8_out_path=obs_predictions_b8_out_path,
+    )
+
+
+def decode_using_correlated_pymatching(*,
+                                       num_shots: int,
+                                       num_dets: int,
+                                       num_obs: int,
+                                       error_model: stim.DetectorErrorModel,
+                                       dets_b8_in_path: pathlib.Path,
+                                       obs_predictions_b8_out_path: pathlib.Path,
+                                       tmp_dir: pathlib.Path) -> None:
+    """Decodes with pymatching's two-pass correlated matching.
+
+    The first pass matches normally. Edges that are components of the same decomposed error as a
+    matched edge (e.g. the X and Z halves of a Y error) are then made cheaper, and the shot is
+    matched again. The error model must have been made with `decompose_errors=True`, which is how
+    sinter makes it.
+    """
+    _decode_b8_file(
+        decoder='pymatching_correlated',
+        num_shots=num_shots,
+        num_dets=num_dets,
+        num_obs=num_obs,
+        error_model=error_model,
+        dets_b8_in_path=dets_b8_in_path,
+        obs_predictions_b8_out_path=obs_predictions_b8_out_path,
+    )
+
+
+def decode_using_flagged_pymatching(*,
+                                    num_shots: int,
+                                    num_dets: int,
+                                    num_obs: int,
+                                    error_model: stim.DetectorErrorModel,
+                                    dets_b8_in_path: pathlib.Path,
+                                    obs_predictions_b8_out_path: pathlib.Path,
+                                    tmp_dir: pathlib.Path) -> None:
+    """Decodes with pymatching, reweighting the edges indicated by each shot's fired flags (see FlagAwareMatcher)."""
+    _decode_b8_file(
+        decoder='pymatching_flagged',
+        num_shots=num_shots,
+        num_dets=num_dets,
+        num_obs=num_obs,
+        error_model=error_model,
+        dets_b8_in_path=dets_b8_in_path,
+        obs_predictions_b8_out_path=obs_predictions_b8_out_path,
+    )
+
+
+def decode_using_windowed_pymatching(*,
+                                     num_shots: int,
+                                     num_dets: int,
+                                     num_obs: int,
+                                     error_model: stim.DetectorErrorModel,
+                                     dets_b8_in_path: pathlib.Path,
+                                     obs_predictions_b8_out_path: pathlib.Path,
+                                     tmp_dir: pathlib.Path) -> None:
+    """Decodes with pymatching over overlapping windows of rounds (see WindowedMatcher)."""
+    _decode_b8_file(
+        decoder='pymatching_windowed',
+        num_shots=num_shots,
+        num_dets=num_dets,
+        num_obs=num_obs,
+        error_model=error_model,
+        dets_b8_in_path=dets_b8_in_path,
+        obs_predictions_b8_out_path=obs_predictions_b8_out_path,
+    )
+
+
+def process_decoder_timings(decoder: str = 'pymatching_cached') -> DecoderTimings:
+    """Returns the build and decode time spent by one of this process's cached decoders so far."""
+    return dataclasses.replace(_MATCHING_CACHES[decoder].timings)
+
+
+def register_decoders(*, timings_path: Optional[Union[str, pathlib.Path]] = None) -> None:
+    """Adds this repository's decoders to sinter's decoder table.
+
+    Registers 'pymatching_cached' (see `decode_using_cached_pymatching`), 'pymatching_correlated'
+    (see `decode_using_correlated_pymatching`), 'pymatching_flagged' (see
+    `decode_using_flagged_pymatching`) and 'pymatching_windowed' (see
+    `decode_using_windowed_pymatching`).
+
+    Args:
+        timings_path: If set, every decoding call (in any process started afterwards) appends a
+            json line with its build and decode time to this file.
+    """
+    DECODER_METHODS['pymatching_cached'] = decode_using_cached_pymatching
+    DECODER_METHODS['pymatching_correlated'] = decode_using_correlated_pymatching
+    DECODER_METHODS['pymatching_flagged'] = decode_using_flagged_pymatching
+    DECODER_METHODS['pymatching_windowed'] = decode_using_windowed_pymatching
+    if timings_path is not None:
+        os.environ[_TIMINGS_PATH_ENV] = str(timings_path)
+
+
+def summarize_decoder_timings(path: Union[str, pathlib.Path]) -> str:
+    """Totals the json lines written by the decoders, per decoder and detector count."""
+    totals: Dict[Tuple[str, int], DecoderTimings] = collections.defaultdict(DecoderTimings)
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            totals[(entry['decoder'], entry['num_dets'])] += DecoderTimings(
+                calls=1,
+                builds=int(entry['built']),
+                shots=entry['shots'],
+                build_seconds=entry['build_seconds'],
+                decode_seconds=entry['decode_seconds'],
+            )
+    lines = ['decoder,num_dets,calls,builds,shots,build_seconds,decode_seconds']
+    for (decoder, num_dets), t in sorted(totals.items()):
+        lines.append(f'{decoder},{num_dets},{t.calls},{t.builds},{t.shots},'
+                     f'{t.build_seconds:.3f},{t.decode_seconds:.3f}')
+    return '\n'.join(lines)
@@ -0,0 +1,201 @@
+import math
+import pathlib
+import re
+
+import numpy as np
+import pymatching
+import pytest
+import stim
+
+from _decoders import (
+    decode_using_cached_pymatching,
+    decode_using_correlated_pymatching,
+    decode_using_flagged_pymatching,
+    decode_using_windowed_pymatching,
+    flag_correlated_model,
+    flag_detectors,
+    process_decoder_timings,
+    WindowedMatcher,
+)
+from main import make_noisy_heavy_hex_circuit
+
+
+def test_cached_pymatching_matches_pymatching_and_reuses_graph(tmp_path: pathlib.Path):
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=3,
+        time_boundary_basis='Z',
+        rounds=3,
+        noise=5e-3,
+        gate_set='cx',
+    )
+    dem = circuit.detector_error_model(decompose_errors=True)
+    dets_path = tmp_path / 'dets.b8'
+    obs_path = tmp_path / 'obs.b8'
+    circuit.compile_detector_sampler(seed=2).sample_write(
+        500, filepath=str(dets_path), format='b8', obs_out_filepath=str(obs_path), obs_out_format='b8')
+    dets = np.fromfile(dets_path, dtype=np.uint8).reshape(500, -1)
+    expected = pymatching.Matching.from_detector_error_model(dem).decode_batch(
+        dets, bit_packed_shots=True, bit_packed_predictions=True)
+
+    before = process_decoder_timings()
+    for k in range(3):
+        predictions_path = tmp_path / f'predictions{k}.b8'
+        decode_using_cached_pymatching(
+            num_shots=500,
+            num_dets=dem.num_detectors,
+            num_obs=dem.num_observables,
+            # An equal (but distinct) model, like the ones sinter hands decoders on each batch.
+            error_model=dem.copy(),
+            dets_b8_in_path=dets_path,
+            obs_predictions_b8_out_path=predictions_path,
+            tmp_dir=tmp_path,
+        )
+        predictions = np.fromfile(predictions_path, dtype=np.uint8).reshape(500, math.ceil(dem.num_observables / 8))
+        np.testing.assert_array_equal(predictions, expected)
+    after = process_decoder_timings()
+    assert after.calls - before.calls == 3
+    assert after.builds - before.builds <= 1
+    assert after.shots - before.shots == 1500
+
+
+def test_correlated_and_flagged_pymatching_beat_uncorrelated(tmp_path: pathlib.Path):
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=5,
+        time_boundary_basis='Z',
+        rounds=5,
+        noise=3e-3,
+        gate_set='cx',
+    )
+    dem = circuit.detector_error_model(decompose_errors=True)
+    dets_path = tmp_path / 'dets.b8'
+    obs_path = tmp_path / 'obs.b8'
+    circuit.compile_detector_sampler(seed=2).sample_write(
+        2000, filepath=str(dets_path), format='b8', obs_out_filepath=str(obs_path), obs_out_format='b8')
+    obs = np.fromfile(obs_path, dtype=np.uint8)
+
+    mistakes = []
+    for decode in [decode_using_cached_pymatching, decode_using_correlated_pymatching, decode_using_flagged_pymatching]:
+        decode(
+            num_shots=2000,
+            num_dets=dem.num_detectors,
+            num_obs=dem.num_observables,
+            error_model=dem,
+            dets_b8_in_path=dets_path,
+            obs_predictions_b8_out_path=tmp_path / 'predictions.b8',
+            tmp_dir=tmp_path,
+        )
+        mistakes.append(np.count_nonzero(np.fromfile(tmp_path / 'predictions.b8', dtype=np.uint8) != obs))
+    uncorrelated, correlated, flagged = mistakes
+    assert correlated < uncorrelated * 0.9
+    assert flagged < uncorrelated * 0.9
+
+
+def test_flag_correlated_model_keeps_matching_graph():
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=3,
+        time_boundary_basis='Z',
+        rounds=4,
+        noise=1e-3,
+        gate_set='cx',
+    )
+    dem = circuit.detector_error_model(decompose_errors=True)
+    flags = flag_detectors(dem)
+    # Two flags per degree 4 X tile (there are two at diam=3), in every round.
+    assert len(flags) == 2 * 2 * 4
+
+    flagged = flag_correlated_model(dem)
+    assert flagged.num_detectors == dem.num_detectors
+    assert flagged.num_observables == dem.num_observables
+    for instruction in flagged:
+        targets = instruction.targets_copy()
+        if any(t.is_separator() for t in targets):
+            assert any(t.is_relative_detector_id() and t.val in flags for t in targets)
+    assert _edge_weights(flagged) == pytest.approx(_edge_weights(dem))
+
+
+def test_windowed_pymatching_matches_whole_shot_matching(tmp_path: pathlib.Path):
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=3,
+        time_boundary_basis='Z',
+        rounds=24,
+        noise=2e-3,
+        gate_set='cx',
+    )
+    dem = circuit.detector_error_model(decompose_errors=True)
+    dets_path = tmp_path / 'dets.b8'
+    obs_path = tmp_path / 'obs.b8'
+    circuit.compile_detector_sampler(seed=3).sample_write(
+        1000, filepath=str(dets_path), format='b8', obs_out_filepath=str(obs_path), obs_out_format='b8')
+    dets = np.fromfile(dets_path, dtype=np.uint8).reshape(1000, -1)
+    obs = np.fromfile(obs_path, dtype=np.uint8)
+    expected = pymatching.Matching.from_detector_error_model(dem).decode_batch(
+        dets, bit_packed_shots=True, bit_packed_predictions=True)[:, 0]
+
+    decode_using_windowed_pymatching(
+        num_shots=1000,
+        num_dets=dem.num_detectors,
+        num_obs=dem.num_observables,
+        error_model=dem,
+        dets_b8_in_path=dets_path,
+        obs_predictions_b8_out_path=tmp_path / 'predictions.b8',
+        tmp_dir=tmp_path,
+    )
+    predictions = np.fromfile(tmp_path / 'predictions.b8', dtype=np.uint8)
+    assert np.count_nonzero(predictions != expected) < 10
+
+    # The bulk windows of a memory experiment all share one graph.
+    windowed = WindowedMatcher(dem)
+    assert len(windowed.windows) > 4
+    assert len({id(window.matching) for window in windowed.windows}) <= 4
+
+
+def test_windowed_pymatching_flips_far_end_of_cut_off_edges():
+    # With one layer per window and no buffer, the likely D0-D1 error is cut off by the first
+    # window's top. Committing it must flip D1, or the second window matches D1 to the boundary
+    # (through L0) and cancels the prediction.
+    dem = stim.DetectorErrorModel('''
+        error(0.1) D0 D1 L0
+        error(0.01) D0
+        error(0.01) D1 L0
+        detector(0, 0, 0) D0
+        detector(0, 0, 1) D1
+    ''')
+    matcher = WindowedMatcher(dem, commit_layers=1, buffer_layers=0)
+    assert len(matcher.windows) == 2
+    dets = np.packbits([[1, 1], [1, 0], [0, 1]], axis=1, bitorder='little').astype(np.uint8)
+    predictions = np.unpackbits(matcher.decode_packed(dets), axis=1, bitorder='little')[:, 0]
+    np.testing.assert_array_equal(predictions, [1, 0, 1])
+
+
+
+def _permute_detectors(dem: stim.DetectorErrorModel, permutation: np.ndarray) -> stim.DetectorErrorModel:
+    assert 'repeat' not in str(dem) and 'shift_detectors' not in str(dem)
+    return stim.DetectorErrorModel(re.sub(r'\bD(\d+)\b', lambda m: f'D{permutation[int(m.group(1))]}', str(dem)))
+
+
+def test_windowed_pymatching_handles_detectors_out_of_time_order():
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=3,
+        time_boundary_basis='Z',
+        rounds=12,
+        noise=2e-3,
+        gate_set='cx',
+    )
+    dem = circuit.flattened().detector_error_model(decompose_errors=True)
+    permutation = np.random.default_rng(5).permutation(dem.num_detectors)
+    shuffled_dem = _permute_detectors(dem, permutation)
+    assert shuffled_dem.get_detector_coordinates()[int(permutation[0])] == dem.get_detector_coordinates()[0]
+
+    dets = circuit.compile_detector_sampler(seed=3).sample(300)
+    shuffled_dets = np.zeros_like(dets)
+    shuffled_dets[:, permutation] = dets
+    expected = WindowedMatcher(dem).decode_packed(np.packbits(dets, axis=1, bitorder='little'))
+    actual = WindowedMatcher(shuffled_dem).decode_packed(np.packbits(shuffled_dets, axis=1, bitorder='little'))
+    np.testing.assert_array_equal(actual, expected)
+
+
+def _edge_weights(dem) -> dict:
+    return {
+        (u, -1 if v is None else v, tuple(sorted(data['fault_ids']))): data['weight']
+        for u, v, data in pymatching.Matching.from_detector_error_model(dem).edges()
+    }
@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+from typing import Dict, Optional, Union
+
+import stim
+
+from _trace import span
+
+DEFAULT_DEM_CACHE_DIR = pathlib.Path(__file__).parent / 'out' / 'dem_cache'
+
+# The same options `sinter collect` uses when deriving a task's error model. Using them for every
+# cached model keeps the strong ids of collected statistics identical to ones computed by sinter.
+DEM_OPTIONS = dict(
+    allow_gauge_detectors=False,
+    approximate_disjoint_errors=True,
+    block_decomposition_from_introducing_remnant_edges=False,
+    decompose_errors=True,
+    flatten_loops=True,
+    ignore_decomposition_failures=False,
+)
+
+
+def _umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+class DemCache:
+    """Detector error models stored on disk, keyed by a hash of the circuit (and options) they were derived from.
+
+    Entries are `.dem` files (or gzipped `.dem.gz` files). Reading an entry refreshes its
+    modification time, and whenever an entry is added the least recently used entries are deleted
+    until the cache fits within its size cap. Entries are written atomically, so several processes
+    can share one cache directory.
+    """
+
+    def __init__(self,
+                 directory: Union[str, pathlib.Path] = DEFAULT_DEM_CACHE_DIR,
+                 *,
+                 max_bytes: Optional[int] = 2 * 2**30,
+                 compress: bool = True):
+        """
+        Args:
+            directory: Where the entries are stored. Created when the first entry is added.
+            max_bytes: Size cap of the cache's files. Set to None for no cap.
+            compress: Whether new entries are gzipped. Existing entries are read either way.
+        """
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.compress = compress
+
+    @staticmethod
+    def key(circuit: stim.Circuit, options: Dict[str, bool]) -> str:
+        text = json.dumps(options, sort_keys=True) + '\n' + str(circuit)
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    def _paths(self, key: str):
+        return [self.directory / f'{key}.dem.gz', self.directory / f'{key}.dem']
+
+    def get(self, circuit: stim.Circuit, **option_overrides: bool) -> Optional[stim.DetectorErrorModel]:
+        """Returns the cached error model of a circuit, or None if it isn't cached.
+
+        Args:
+            circuit: The circuit the error model was derived from.
+            **option_overrides: Arguments of `stim.Circuit.detector_error_model` that differ from
+                DEM_OPTIONS.
+        """
+        for path in self._paths(self.key(circuit, {**DEM_OPTIONS, **option_overrides})):
+            try:
+                opener = gzip.open if path.suffix == '.gz' else open
+                with opener(path, 'rt') as f:
+                    text = f.read()
+            except FileNotFoundError:
+                continue
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            return stim.DetectorErrorModel(text)
+        return None
+
+    def put(self,
+            circuit: stim.Circuit,
+            model: stim.DetectorErrorModel,
+            **option_overrides: bool) -> pathlib.Path:
+        """Stores the error model of a circuit, then evicts entries beyond the size cap."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        compressed_path, plain_path = self._paths(self.key(circuit, {**DEM_OPTIONS, **option_overrides}))
+        path = compressed_path if self.compress else plain_path
+        data = str(model).encode('utf8')
+        if self.compress:
+            data = gzip.compress(data, compresslevel=6, mtime=0)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp makes the file private; give it the permissions an ordinary new file would get.
+            os.fchmod(f.fileno(), 0o666 & ~_umask())
+            f.write(data)
+        os.replace(tmp_path, path)
+        (plain_path if self.compress else compressed_path).unlink(missing_ok=True)
+        self.evict(keep=path)
+        return path
+
+    def detector_error_model(self, circuit: stim.Circuit, **option_overrides: bool) -> stim.DetectorErrorModel:
+        """Returns the error model of a circuit, deriving and caching it if it isn't cached yet."""
+        with span('read_cached_dem'):
+            model = self.get(circuit, **option_overrides)
+        if model is None:
+            with span('detector_error_model', num_detectors=circuit.num_detectors):
+                model = circuit.detector_error_model(**{**DEM_OPTIONS, **option_overrides})
+            with span('write_cached_dem'):
+                self.put(circuit, model, **option_overrides)
+        return model
+
+    def evict(self, *, keep: Optional[pathlib.Path] = None) -> None:
+        """Deletes least recently used entries until the cache fits within its size cap."""
+        if self.max_bytes is None or not self.directory.exists():
+            return
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.endswith(('.dem', '.dem.gz')):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
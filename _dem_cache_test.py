@@ -0,0 +1,50 @@
+import os
+import pathlib
+
+import stim
+
+from _dem_cache import DemCache, DEM_OPTIONS
+
+
+def _circuit(p: float) -> stim.Circuit:
+    return stim.Circuit(f"""
+        X_ERROR({p}) 0 1
+        M 0 1
+        DETECTOR rec[-1]
+        DETECTOR rec[-2]
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """)
+
+
+def test_dem_cache_round_trip_and_lru_eviction(tmp_path: pathlib.Path):
+    cache = DemCache(tmp_path, max_bytes=None)
+    circuits = [_circuit(p) for p in [0.1, 0.2, 0.3]]
+    for circuit in circuits:
+        assert cache.get(circuit) is None
+        assert cache.detector_error_model(circuit) == circuit.detector_error_model(decompose_errors=True)
+        assert cache.get(circuit) == circuit.detector_error_model(decompose_errors=True)
+    assert cache.get(circuits[0], decompose_errors=False) is None
+
+    paths = sorted(tmp_path.iterdir())
+    assert len(paths) == 3
+    entry_size = max(path.stat().st_size for path in paths)
+    for k, circuit in enumerate(circuits):
+        path, = tmp_path.glob(DemCache.key(circuit, DEM_OPTIONS) + '*')
+        os.utime(path, (k, k))
+
+    # Reading an entry makes it the most recently used one.
+    cache.get(circuits[0])
+    cache.max_bytes = entry_size * 2
+    cache.evict()
+    assert cache.get(circuits[1]) is None
+    assert cache.get(circuits[0]) is not None
+    assert cache.get(circuits[2]) is not None
+
+
+def test_dem_cache_entries_are_readable_by_others(tmp_path: pathlib.Path):
+    old_umask = os.umask(0o022)
+    try:
+        path = DemCache(tmp_path).put(_circuit(0.1), _circuit(0.1).detector_error_model())
+    finally:
+        os.umask(old_umask)
+    assert path.stat().st_mode & 0o777 == 0o644
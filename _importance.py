@@ -0,0 +1,316 @@
+import dataclasses
+import math
+import pathlib
+import tempfile
+from typing import Optional, Tuple
+
+import numpy as np
+import stim
+from sinter.decoding import DECODER_METHODS
+
+from _decoders import _iter_dem_errors
+from _trace import span
+
+
+@dataclasses.dataclass
+class DemMechanisms:
+    """The independent error mechanisms of a detector error model, as arrays.
+
+    Mechanism k flips detectors `dets[det_starts[k]:det_starts[k+1]]` and observables
+    `obs[obs_starts[k]:obs_starts[k+1]]` with probability `probabilities[k]`. Components of
+    decomposed errors are combined, since only the symptoms matter when sampling.
+    """
+    probabilities: np.ndarray
+    det_starts: np.ndarray
+    dets: np.ndarray
+    obs_starts: np.ndarray
+    obs: np.ndarray
+    num_detectors: int
+    num_observables: int
+
+    @staticmethod
+    def from_dem(model: stim.DetectorErrorModel) -> 'DemMechanisms':
+        probabilities = []
+        det_starts, dets = [0], []
+        obs_starts, obs = [0], []
+        for p, components in _iter_dem_errors(model):
+            flipped_dets = set()
+            flipped_obs = set()
+            for component_dets, component_obs in components:
+                flipped_dets.symmetric_difference_update(component_dets)
+                flipped_obs.symmetric_difference_update(component_obs)
+            probabilities.append(p)
+            dets.extend(sorted(flipped_dets))
+            obs.extend(sorted(flipped_obs))
+            det_starts.append(len(dets))
+            obs_starts.append(len(obs))
+        return DemMechanisms(
+            probabilities=np.array(probabilities, dtype=np.float64),
+            det_starts=np.array(det_starts, dtype=np.int64),
+            dets=np.array(dets, dtype=np.int64),
+            obs_starts=np.array(obs_starts, dtype=np.int64),
+            obs=np.array(obs, dtype=np.int64),
+            num_detectors=model.num_detectors,
+            num_observables=model.num_observables,
+        )
+
+    def sample_errors(self, shots: int, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples which mechanisms occur in each shot.
+
+        Mechanisms are bucketed by probability (within a factor of 2). Candidate occurrences are
+        drawn at each bucket's largest probability, then thinned down to each mechanism's own
+        probability, so the cost is proportional to the number of occurrences rather than to
+        shots * mechanisms.
+
+        Returns:
+            A tuple (shot_ids, mechanism_ids) listing every occurrence, sorted by shot.
+        """
+        positive = np.flatnonzero(self.probabilities > 0)
+        buckets = np.floor(np.log2(self.probabilities[positive])).astype(np.int64)
+        shot_parts, mechanism_parts = [], []
+        for bucket in np.unique(buckets):
+            members = positive[buckets == bucket]
+            rate = min(float(self.probabilities[members].max()), 1.0)
+            population = shots * len(members)
+            k = rng.binomial(population, rate)
+            if k == 0:
+                continue
+            positions = rng.choice(population, size=k, replace=False, shuffle=False)
+            mechanism_ids = members[positions % len(members)]
+            keep = rng.random(k) * rate < self.probabilities[mechanism_ids]
+            shot_parts.append(positions[keep] // len(members))
+            mechanism_parts.append(mechanism_ids[keep])
+        if not shot_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        shot_ids = np.concatenate(shot_parts)
+        mechanism_ids = np.concatenate(mechanism_parts)
+        order = np.argsort(shot_ids, kind='stable')
+        return shot_ids[order], mechanism_ids[order]
+
+    def symptoms(self, shots: int, shot_ids: np.ndarray, mechanism_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the bit packed detection events and observable flips of sampled occurrences."""
+        return (
+            _packed_parities(shots, self.num_detectors, shot_ids, mechanism_ids, self.det_starts, self.dets),
+            _packed_parities(shots, self.num_observables, shot_ids, mechanism_ids, self.obs_starts, self.obs),
+        )
+
+
+def _packed_parities(shots: int,
+                     num_bits: int,
+                     shot_ids: np.ndarray,
+                     mechanism_ids: np.ndarray,
+                     starts: np.ndarray,
+                     targets: np.ndarray) -> np.ndarray:
+    counts = starts[mechanism_ids + 1] - starts[mechanism_ids]
+    flat_shots = np.repeat(shot_ids, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    flat_targets = targets[np.repeat(starts[mechanism_ids], counts) + offsets]
+    bits = np.zeros((shots, num_bits), dtype=np.uint8)
+    np.add.at(bits, (flat_shots, flat_targets), 1)
+    return np.packbits(bits & 1, axis=1, bitorder='little')
+
+
+def fault_count_distribution(probabilities: np.ndarray, max_faults: int) -> np.ndarray:
+    """Returns the probability of exactly 0, 1, ..., max_faults independent mechanisms occurring.
+
+    Mechanisms with equal probability are grouped into binomials, which are then convolved.
+    """
+    result = np.zeros(max_faults + 1)
+    result[0] = 1
+    values, counts = np.unique(probabilities[probabilities > 0], return_counts=True)
+    for p, n in zip(values, counts):
+        if p >= 1:
+            result = np.concatenate([np.zeros(n), result])[:max_faults + 1]
+            continue
+        k = np.arange(min(n, max_faults) + 1)
+        log_choose = np.array([math.lgamma(n + 1) - math.lgamma(e + 1) - math.lgamma(n - e + 1) for e in k])
+        binomial = np.exp(log_choose + k * math.log(p) + (n - k) * math.log1p(-p))
+        result = np.convolve(result, binomial)[:max_faults + 1]
+    return result
+
+
+def suggest_biased_noise(*, target_model: stim.DetectorErrorModel, noise: float, distance: int) -> float:
+    """Picks a noise strength to sample at, when estimating the logical error rate at `noise`.
+
+    The strength is scaled up so that shots have (d + 1) / 2 more faults on average than they do
+    at the target strength, which is roughly where failures start. It's never scaled down.
+    """
+    expected_faults = float(DemMechanisms.from_dem(target_model).probabilities.sum())
+    if expected_faults == 0:
+        return noise
+    return noise * max(1.0, (expected_faults + (distance + 1) / 2) / expected_faults)
+
+
+@dataclasses.dataclass(frozen=True)
+class ImportanceEstimate:
+    """A logical error rate estimated from shots sampled at a biased noise strength.
+
+    `errors` counts the biased shots the decoder got wrong. `effective_shots` is the Kish effective
+    sample size of the likelihood ratio weights, summed over fault counts. `unsampled_mass` is the
+    target probability of fault counts that no biased shot had; it is included in `high` (as if
+    those shots always failed) but not in `estimate`.
+    """
+    shots: int
+    errors: int
+    estimate: float
+    std_error: float
+    low: float
+    high: float
+    effective_shots: float
+    unsampled_mass: float
+
+
+def importance_sample_logical_error_rate(*,
+                                         target_model: stim.DetectorErrorModel,
+                                         biased_model: stim.DetectorErrorModel,
+                                         decoder: str,
+                                         shots: int,
+                                         target_fraction: float = 0.25,
+                                         batch_size: int = 10_000,
+                                         confidence_z: float = 1.96,
+                                         seed: Optional[int] = None) -> ImportanceEstimate:
+    """Estimates a logical error rate by sampling a noisier model and reweighting by likelihood ratio.
+
+    Each shot is sampled from the target model with probability `target_fraction`, and otherwise
+    from the biased model. A shot x is weighted by P(x) / (a P(x) + (1 - a) Q(x)), where P and Q
+    are the target and biased distributions and a is the target fraction. Mixing in the target
+    model bounds the weights by 1/a, and keeps the low fault counts (which are likely under P but
+    not under Q) sampled.
+
+    Shots are then grouped by how many mechanisms occurred (their fault count). The weighted
+    failure rate of each group is combined using the target model's exact fault count
+    distribution, which removes the (large) variance that comes from the weights varying between
+    fault counts. Shots with no faults can't fail, so that group doesn't need samples.
+
+    The confidence interval is a normal approximation, with each group's failure rate smoothed
+    by half a failure so that groups without failures still contribute uncertainty. Assuming that
+    more faults never make failing less likely, a group's variance is capped by the mean square
+    of the pooled failure rate of it and the groups above it.
+
+    Args:
+        target_model: The error model whose logical error rate is estimated. The decoder is
+            configured using it.
+        biased_model: An error model with the same mechanisms as the target, but with larger
+            probabilities (e.g. the same circuit made with a larger noise strength).
+        decoder: A key of `sinter.decoding.DECODER_METHODS`.
+        shots: How many shots to sample.
+        target_fraction: The probability that a shot is sampled from the target model instead of
+            the biased model.
+        batch_size: How many shots are sampled and decoded at a time.
+        confidence_z: The width of the reported interval, in standard errors.
+        seed: Seeds the sampling.
+
+    Returns:
+        The estimate.
+    """
+    if not 0 < target_fraction <= 1:
+        raise ValueError(f"{target_fraction=} isn't in (0, 1].")
+    if not target_model.approx_equals(biased_model, atol=1):
+        raise ValueError("The biased model doesn't have the same error mechanisms as the target model.")
+    target = DemMechanisms.from_dem(target_model)
+    biased = DemMechanisms.from_dem(biased_model)
+    p = target.probabilities
+    q = biased.probabilities
+    if np.any((q <= 0) & (p > 0)):
+        raise ValueError("The biased model can't produce some of the target model's errors.")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_absent = np.where(q < 1, np.log1p(-p) - np.log1p(-q), 0)
+        log_present = np.where(q > 0, np.log(p) - np.log(q), -np.inf)
+    log_none = float(log_absent.sum())
+    occurrence_log_ratio = log_present - log_absent
+    typical_log_ratio = float(np.mean(occurrence_log_ratio[q > 0]))
+
+    def log_weight(log_ratio: np.ndarray) -> np.ndarray:
+        # log(P / (a P + (1 - a) Q)) given log(P / Q).
+        if target_fraction == 1:
+            return np.zeros_like(log_ratio)
+        return -np.logaddexp(math.log(target_fraction), math.log1p(-target_fraction) - log_ratio)
+
+    decode_method = DECODER_METHODS.get(decoder)
+    if decode_method is None:
+        raise NotImplementedError(f"Unrecognized decoder: {decoder!r}")
+
+    # Per fault count: sum of weights, sum of weights of failures, sum of squared weights.
+    sums = np.zeros((3, 1))
+    errors = 0
+    rng = np.random.default_rng(seed)
+    done = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        while done < shots:
+            n = min(batch_size, shots - done)
+            with span('sample', shots=n):
+                num_target = rng.binomial(n, target_fraction)
+                target_shots, target_mechanisms = target.sample_errors(num_target, rng)
+                biased_shots, biased_mechanisms = biased.sample_errors(n - num_target, rng)
+                shot_ids = np.concatenate([target_shots, biased_shots + num_target])
+                mechanism_ids = np.concatenate([target_mechanisms, biased_mechanisms])
+                fault_counts = np.bincount(shot_ids, minlength=n)
+                log_ratios = np.full(n, log_none)
+                np.add.at(log_ratios, shot_ids, occurrence_log_ratio[mechanism_ids])
+                dets, obs = target.symptoms(n, shot_ids, mechanism_ids)
+
+            with span('decode', decoder=decoder, num_detectors=target.num_detectors, shots=n):
+                dets.tofile(tmp_dir / 'dets.b8')
+                decode_method(
+                    num_shots=n,
+                    num_dets=target.num_detectors,
+                    num_obs=target.num_observables,
+                    error_model=target_model,
+                    dets_b8_in_path=tmp_dir / 'dets.b8',
+                    obs_predictions_b8_out_path=tmp_dir / 'predictions.b8',
+                    tmp_dir=tmp_dir,
+                )
+                predictions = np.fromfile(tmp_dir / 'predictions.b8', dtype=np.uint8).reshape(obs.shape)
+            failed = np.any(predictions != obs, axis=1)
+            errors += int(np.count_nonzero(failed))
+
+            # Weights are only compared within a fault count, so each fault count's weights are
+            # divided by a fixed typical weight (keeping them from underflowing).
+            typical = log_weight(log_none + fault_counts * typical_log_ratio)
+            weights = np.exp(log_weight(log_ratios) - typical)
+            size = max(sums.shape[1], int(fault_counts.max()) + 1)
+            sums = np.pad(sums, ((0, 0), (0, size - sums.shape[1])))
+            sums += np.array([
+                np.bincount(fault_counts, weights=weights, minlength=size),
+                np.bincount(fault_counts, weights=weights * failed, minlength=size),
+                np.bincount(fault_counts, weights=weights**2, minlength=size),
+            ])
+            done += n
+
+    weight_sums, failure_sums, square_sums = sums
+    fault_probabilities = fault_count_distribution(p, len(weight_sums) - 1)
+    counted = weight_sums > 0
+    counted[0] = False
+    rates = np.zeros(len(weight_sums))
+    effective = np.zeros(len(weight_sums))
+    variances = np.zeros(len(weight_sums))
+    rates[counted] = failure_sums[counted] / weight_sums[counted]
+    effective[counted] = weight_sums[counted]**2 / square_sums[counted]
+    smoothed = (rates[counted] * effective[counted] + 0.5) / (effective[counted] + 1)
+    variances[counted] = smoothed * (1 - smoothed) / effective[counted]
+    # Failure rates don't decrease as fault counts increase, so a group's rate is also bounded by
+    # the pooled rate of it and the groups above it (which can have many more shots).
+    effective_failures = rates * effective
+    for w in np.flatnonzero(counted):
+        pooled_failures = np.cumsum(effective_failures[w:])
+        pooled_shots = np.cumsum(effective[w:])
+        pooled = (pooled_failures + 0.5) / (pooled_shots + 1)
+        bounds = pooled**2 + pooled * (1 - pooled) / np.maximum(pooled_shots, 1)
+        variances[w] = min(variances[w], float(bounds.min()))
+
+    unsampled = ~counted
+    unsampled[0] = False
+    estimate = float(np.dot(fault_probabilities, rates))
+    std_error = math.sqrt(float(np.dot(fault_probabilities**2, variances)))
+    unsampled_mass = float(fault_probabilities[unsampled].sum() + max(1 - fault_probabilities.sum(), 0))
+    return ImportanceEstimate(
+        shots=shots,
+        errors=errors,
+        estimate=estimate,
+        std_error=std_error,
+        low=max(estimate - confidence_z * std_error, 0),
+        high=min(estimate + confidence_z * std_error + unsampled_mass, 1),
+        effective_shots=float(effective.sum()),
+        unsampled_mass=unsampled_mass,
+    )
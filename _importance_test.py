@@ -0,0 +1,77 @@
+import itertools
+import math
+
+import numpy as np
+import stim
+
+from _decoders import PackedMatcher, register_decoders
+from _importance import DemMechanisms, fault_count_distribution, importance_sample_logical_error_rate
+from main import make_noisy_heavy_hex_circuit
+
+register_decoders()
+
+
+def test_fault_count_distribution_matches_brute_force():
+    probabilities = np.array([0.1, 0.1, 0.25, 0.01, 0.5])
+    expected = np.zeros(len(probabilities) + 1)
+    for occurred in itertools.product([0, 1], repeat=len(probabilities)):
+        expected[sum(occurred)] += math.prod(p if x else 1 - p for p, x in zip(probabilities, occurred))
+    np.testing.assert_allclose(fault_count_distribution(probabilities, len(probabilities)), expected)
+    np.testing.assert_allclose(fault_count_distribution(probabilities, 2), expected[:3])
+
+
+def test_dem_mechanisms_sample_with_their_probabilities():
+    model = stim.DetectorErrorModel('''
+        error(0.3) D0 D1 ^ D2 L0
+        error(0.01) D1
+        error(0.02) D2 D3
+    ''')
+    mechanisms = DemMechanisms.from_dem(model)
+    np.testing.assert_array_equal(mechanisms.probabilities, [0.3, 0.01, 0.02])
+
+    shots = 100_000
+    shot_ids, mechanism_ids = mechanisms.sample_errors(shots, np.random.default_rng(5))
+    counts = np.bincount(mechanism_ids, minlength=3)
+    for count, p in zip(counts, mechanisms.probabilities):
+        assert abs(count - shots * p) < 5 * math.sqrt(shots * p * (1 - p))
+    assert len(set(zip(shot_ids, mechanism_ids))) == len(shot_ids)
+
+    dets, obs = mechanisms.symptoms(3, np.array([0, 1, 2, 2]), np.array([0, 1, 1, 2]))
+    np.testing.assert_array_equal(np.unpackbits(dets, axis=1, bitorder='little')[:, :4], [
+        [1, 1, 1, 0],
+        [0, 1, 0, 0],
+        [0, 1, 1, 1],
+    ])
+    np.testing.assert_array_equal(np.unpackbits(obs, axis=1, bitorder='little')[:, 0], [1, 0, 0])
+
+
+def test_importance_sampling_agrees_with_direct_sampling():
+    def circuit(noise: float) -> stim.Circuit:
+        return make_noisy_heavy_hex_circuit(
+            diam=3,
+            time_boundary_basis='Z',
+            rounds=3,
+            noise=noise,
+            gate_set='cx',
+        )
+    target = circuit(2e-3)
+    target_model = target.detector_error_model(decompose_errors=True)
+    biased_model = circuit(6e-3).detector_error_model(decompose_errors=True)
+
+    shots = 20_000
+    samples = target.compile_detector_sampler(seed=3).sample(shots, append_observables=True)
+    dets = np.packbits(samples[:, :target.num_detectors], axis=1, bitorder='little')
+    predictions = np.unpackbits(PackedMatcher(target_model).decode_packed(dets), axis=1, bitorder='little')
+    direct = np.count_nonzero(predictions[:, 0] != samples[:, -1]) / shots
+    direct_std_error = math.sqrt(direct * (1 - direct) / shots)
+
+    estimate = importance_sample_logical_error_rate(
+        target_model=target_model,
+        biased_model=biased_model,
+        decoder='pymatching_cached',
+        shots=shots,
+        seed=3,
+    )
+    assert estimate.errors > direct * shots
+    assert estimate.low <= estimate.estimate <= estimate.high
+    assert abs(estimate.estimate - direct) < 4 * math.hypot(estimate.std_error, direct_std_error)
@@ -0,0 +1,181 @@
+import dataclasses
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import stim
+
+from _decoders import _iter_dem_errors
+from _dem_cache import DEM_OPTIONS
+
+# An error's components, each a (sorted detectors, sorted observables) pair.
+_Targets = Tuple[Tuple[Tuple[int, ...], Tuple[int, ...]], ...]
+
+
+@dataclasses.dataclass
+class _FlatDem:
+    """A flattened detector error model: its errors (with absolute detector ids) and detector coordinates."""
+    errors: List[Tuple[float, _Targets]]
+    coords: Dict[int, List[float]]
+    num_detectors: int
+    num_observables: int
+
+    @staticmethod
+    def from_dem(model: stim.DetectorErrorModel) -> '_FlatDem':
+        errors = [
+            (p, tuple((tuple(sorted(dets)), tuple(sorted(obs))) for dets, obs in components))
+            for p, components in _iter_dem_errors(model)
+        ]
+        return _FlatDem(errors, model.get_detector_coordinates(), model.num_detectors, model.num_observables)
+
+
+def _anchor(targets: _Targets) -> int:
+    """The smallest detector an error touches (errors touching no detectors go first)."""
+    return min((d for dets, _ in targets for d in dets), default=-1)
+
+
+def _shifted(targets: _Targets, shift: int) -> _Targets:
+    return tuple((tuple(d + shift for d in dets), obs) for dets, obs in targets)
+
+
+def canonical_errors(model: stim.DetectorErrorModel) -> Dict[_Targets, List[float]]:
+    """Groups the (flattened) errors of a model by their targets, for comparing models that list them differently."""
+    result: Dict[_Targets, List[float]] = {}
+    for p, targets in _FlatDem.from_dem(model).errors:
+        result.setdefault(targets, []).append(p)
+    return {targets: sorted(ps) for targets, ps in result.items()}
+
+
+@dataclasses.dataclass
+class PeriodicDem:
+    """A detector error model split into a head, a body that repeats once per round, and a tail.
+
+    `head` and the body use absolute detector ids starting at 0 and at `body_start` respectively;
+    the tail's ids are relative to where the repetitions of the body end. Each repetition of the
+    body shifts detector ids by `period_detectors` and the time coordinate by `period_time`.
+    """
+    base_rounds: int
+    head: List[Tuple[float, _Targets]]
+    body: List[Tuple[float, _Targets]]
+    tail: List[Tuple[float, _Targets]]
+    head_coords: Dict[int, List[float]]
+    body_coords: Dict[int, List[float]]
+    tail_coords: Dict[int, List[float]]
+    body_start: int
+    period_detectors: int
+    period_time: float
+    num_observables: int
+
+    @staticmethod
+    def derive(base: stim.DetectorErrorModel, extended: stim.DetectorErrorModel, *, base_rounds: int) -> 'PeriodicDem':
+        """Finds the repeating part of a circuit's error model, from its models at two consecutive round counts.
+
+        Args:
+            base: The (flattened) error model of the circuit with `base_rounds` rounds.
+            extended: The (flattened) error model of the same circuit with one more round.
+            base_rounds: The number of rounds of `base`.
+
+        Raises:
+            ValueError: The models don't differ by one repeated period of errors (e.g. because
+                `base_rounds` is too small for the middle rounds to look alike).
+        """
+        small = _FlatDem.from_dem(base)
+        large = _FlatDem.from_dem(extended)
+        period = large.num_detectors - small.num_detectors
+        if period <= 0:
+            raise ValueError("The extended model doesn't have more detectors than the base model.")
+
+        # Try cutting at each time layer boundary, from the middle of the base model outward, until
+        # the head/body/tail split reproduces the extended model.
+        times = np.array([(small.coords.get(k) or [0])[-1] for k in range(small.num_detectors)])
+        boundaries = [0] + [k for k in range(1, small.num_detectors) if times[k] != times[k - 1]]
+        boundaries.sort(key=lambda k: abs(k - small.num_detectors / 2))
+        expected = sorted(large.errors)
+        for start in boundaries:
+            if start + period > large.num_detectors or not large.coords.get(start):
+                continue
+            period_time = large.coords[start + period][-1] - large.coords[start][-1] if large.coords.get(start + period) else 0
+            result = PeriodicDem(
+                base_rounds=base_rounds,
+                head=[(p, t) for p, t in small.errors if _anchor(t) < start],
+                body=[(p, _shifted(t, -start)) for p, t in large.errors if start <= _anchor(t) < start + period],
+                tail=[(p, _shifted(t, -start)) for p, t in small.errors if _anchor(t) >= start],
+                head_coords={k: c for k, c in small.coords.items() if k < start},
+                body_coords={k - start: c for k, c in large.coords.items() if start <= k < start + period},
+                tail_coords={k - start: c for k, c in small.coords.items() if k >= start},
+                body_start=start,
+                period_detectors=period,
+                period_time=period_time,
+                num_observables=small.num_observables,
+            )
+            # Check that one repetition of the body reproduces the extended model, without a round trip through text.
+            errors = (result.head
+                      + [(p, _shifted(t, start)) for p, t in result.body]
+                      + [(p, _shifted(t, start + period)) for p, t in result.tail])
+            coords = {**result.head_coords, **{k + start: c for k, c in result.body_coords.items()}}
+            for k, c in result.tail_coords.items():
+                coords[k + start + period] = c[:-1] + [c[-1] + period_time]
+            if sorted(errors) == expected and coords == large.coords:
+                return result
+        raise ValueError("Couldn't split the model into a head, a repeating body and a tail.")
+
+    def detector_error_model(self, rounds: int) -> stim.DetectorErrorModel:
+        """Returns the error model for the given number of rounds, with the body in a repeat block.
+
+        Flattening the result gives the same errors as deriving the model of the full circuit
+        with loops flattened, but its size (and the time it takes to make) doesn't depend on the
+        number of rounds.
+        """
+        repetitions = rounds - self.base_rounds
+        if repetitions < 0:
+            raise ValueError(f"{rounds=} is less than the {self.base_rounds} rounds the model was derived from.")
+
+        def lines(errors: List[Tuple[float, _Targets]], coords: Dict[int, List[float]], indent: str = '') -> List[str]:
+            result = []
+            for p, targets in errors:
+                components = [' '.join([f'D{d}' for d in dets] + [f'L{k}' for k in obs]) for dets, obs in targets]
+                result.append(f'{indent}error({p!r}) ' + ' ^ '.join(components))
+            for k, c in sorted(coords.items()):
+                result.append(f'{indent}detector({", ".join(repr(float(v)) for v in c)}) D{k}' if c else f'{indent}detector D{k}')
+            return result
+
+        time_shift = ', '.join(['0'] * (len(next(iter(self.body_coords.values()), [0])) - 1) + [repr(self.period_time)])
+        text = lines(self.head, self.head_coords)
+        text.append(f'shift_detectors {self.body_start}')
+        if repetitions:
+            text.append(f'repeat {repetitions} {{')
+            text.extend(lines(self.body, self.body_coords, indent='    '))
+            text.append(f'    shift_detectors({time_shift}) {self.period_detectors}')
+            text.append('}')
+        text.extend(lines(self.tail, self.tail_coords))
+        if self.num_observables:
+            text.append(f'logical_observable L{self.num_observables - 1}')
+        return stim.DetectorErrorModel('\n'.join(text))
+
+
+def periodic_detector_error_model(make_circuit: Callable[..., stim.Circuit],
+                                  *,
+                                  rounds: int,
+                                  base_rounds: int = 5,
+                                  **option_overrides: bool) -> stim.DetectorErrorModel:
+    """Makes a circuit's error model by repeating one round's errors, instead of analyzing every round.
+
+    Only the circuits with `base_rounds` and `base_rounds + 1` rounds are analyzed by stim (see
+    `PeriodicDem.derive`), so the cost doesn't depend on `rounds`. Circuits with fewer rounds
+    than that are analyzed directly.
+
+    Args:
+        make_circuit: Makes the circuit, given a `rounds` keyword argument. For example
+            `functools.partial(make_noisy_heavy_hex_circuit, diam=5, ...)`.
+        rounds: The number of rounds of the circuit whose error model is returned.
+        base_rounds: The number of rounds of the smaller circuit analyzed by stim.
+        **option_overrides: Changes to the options (`DEM_OPTIONS`) passed to stim.
+    """
+    options = {**DEM_OPTIONS, **option_overrides, 'flatten_loops': True}
+    if rounds <= base_rounds + 1:
+        return make_circuit(rounds=rounds).detector_error_model(**options)
+    periodic = PeriodicDem.derive(
+        make_circuit(rounds=base_rounds).detector_error_model(**options),
+        make_circuit(rounds=base_rounds + 1).detector_error_model(**options),
+        base_rounds=base_rounds,
+    )
+    return periodic.detector_error_model(rounds)
@@ -0,0 +1,46 @@
+import functools
+
+import pytest
+import stim
+
+from _dem_cache import DEM_OPTIONS
+from _periodic_dem import PeriodicDem, canonical_errors, periodic_detector_error_model
+from main import make_noisy_heavy_hex_circuit
+
+
+@pytest.mark.parametrize('gate_set,basis,rounds', [
+    ('cx', 'Z', 7),
+    ('cx', 'X', 10),
+    ('cx_noflags', 'Z', 10),
+    ('cx_noflags', 'X', 4),
+])
+def test_periodic_dem_matches_full_dem(gate_set: str, basis: str, rounds: int):
+    make = functools.partial(make_noisy_heavy_hex_circuit, diam=3, time_boundary_basis=basis, noise=1e-3, gate_set=gate_set)
+    actual = periodic_detector_error_model(make, rounds=rounds)
+    expected = make(rounds=rounds).detector_error_model(**DEM_OPTIONS)
+    assert canonical_errors(actual) == canonical_errors(expected)
+    assert actual.get_detector_coordinates() == expected.get_detector_coordinates()
+    assert actual.num_detectors == expected.num_detectors
+    assert actual.num_observables == expected.num_observables
+
+
+def test_periodic_dem_size_is_independent_of_rounds():
+    make = functools.partial(make_noisy_heavy_hex_circuit, diam=3, time_boundary_basis='Z', noise=1e-3, gate_set='cx')
+    short = periodic_detector_error_model(make, rounds=10)
+    long = periodic_detector_error_model(make, rounds=50)
+    assert len(str(short).splitlines()) == len(str(long).splitlines())
+    assert long.num_detectors > short.num_detectors
+
+
+def test_derive_rejects_non_periodic_models():
+    base = stim.DetectorErrorModel('''
+        error(0.1) D0 D1
+        error(0.1) D1 L0
+    ''')
+    extended = stim.DetectorErrorModel('''
+        error(0.1) D0 D1
+        error(0.2) D1 D2
+        error(0.3) D2 L0
+    ''')
+    with pytest.raises(ValueError):
+        PeriodicDem.derive(base, extended, base_rounds=2)
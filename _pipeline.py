@@ -0,0 +1,389 @@
+import dataclasses
+import math
+import multiprocessing
+import pathlib
+import queue
+import tempfile
+import time
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import sinter
+import stim
+from sinter.decoding import DECODER_METHODS
+
+from _decoders import _MATCHING_CACHES, register_decoders
+from _dem_cache import DemCache, DEFAULT_DEM_CACHE_DIR
+from _trace import labels, span
+
+# How long a sampler waits for a free slot before checking whether its circuits were stopped.
+_FREE_SLOT_POLL_SECONDS = 0.1
+# Fewest shots in a batch. Batches are sized from the error rates seen so far, starting from this.
+_FIRST_BATCH_SHOTS = 100
+
+
+@dataclasses.dataclass(frozen=True)
+class _Circuit:
+    """What the worker processes need to know about one circuit of the pipeline."""
+    path: pathlib.Path
+    metadata: Dict[str, Any]
+    num_dets: int
+    num_obs: int
+    batch_shots: int  # The most shots fitting in a slot.
+    max_shots: int
+
+    @property
+    def det_bytes(self) -> int:
+        return math.ceil(self.num_dets / 8)
+
+    @property
+    def obs_bytes(self) -> int:
+        return math.ceil(self.num_obs / 8)
+
+
+@dataclasses.dataclass(frozen=True)
+class _Batch:
+    """A batch of shots a sampler wrote into one slot of its ring buffer."""
+    sampler: int
+    slot: int
+    circuit: int
+    shots: int
+    sample_seconds: float
+
+
+@dataclasses.dataclass(frozen=True)
+class _Result:
+    """How one decoder did on a batch."""
+    sampler: int
+    circuit: int
+    decoder: str
+    shots: int
+    errors: int
+    seconds: float
+
+
+@dataclasses.dataclass(frozen=True)
+class _SamplerDone:
+    sampler: int
+    batches: int
+
+
+def _slot_views(buffer: memoryview, circuit: _Circuit, slot: int, slot_bytes: int, shots: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The bit packed detection events and observable flips of a batch in a ring buffer slot."""
+    data = np.frombuffer(buffer, dtype=np.uint8, count=slot_bytes, offset=slot * slot_bytes)
+    dets = data[:shots * circuit.det_bytes].reshape(shots, circuit.det_bytes)
+    obs = data[circuit.batch_shots * circuit.det_bytes:][:shots * circuit.obs_bytes].reshape(shots, circuit.obs_bytes)
+    return dets, obs
+
+
+def _sampler_main(index: int,
+                  circuits: List[_Circuit],
+                  assigned: List[int],
+                  ring_name: str,
+                  slot_bytes: int,
+                  free_slots: multiprocessing.Queue,
+                  batches: multiprocessing.Queue,
+                  results: multiprocessing.Queue,
+                  batch_limits,
+                  seed: Optional[int]) -> None:
+    """Samples its circuits round robin into free slots, until each is stopped or out of shots.
+
+    The main process sets the most shots each circuit's next batch can have in `batch_limits`,
+    and stops a circuit by setting its limit to 0.
+    """
+    ring = shared_memory.SharedMemory(name=ring_name)
+    samplers = {}
+    issued = {k: 0 for k in assigned}
+    sent = 0
+    active = list(assigned)
+    while active:
+        for k in list(active):
+            circuit = circuits[k]
+            if not batch_limits[k] or issued[k] >= circuit.max_shots:
+                active.remove(k)
+                continue
+            try:
+                slot = free_slots.get(timeout=_FREE_SLOT_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            start = time.monotonic()
+            shots = min(batch_limits[k], circuit.max_shots - issued[k])
+            with labels(**circuit.metadata), span('sample', shots=shots):
+                if k not in samplers:
+                    samplers[k] = stim.Circuit.from_file(circuit.path).compile_detector_sampler(
+                        seed=None if seed is None else seed + k)
+                samples = samplers[k].sample(shots, append_observables=True)
+                dets, obs = _slot_views(ring.buf, circuit, slot, slot_bytes, shots)
+                dets[:] = np.packbits(samples[:, :circuit.num_dets], axis=1, bitorder='little')
+                obs[:] = np.packbits(samples[:, circuit.num_dets:], axis=1, bitorder='little')
+                del samples, dets, obs
+            issued[k] += shots
+            sent += 1
+            batches.put(_Batch(
+                sampler=index,
+                slot=slot,
+                circuit=k,
+                shots=shots,
+                sample_seconds=time.monotonic() - start,
+            ))
+    # (Not closed on errors, where views into the ring may still be alive. Exiting unmaps it anyway.)
+    ring.close()
+    results.put(_SamplerDone(sampler=index, batches=sent))
+
+
+def _predict(decoder: str, model: stim.DetectorErrorModel, dets: np.ndarray, num_obs: int) -> np.ndarray:
+    """Predicts bit packed observable flips, decoding in memory when the decoder is one of this repository's."""
+    if decoder in _MATCHING_CACHES:
+        decoder_object, _ = _MATCHING_CACHES[decoder].decoder(model)
+        predictions = np.zeros((dets.shape[0], math.ceil(num_obs / 8)), dtype=np.uint8)
+        packed = decoder_object.decode_packed(dets)
+        predictions[:, :packed.shape[1]] = packed[:, :predictions.shape[1]]
+        return predictions
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        dets.tofile(tmp_dir / 'dets.b8')
+        DECODER_METHODS[decoder](
+            num_shots=dets.shape[0],
+            num_dets=model.num_detectors,
+            num_obs=num_obs,
+            error_model=model,
+            dets_b8_in_path=tmp_dir / 'dets.b8',
+            obs_predictions_b8_out_path=tmp_dir / 'predictions.b8',
+            tmp_dir=tmp_dir,
+        )
+        predictions = np.fromfile(tmp_dir / 'predictions.b8', dtype=np.uint8)
+        return predictions.reshape(dets.shape[0], math.ceil(num_obs / 8))
+
+
+def _decoder_main(circuits: List[_Circuit],
+                  decoder_methods: Dict[str, Callable],
+                  ring_names: List[str],
+                  slot_bytes: int,
+                  free_slots: List[multiprocessing.Queue],
+                  batches: multiprocessing.Queue,
+                  results: multiprocessing.Queue,
+                  dem_cache_dir: pathlib.Path) -> None:
+    """Decodes batches with every decoder and hands their slots back, until given None."""
+    register_decoders()
+    # Spawned (rather than forked) workers start with sinter's own table, without decoders the
+    # parent registered.
+    DECODER_METHODS.update(decoder_methods)
+    decoders = list(decoder_methods)
+    rings = [shared_memory.SharedMemory(name=name) for name in ring_names]
+    dem_cache = DemCache(dem_cache_dir)
+    models: Dict[int, stim.DetectorErrorModel] = {}
+    while (batch := batches.get()) is not None:
+        circuit = circuits[batch.circuit]
+        if batch.circuit not in models:
+            with labels(**circuit.metadata):
+                models[batch.circuit] = dem_cache.detector_error_model(stim.Circuit.from_file(circuit.path))
+        dets, obs = _slot_views(rings[batch.sampler].buf, circuit, batch.slot, slot_bytes, batch.shots)
+        for decoder in decoders:
+            start = time.monotonic()
+            trace_args = dict(decoder=decoder, num_detectors=circuit.num_dets, shots=batch.shots)
+            with labels(**circuit.metadata), span('decode', **trace_args):
+                predictions = _predict(decoder, models[batch.circuit], dets, circuit.num_obs)
+                errors = int(np.count_nonzero(np.any(predictions != obs, axis=1)))
+            results.put(_Result(
+                sampler=batch.sampler,
+                circuit=batch.circuit,
+                decoder=decoder,
+                shots=batch.shots,
+                errors=errors,
+                # Sinter counts sampling time too; it's split evenly between the decoders sharing the shots.
+                seconds=time.monotonic() - start + batch.sample_seconds / len(decoders),
+            ))
+        del dets, obs
+        free_slots[batch.sampler].put(batch.slot)
+    for ring in rings:
+        ring.close()
+
+
+def _next_batch_shots(tasks: List[sinter.TaskStats], *, max_errors: int, batch_shots: int, batches_in_flight: int) -> int:
+    """Sizes a circuit's batches so that the batches in flight don't overshoot the error budget by much.
+
+    Returns 0 once every task has reached the budget.
+    """
+    shots_needed = 0
+    for stats in tasks:
+        if stats.errors < max_errors:
+            rate = (stats.errors + 1) / (stats.shots + 1)
+            shots_needed = max(shots_needed, (max_errors - stats.errors) / rate)
+    if not shots_needed:
+        return 0
+    return int(min(batch_shots, max(_FIRST_BATCH_SHOTS, shots_needed / batches_in_flight)))
+
+
+def collect_pipelined(*,
+                      circuit_paths: List[pathlib.Path],
+                      decoders: List[str],
+                      max_shots: int,
+                      max_errors: int,
+                      num_samplers: int,
+                      num_decoder_workers: int,
+                      dem_cache_dir: pathlib.Path = DEFAULT_DEM_CACHE_DIR,
+                      existing_stats: Iterable[sinter.TaskStats] = (),
+                      slots_per_sampler: int = 4,
+                      slot_bytes: int = 2**22,
+                      max_batch_shots: int = 10_000,
+                      seed: Optional[int] = None,
+                      on_stats: Optional[Callable[[sinter.TaskStats], None]] = None) -> Dict[str, sinter.TaskStats]:
+    """Collects statistics with separate pools of sampling and decoding processes.
+
+    Each sampler process owns a shared memory ring buffer of `slots_per_sampler` slots. It samples
+    its circuits (assigned round robin) into free slots, as bit packed detection events and
+    observable flips, and passes the filled slots to the decoder processes. They decode each
+    batch with every decoder and hand the slot back. A sampler waits when all its slots are in
+    use, so sampling can't run ahead of decoding by more than the ring buffers hold. With more
+    samplers than decoder workers (or vice versa) on a machine, sampling heavy tasks (high noise)
+    and decoding heavy tasks (large diameters) keep every core busy.
+
+    A circuit stops being sampled once it has `max_shots` shots, or every decoder has seen
+    `max_errors` errors on it. Like `sinter collect`, batch sizes start small and grow to fit
+    the observed error rates, and batches already in flight when a budget is reached are still
+    counted, so totals can overshoot the budget slightly.
+
+    Args:
+        circuit_paths: Circuits written by main.py (their file names give the json metadata).
+        decoders: Keys of `sinter.decoding.DECODER_METHODS` (as registered in this process). Every batch is
+            decoded by each one.
+        max_shots: Shot budget of each circuit.
+        max_errors: Error budget of each (circuit, decoder) task.
+        num_samplers: Number of sampling processes.
+        num_decoder_workers: Number of decoding processes.
+        dem_cache_dir: Where the circuits' error models are cached.
+        existing_stats: Previously collected statistics, counted towards the budgets.
+        slots_per_sampler: Size of each sampler's ring buffer, in batches.
+        slot_bytes: Size of each ring buffer slot. Batches of large circuits get fewer shots to fit.
+        max_batch_shots: Most shots in one batch.
+        seed: Seeds the samplers (circuit k uses `seed + k`). Shots are only reproducible with a
+            single sampler, since otherwise batch boundaries depend on timing.
+        on_stats: Called with the statistics of every decoded batch, as they arrive.
+
+    Returns:
+        The total statistics of each task (including the existing ones), keyed by strong id.
+    """
+    dem_cache = DemCache(dem_cache_dir)
+    totals: Dict[str, sinter.TaskStats] = {}
+    for stats in existing_stats:
+        totals[stats.strong_id] = totals[stats.strong_id] + stats if stats.strong_id in totals else stats
+
+    circuits = []
+    task_ids: Dict[Tuple[int, str], str] = {}
+    for k, path in enumerate(circuit_paths):
+        circuit = stim.Circuit.from_file(path)
+        metadata = sinter.comma_separated_key_values(str(path))
+        model = dem_cache.detector_error_model(circuit)
+        # Only tasks still short of errors need more shots, starting from the fewest any of them has.
+        collected = max_shots
+        for decoder in decoders:
+            task_id = sinter.Task(
+                circuit=circuit,
+                decoder=decoder,
+                detector_error_model=model,
+                json_metadata=metadata,
+            ).strong_id()
+            task_ids[(k, decoder)] = task_id
+            if task_id not in totals:
+                totals[task_id] = sinter.TaskStats(
+                    strong_id=task_id, decoder=decoder, json_metadata=metadata,
+                    shots=0, errors=0, discards=0, seconds=0)
+            if totals[task_id].errors < max_errors:
+                collected = min(collected, totals[task_id].shots)
+        shot_bytes = math.ceil(circuit.num_detectors / 8) + math.ceil(circuit.num_observables / 8)
+        if shot_bytes > slot_bytes:
+            raise ValueError(f"A shot of {path} takes {shot_bytes} bytes, which doesn't fit in {slot_bytes=}.")
+        circuits.append(_Circuit(
+            path=pathlib.Path(path),
+            metadata=metadata,
+            num_dets=circuit.num_detectors,
+            num_obs=circuit.num_observables,
+            batch_shots=min(max_batch_shots, slot_bytes // shot_bytes),
+            max_shots=max(0, max_shots - collected),
+        ))
+
+    register_decoders()
+    unknown = [decoder for decoder in decoders if decoder not in DECODER_METHODS]
+    if unknown:
+        raise ValueError(f"Decoders {unknown} aren't in sinter.decoding.DECODER_METHODS.")
+    # Handed to the decoder workers by reference, so they must be importable functions.
+    decoder_methods = {decoder: DECODER_METHODS[decoder] for decoder in decoders}
+
+    num_samplers = max(1, min(num_samplers, len(circuits)))
+    context = multiprocessing.get_context()
+    rings = [shared_memory.SharedMemory(create=True, size=slots_per_sampler * slot_bytes) for _ in range(num_samplers)]
+    free_slots = [context.Queue() for _ in range(num_samplers)]
+    for q in free_slots:
+        for slot in range(slots_per_sampler):
+            q.put(slot)
+    batches = context.Queue()
+    results = context.Queue()
+    batch_limits = context.Array('q', [
+        _next_batch_shots(
+            [totals[task_ids[(k, decoder)]] for decoder in decoders],
+            max_errors=max_errors,
+            batch_shots=circuit.batch_shots,
+            batches_in_flight=slots_per_sampler,
+        )
+        for k, circuit in enumerate(circuits)
+    ], lock=False)
+    processes = [
+        context.Process(target=_sampler_main, args=(
+            index, circuits, list(range(index, len(circuits), num_samplers)), rings[index].name,
+            slot_bytes, free_slots[index], batches, results, batch_limits, seed))
+        for index in range(num_samplers)
+    ]
+    processes += [
+        context.Process(target=_decoder_main, args=(
+            circuits, decoder_methods, [ring.name for ring in rings], slot_bytes, free_slots, batches, results,
+            pathlib.Path(dem_cache_dir)))
+        for _ in range(num_decoder_workers)
+    ]
+    try:
+        for process in processes:
+            process.start()
+        sent: Dict[int, int] = {}
+        decoded = [0] * num_samplers
+        while len(sent) < num_samplers or sum(decoded) < sum(sent.values()) * len(decoders):
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() or process.exitcode == 0 for process in processes):
+                    raise RuntimeError("A pipeline worker process died.")
+                continue
+            if isinstance(message, _SamplerDone):
+                sent[message.sampler] = message.batches
+                continue
+            decoded[message.sampler] += 1
+            task_id = task_ids[(message.circuit, message.decoder)]
+            stats = sinter.TaskStats(
+                strong_id=task_id,
+                decoder=message.decoder,
+                json_metadata=totals[task_id].json_metadata,
+                shots=message.shots,
+                errors=message.errors,
+                discards=0,
+                seconds=message.seconds,
+            )
+            totals[task_id] += stats
+            if on_stats is not None:
+                on_stats(stats)
+            batch_limits[message.circuit] = _next_batch_shots(
+                [totals[task_ids[(message.circuit, decoder)]] for decoder in decoders],
+                max_errors=max_errors,
+                batch_shots=circuits[message.circuit].batch_shots,
+                batches_in_flight=slots_per_sampler,
+            )
+        for _ in range(num_decoder_workers):
+            batches.put(None)
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for ring in rings:
+            ring.close()
+            ring.unlink()
+    return totals
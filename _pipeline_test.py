@@ -0,0 +1,101 @@
+import functools
+import multiprocessing
+import pathlib
+
+import pytest
+import sinter
+import stim
+from sinter.decoding import DECODER_METHODS
+
+from _decoders import decode_using_cached_pymatching
+from _dem_cache import DemCache
+from _pipeline import collect_pipelined
+from main import make_noisy_heavy_hex_circuit
+
+
+def _write_circuits(directory: pathlib.Path):
+    paths = []
+    for d, p in [(3, 0.01), (5, 0.002)]:
+        circuit = make_noisy_heavy_hex_circuit(diam=d, time_boundary_basis='Z', rounds=3, noise=p, gate_set='cx')
+        path = directory / f'b=Z,d={d},g=cx,p={p},r=3.stim'
+        circuit.to_file(path)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_collect_pipelined_reports_sinter_stats_within_budget(tmp_path: pathlib.Path,
+                                                              monkeypatch: pytest.MonkeyPatch,
+                                                              start_method: str):
+    if start_method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"{start_method} isn't available on this platform.")
+    monkeypatch.setattr(multiprocessing, 'get_context', functools.partial(multiprocessing.get_context, start_method))
+    # Decodes through b8 files, like decoders from outside this repository. It's only registered in
+    # this process, so spawned workers must be handed it.
+    monkeypatch.setitem(DECODER_METHODS, 'pymatching_via_files', decode_using_cached_pymatching)
+    paths = _write_circuits(tmp_path)
+    seen = []
+    totals = collect_pipelined(
+        circuit_paths=paths,
+        decoders=['pymatching_cached', 'pymatching_via_files'],
+        max_shots=3000,
+        max_errors=10**9,
+        num_samplers=1,
+        num_decoder_workers=2,
+        dem_cache_dir=tmp_path / 'dem_cache',
+        slots_per_sampler=2,
+        max_batch_shots=500,
+        seed=5,
+        on_stats=seen.append,
+    )
+
+    # The strong ids are the ones `sinter collect` gives the same tasks, so the stats can be merged.
+    dem_cache = DemCache(tmp_path / 'dem_cache')
+    expected_ids = set()
+    for path in paths:
+        circuit = stim.Circuit.from_file(path)
+        for decoder in ['pymatching_cached', 'pymatching_via_files']:
+            expected_ids.add(sinter.Task(
+                circuit=circuit,
+                decoder=decoder,
+                detector_error_model=dem_cache.detector_error_model(circuit),
+                json_metadata=sinter.comma_separated_key_values(str(path)),
+            ).strong_id())
+    assert set(totals) == expected_ids
+    for stats in totals.values():
+        assert stats.shots == 3000
+        assert 0 < stats.errors < stats.shots
+        assert sum(e.shots for e in seen if e.strong_id == stats.strong_id) == 3000
+    # Both decoders are the same, and decode the same shots.
+    by_metadata = sinter.group_by(totals.values(), key=lambda e: e.json_metadata['d'])
+    for group in by_metadata.values():
+        assert len({e.errors for e in group}) == 1
+
+
+def test_collect_pipelined_counts_existing_stats_and_stops_at_max_errors(tmp_path: pathlib.Path):
+    paths = _write_circuits(tmp_path)[:1]
+    first = collect_pipelined(
+        circuit_paths=paths,
+        decoders=['pymatching_cached'],
+        max_shots=10**9,
+        max_errors=20,
+        num_samplers=1,
+        num_decoder_workers=1,
+        dem_cache_dir=tmp_path / 'dem_cache',
+        max_batch_shots=100,
+    )
+    stats, = first.values()
+    # Batches already in flight when the budget is reached still count.
+    assert 20 <= stats.errors < 200
+
+    again = collect_pipelined(
+        circuit_paths=paths,
+        decoders=['pymatching_cached'],
+        max_shots=10**9,
+        max_errors=20,
+        num_samplers=1,
+        num_decoder_workers=1,
+        dem_cache_dir=tmp_path / 'dem_cache',
+        existing_stats=[stats],
+    )
+    assert again == first
@@ -0,0 +1,211 @@
+import collections
+import dataclasses
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import sinter
+
+from _stats import StatsTable
+
+
+@dataclasses.dataclass(frozen=True)
+class SweepPoint:
+    """The statistics collected so far for one decoder on one circuit of the sweep."""
+    b: str
+    g: str
+    decoder: str
+    d: int
+    p: float
+    r: int
+    shots: int = 0
+    errors: int = 0
+
+    @property
+    def key(self) -> Tuple[str, str, str, int, float, int]:
+        return self.b, self.g, self.decoder, self.d, self.p, self.r
+
+    @property
+    def cost_per_shot(self) -> float:
+        """Proportional to the number of detectors, which dominates sampling and decoding time."""
+        return self.d * self.d * self.r
+
+    def smoothed_shot_error_rate(self) -> float:
+        return (self.errors + 0.5) / (self.shots + 1)
+
+    def round_relative_error(self) -> float:
+        """The relative standard error of the logical error rate per round."""
+        if self.errors == 0:
+            return math.inf
+        rate = self.errors / self.shots
+        return round_elasticity(rate, rounds=self.r) * math.sqrt((1 - rate) / self.errors)
+
+    def errors_needed(self, target_relative_error: float) -> float:
+        """Estimates how many errors bring the per round relative error down to the target.
+
+        Infinite when the shot error rate is at least 1/2, since the per round rate is then unbounded.
+        """
+        rate = self.smoothed_shot_error_rate()
+        needed = round_elasticity(rate, rounds=self.r)**2 * (1 - rate) / target_relative_error**2
+        return math.ceil(needed) if math.isfinite(needed) else math.inf
+
+
+def round_elasticity(shot_error_rate: float, *, rounds: int) -> float:
+    """Returns d ln(per round error rate) / d ln(per shot error rate).
+
+    The relative error of the per shot rate is multiplied by this to get the relative error of the
+    per round rate. It's close to 1 for small rates and diverges as the shot rate approaches 1/2.
+    """
+    if shot_error_rate >= 0.5:
+        return math.inf
+    round_rate = sinter.shot_error_rate_to_piece_error_rate(shot_error_rate, pieces=rounds)
+    derivative = (1 - 2 * shot_error_rate)**(1 / rounds - 1) / rounds
+    return shot_error_rate * derivative / round_rate
+
+
+def sweep_points(tasks: Iterable[Dict[str, Any]],
+                 decoders: Iterable[str],
+                 table: Optional[StatsTable]) -> List[SweepPoint]:
+    """Combines the swept circuit parameters with the statistics collected for them so far.
+
+    Args:
+        tasks: The json metadata (d, p, b, g, r) of each circuit in the sweep.
+        decoders: The decoders each circuit is decoded with.
+        table: Statistics that have already been collected, or None if there are none yet.
+    """
+    totals = collections.defaultdict(lambda: [0, 0])
+    if table is not None:
+        for b, g, decoder, d, p, r, shots, discards, errors in zip(
+                table['b'], table['g'], table['decoder'], table['d'], table['p'], table['r'],
+                table['shots'], table['discards'], table['errors']):
+            total = totals[(str(b), str(g), str(decoder), int(d), float(p), int(r))]
+            total[0] += int(shots - discards)
+            total[1] += int(errors)
+    result = []
+    for metadata in tasks:
+        for decoder in decoders:
+            key = (metadata['b'], metadata['g'], decoder, metadata['d'], metadata['p'], metadata['r'])
+            shots, errors = totals.get(key, (0, 0))
+            result.append(SweepPoint(*key, shots=shots, errors=errors))
+    return result
+
+
+def _fit_log_line(xs: np.ndarray, points: List[SweepPoint]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Weighted least squares fit of ln(shot error rate) = offset + slope * x.
+
+    Each point is weighted by its Fisher information about ln(rate), shots * rate / (1 - rate).
+
+    Returns:
+        The (offset, slope) coefficients and their covariance matrix, or None if the points can't
+        constrain a line.
+    """
+    rates = np.array([e.smoothed_shot_error_rate() for e in points])
+    weights = np.array([e.shots for e in points]) * rates / (1 - rates)
+    if np.count_nonzero(weights) < 2 or len(set(xs[weights > 0])) < 2:
+        return None
+    design = np.stack([np.ones_like(xs), xs], axis=1)
+    information = design.T @ (weights[:, None] * design)
+    covariance = np.linalg.inv(information)
+    coefficients = covariance @ (design.T @ (weights * np.log(rates)))
+    return coefficients, covariance
+
+
+def fit_gains(points: List[SweepPoint]) -> Dict[Tuple, float]:
+    """Estimates how much one more shot of each point tightens the fits made by fit_lines.py.
+
+    The fit quantities are the slope of every line (over d at fixed p, and over -ln(p) at fixed d)
+    and the threshold crossing of the p-axis lines of consecutive diameters. For each one, the
+    delta method gives the reduction in its variance from adding a shot to a point. Reductions
+    are divided by the current variance, so that each fit quantity counts equally, and summed.
+
+    Returns:
+        A dictionary from point key to the summed relative variance reduction per shot.
+    """
+    gains = collections.defaultdict(float)
+
+    def add_gains(group: List[SweepPoint], xs: np.ndarray, covariance: np.ndarray, gradient: np.ndarray, variance: float):
+        if variance <= 0:
+            return
+        for e, x in zip(group, xs):
+            rate = e.smoothed_shot_error_rate()
+            sensitivity = float(gradient @ covariance @ np.array([1, x]))
+            gains[e.key] += sensitivity**2 * rate / (1 - rate) / variance
+
+    for _, family in sinter.group_by(points, key=lambda e: (e.b, e.g, e.decoder)).items():
+        for _, group in sinter.group_by(family, key=lambda e: e.p).items():
+            xs = np.array([e.d for e in group], dtype=np.float64)
+            fit = _fit_log_line(xs, group)
+            if fit is not None:
+                add_gains(group, xs, fit[1], np.array([0.0, 1.0]), float(fit[1][1, 1]))
+
+        p_lines = []
+        for _, group in sorted(sinter.group_by(family, key=lambda e: e.d).items()):
+            xs = np.array([-math.log(e.p) for e in group])
+            fit = _fit_log_line(xs, group)
+            if fit is not None:
+                add_gains(group, xs, fit[1], np.array([0.0, 1.0]), float(fit[1][1, 1]))
+                p_lines.append((group, xs, fit))
+        for (group1, xs1, (c1, cov1)), (group2, xs2, (c2, cov2)) in zip(p_lines, p_lines[1:]):
+            slope_gap = c1[1] - c2[1]
+            if slope_gap == 0:
+                continue
+            crossing = (c2[0] - c1[0]) / slope_gap
+            gradient1 = np.array([-1, -crossing]) / slope_gap
+            gradient2 = np.array([1, crossing]) / slope_gap
+            variance = float(gradient1 @ cov1 @ gradient1 + gradient2 @ cov2 @ gradient2)
+            add_gains(group1, xs1, cov1, gradient1, variance)
+            add_gains(group2, xs2, cov2, gradient2, variance)
+
+    return dict(gains)
+
+
+@dataclasses.dataclass(frozen=True)
+class Allocation:
+    """Total budgets (including already collected statistics) to give a point's sinter task."""
+    max_shots: int
+    max_errors: int
+
+
+def plan_round(points: List[SweepPoint],
+               *,
+               target_relative_error: float,
+               round_shots: int,
+               max_shots: int,
+               max_errors: int,
+               min_shots: int = 1000) -> Dict[Tuple, Allocation]:
+    """Decides how many more shots each point gets in the next round of collection.
+
+    Points that have reached the target relative error (on their per round error rate), or
+    exhausted their budget, aren't scheduled. The others split `round_shots` in proportion to how
+    much a shot of theirs tightens the fits per unit of cost (see `fit_gains`), with every point
+    getting at least `min_shots` and no point getting more than it's expected to need. Each
+    point's error budget is the number of errors expected to reach the target, so sinter stops
+    it as soon as it does.
+
+    Returns:
+        A dictionary from point key to allocation, containing only the scheduled points. Empty
+        when collection is done.
+    """
+    pending = [
+        e
+        for e in points
+        if e.round_relative_error() > target_relative_error and e.shots < max_shots and e.errors < max_errors
+    ]
+    if not pending:
+        return {}
+    gains = fit_gains(points)
+    # Points without shots have no rate estimate yet; they only get `min_shots`, to get one.
+    priorities = np.array([gains.get(e.key, 0) / e.cost_per_shot if e.shots else 0 for e in pending])
+    if priorities.sum() > 0:
+        shares = round_shots * priorities / priorities.sum()
+    else:
+        shares = np.full(len(pending), round_shots / len(pending))
+    shares[[not e.shots for e in pending]] = 0
+
+    result = {}
+    for e, share in zip(pending, shares):
+        errors_needed = int(min(e.errors_needed(target_relative_error), max_errors))
+        shots_needed = math.ceil(max(errors_needed - e.errors, 1) / e.smoothed_shot_error_rate())
+        extra = max(min_shots, min(int(share), shots_needed))
+        result[e.key] = Allocation(max_shots=min(e.shots + extra, max_shots), max_errors=errors_needed)
+    return result
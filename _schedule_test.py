@@ -0,0 +1,56 @@
+import math
+
+import pytest
+
+from _schedule import SweepPoint, fit_gains, plan_round, round_elasticity, sweep_points
+
+
+def _point(d: int, p: float, shots: int, errors: int, **kwargs) -> SweepPoint:
+    return SweepPoint(**{'b': 'Z', 'g': 'cx', 'decoder': 'pymatching', 'd': d, 'p': p, 'r': 3 * d, 'shots': shots, 'errors': errors, **kwargs})
+
+
+def test_round_relative_error_and_errors_needed():
+    assert round_elasticity(1e-6, rounds=10) == pytest.approx(1, rel=1e-4)
+    assert round_elasticity(0.3, rounds=10) > 1
+    assert round_elasticity(0.5, rounds=10) == math.inf
+
+    point = _point(5, 1e-3, shots=1_000_000, errors=100)
+    assert point.round_relative_error() == pytest.approx(0.1, rel=1e-2)
+    assert point.errors_needed(0.1) == pytest.approx(100, abs=2)
+    assert point.errors_needed(0.05) == pytest.approx(400, abs=5)
+    assert _point(5, 1e-3, shots=100, errors=0).round_relative_error() == math.inf
+    assert _point(5, 1e-3, shots=100, errors=60).errors_needed(0.1) == math.inf
+
+
+def test_sweep_points_include_uncollected_points():
+    sweep = [dict(b='Z', g='cx', d=3, p=0.001, r=9), dict(b='Z', g='cx', d=5, p=0.001, r=15)]
+    points = sweep_points(sweep, ['a', 'b'], None)
+    assert [(e.d, e.decoder, e.shots) for e in points] == [(3, 'a', 0), (3, 'b', 0), (5, 'a', 0), (5, 'b', 0)]
+
+
+def test_fit_gains_favor_points_with_leverage():
+    points = [_point(d, 1e-3, shots=100_000, errors=100) for d in [3, 5, 7]]
+    gains = fit_gains(points)
+    assert gains[points[2].key] > gains[points[1].key]
+    assert gains[points[0].key] > gains[points[1].key]
+
+
+def test_plan_round_stops_points_at_target_precision():
+    done = _point(3, 1e-3, shots=1_000_000, errors=500)
+    imprecise = _point(5, 1e-3, shots=100_000, errors=10)
+    capped = _point(7, 1e-3, shots=10_000_000, errors=20)
+    fresh = _point(9, 1e-3, shots=0, errors=0)
+    plan = plan_round(
+        [done, imprecise, capped, fresh],
+        target_relative_error=0.1,
+        round_shots=10_000_000,
+        max_shots=10_000_000,
+        max_errors=1000,
+    )
+    assert set(plan) == {imprecise.key, fresh.key}
+
+    # The imprecise point needs ~90 more errors at a rate of ~1e-4, and isn't given much more than that.
+    allocation = plan[imprecise.key]
+    assert allocation.max_errors == pytest.approx(100, abs=2)
+    assert 500_000 < allocation.max_shots - imprecise.shots < 1_500_000
+    assert plan[fresh.key].max_shots >= 1000
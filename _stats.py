@@ -0,0 +1,213 @@
+import csv
+import dataclasses
+import hashlib
+import io
+import json
+import pathlib
+from typing import List, Union, Dict, Optional, Any
+
+import numpy as np
+import sinter
+
+# Metadata keys that get their own typed column, and the value used when a row lacks the key.
+METADATA_COLUMNS = {
+    'd': (np.int64, -1),
+    'p': (np.float64, np.nan),
+    'b': (np.str_, ''),
+    'g': (np.str_, ''),
+    'r': (np.int64, -1),
+}
+# Rows are kept sorted by these columns, so that related tasks are stored next to each other.
+INDEX_COLUMNS = ('b', 'g', 'decoder', 'd', 'p', 'r')
+# How much of the start of the csv file is hashed to detect that it was rewritten instead of appended to.
+_HEAD_BYTES = 4096
+_STORE_VERSION = 1
+
+
+def read_stats(path: Union[str, pathlib.Path]) -> List[sinter.TaskStats]:
+    """Reads sampling statistics, combining rows that have the same strong id."""
+    return sinter.stats_from_csv_files(path)
+
+
+@dataclasses.dataclass
+class StatsTable:
+    """Sampling statistics aggregated per strong id, stored column by column.
+
+    The metadata keys listed in METADATA_COLUMNS are expanded into typed columns, and rows are
+    sorted by INDEX_COLUMNS.
+    """
+    columns: Dict[str, np.ndarray]
+    source_bytes: int = 0
+    source_head_hash: str = ''
+
+    def __len__(self) -> int:
+        return len(self.columns['strong_id'])
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.columns[key]
+
+    def mask(self, **conditions: Any) -> np.ndarray:
+        """Returns a boolean mask of the rows whose columns equal the given values."""
+        result = np.ones(len(self), dtype=np.bool_)
+        for key, value in conditions.items():
+            result &= self.columns[key] == value
+        return result
+
+    def select(self, **conditions: Any) -> 'StatsTable':
+        """Returns the rows whose columns equal the given values."""
+        keep = self.mask(**conditions)
+        return StatsTable(columns={k: v[keep] for k, v in self.columns.items()})
+
+    def task_stats(self) -> List[sinter.TaskStats]:
+        c = self.columns
+        return [
+            sinter.TaskStats(
+                strong_id=str(c['strong_id'][k]),
+                decoder=str(c['decoder'][k]),
+                json_metadata=json.loads(c['json_metadata'][k]),
+                shots=int(c['shots'][k]),
+                errors=int(c['errors'][k]),
+                discards=int(c['discards'][k]),
+                seconds=float(c['seconds'][k]),
+            )
+            for k in range(len(self))
+        ]
+
+    def save(self, path: Union[str, pathlib.Path]) -> None:
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     _version=np.int64(_STORE_VERSION),
+                     _source_bytes=np.int64(self.source_bytes),
+                     _source_head_hash=np.str_(self.source_head_hash),
+                     **self.columns)
+
+    @staticmethod
+    def load(path: Union[str, pathlib.Path]) -> Optional['StatsTable']:
+        """Loads a saved table, or returns None if it was saved by an incompatible version."""
+        with np.load(path, allow_pickle=False) as data:
+            if '_version' not in data.files or int(data['_version']) != _STORE_VERSION:
+                return None
+            return StatsTable(
+                columns={k: data[k] for k in data.files if not k.startswith('_')},
+                source_bytes=int(data['_source_bytes']),
+                source_head_hash=str(data['_source_head_hash']),
+            )
+
+
+def _empty_columns() -> Dict[str, np.ndarray]:
+    columns = {
+        'strong_id': np.array([], dtype=np.str_),
+        'decoder': np.array([], dtype=np.str_),
+        'json_metadata': np.array([], dtype=np.str_),
+        'shots': np.array([], dtype=np.int64),
+        'errors': np.array([], dtype=np.int64),
+        'discards': np.array([], dtype=np.int64),
+        'seconds': np.array([], dtype=np.float64),
+    }
+    for key, (dtype, _) in METADATA_COLUMNS.items():
+        columns[key] = np.array([], dtype=dtype)
+    return columns
+
+
+def _parse_csv_rows(text: str) -> Dict[str, np.ndarray]:
+    """Parses csv rows (without the header) written by sinter into columns."""
+    strong_ids, decoders, metadata_texts = [], [], []
+    shots, errors, discards, seconds = [], [], [], []
+    metadata_values = {key: [] for key in METADATA_COLUMNS}
+    for row in csv.reader(io.StringIO(text)):
+        if not row:
+            continue
+        shots.append(int(row[0]))
+        errors.append(int(row[1]))
+        discards.append(int(row[2]))
+        seconds.append(float(row[3]))
+        decoders.append(row[4].strip())
+        strong_ids.append(row[5].strip())
+        metadata_text = row[6].strip()
+        metadata_texts.append(metadata_text)
+        metadata = json.loads(metadata_text)
+        if not isinstance(metadata, dict):
+            metadata = {}
+        for key, (_, default) in METADATA_COLUMNS.items():
+            metadata_values[key].append(metadata.get(key, default))
+    if not strong_ids:
+        return _empty_columns()
+    columns = {
+        'strong_id': np.array(strong_ids, dtype=np.str_),
+        'decoder': np.array(decoders, dtype=np.str_),
+        'json_metadata': np.array(metadata_texts, dtype=np.str_),
+        'shots': np.array(shots, dtype=np.int64),
+        'errors': np.array(errors, dtype=np.int64),
+        'discards': np.array(discards, dtype=np.int64),
+        'seconds': np.array(seconds, dtype=np.float64),
+    }
+    for key, (dtype, _) in METADATA_COLUMNS.items():
+        columns[key] = np.array(metadata_values[key], dtype=dtype)
+    return columns
+
+
+def _aggregate(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Sums the counts of rows with the same strong id, and sorts the result by the index columns."""
+    ids, first, inverse = np.unique(columns['strong_id'], return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    result = {key: values[first] for key, values in columns.items()}
+    for key in ('shots', 'errors', 'discards', 'seconds'):
+        total = np.zeros(len(ids), dtype=columns[key].dtype)
+        np.add.at(total, inverse, columns[key])
+        result[key] = total
+    order = np.lexsort([result[key] for key in reversed(INDEX_COLUMNS)])
+    return {key: values[order] for key, values in result.items()}
+
+
+def _head_hash(path: pathlib.Path, num_bytes: int) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read(min(num_bytes, _HEAD_BYTES))).hexdigest()
+
+
+def load_stats(csv_path: Union[str, pathlib.Path],
+               *,
+               store_path: Optional[Union[str, pathlib.Path]] = None) -> StatsTable:
+    """Returns the aggregated statistics of a sinter csv file, updating its columnar store.
+
+    The store remembers how much of the csv file it has absorbed. Rows appended to the csv file
+    since the last update are parsed and merged in. If the csv file was rewritten (it shrank, or its
+    start changed) the store is rebuilt from scratch.
+
+    Args:
+        csv_path: The csv file written by sinter (e.g. out/stats.csv).
+        store_path: Where the store is kept. Defaults to the csv path with an .npz extension.
+
+    Returns:
+        The aggregated table.
+    """
+    csv_path = pathlib.Path(csv_path)
+    store_path = csv_path.with_suffix('.npz') if store_path is None else pathlib.Path(store_path)
+    size = csv_path.stat().st_size
+
+    table = None
+    if store_path.exists():
+        table = StatsTable.load(store_path)
+    if table is not None and (table.source_bytes > size
+                              or _head_hash(csv_path, table.source_bytes) != table.source_head_hash):
+        table = None
+    if table is not None and table.source_bytes == size:
+        return table
+
+    with open(csv_path, 'rb') as f:
+        if table is None:
+            table = StatsTable(columns=_empty_columns())
+            f.readline()  # header
+        else:
+            f.seek(table.source_bytes)
+        new_bytes = f.read()
+    # Leave an incomplete trailing line (from a writer that is mid-flush) for the next update.
+    complete = new_bytes[:new_bytes.rfind(b'\n') + 1]
+    new_columns = _parse_csv_rows(complete.decode('utf8'))
+    merged = {key: np.concatenate([table.columns[key], new_columns[key]]) for key in table.columns}
+    table = StatsTable(
+        columns=_aggregate(merged),
+        source_bytes=size - (len(new_bytes) - len(complete)),
+    )
+    table.source_head_hash = _head_hash(csv_path, table.source_bytes)
+    table.save(store_path)
+    return table
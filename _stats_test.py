@@ -0,0 +1,32 @@
+import pathlib
+
+import numpy as np
+
+from _stats import load_stats, read_stats
+
+HEADER = '     shots,    errors,  discards, seconds,decoder,strong_id,json_metadata\n'
+
+
+def _row(shots: int, errors: int, strong_id: str, d: int, p: float) -> str:
+    return f'{shots},{errors},0,1.5,pymatching,{strong_id},"{{""b"":""X"",""d"":{d},""g"":""cx"",""p"":{p},""r"":{3 * d}}}"\n'
+
+
+def test_load_stats_absorbs_appended_rows(tmp_path: pathlib.Path):
+    csv_path = tmp_path / 'stats.csv'
+    csv_path.write_text(HEADER + _row(100, 5, 'aaa', 5, 0.001) + _row(200, 1, 'bbb', 3, 0.001))
+    table = load_stats(csv_path)
+    assert (tmp_path / 'stats.npz').exists()
+    np.testing.assert_array_equal(table['d'], [3, 5])
+    np.testing.assert_array_equal(table['shots'], [200, 100])
+
+    with open(csv_path, 'a') as f:
+        f.write(_row(50, 2, 'aaa', 5, 0.001) + _row(10, 0, 'ccc', 3, 0.002))
+    table = load_stats(csv_path)
+    assert sorted(table.task_stats(), key=lambda e: e.strong_id) == read_stats(csv_path)
+    assert table.select(d=5)['shots'].tolist() == [150]
+    assert table.select(d=5)['errors'].tolist() == [7]
+    assert table.select(p=0.002)['strong_id'].tolist() == ['ccc']
+
+    # Rewriting the file from scratch invalidates the store.
+    csv_path.write_text(HEADER + _row(7, 7, 'ddd', 3, 0.001))
+    assert load_stats(csv_path)['strong_id'].tolist() == ['ddd']
@@ -0,0 +1,221 @@
+import dataclasses
+import hashlib
+import json
+import math
+import os
+import pathlib
+import tempfile
+import time
+from typing import Any, Optional, Union
+
+import numpy as np
+import sinter
+import stim
+from sinter.decoding import DECODER_METHODS
+
+from _dem_cache import DEM_OPTIONS
+from _trace import span
+
+# Shots are sampled (and appended to the store) this many at a time, to bound memory use.
+_SAMPLE_BATCH_SIZE = 100_000
+
+
+def circuit_hash(circuit: stim.Circuit) -> str:
+    return hashlib.sha256(str(circuit).encode('utf8')).hexdigest()
+
+
+@dataclasses.dataclass
+class SyndromeStore:
+    """Detection events and observable flips sampled once from a circuit, for decoding many times.
+
+    Shots are stored bit packed in stim's 'b8' format (one row of ceil(n / 8) little endian bytes
+    per shot), in `dets.b8` and `obs.b8` files of the store's directory. These files can be memory
+    mapped, or handed directly to the decoders in `sinter.decoding.DECODER_METHODS`.
+    """
+    directory: pathlib.Path
+    num_shots: int
+    num_dets: int
+    num_obs: int
+    circuit_hash: str
+
+    @property
+    def dets_path(self) -> pathlib.Path:
+        return self.directory / 'dets.b8'
+
+    @property
+    def obs_path(self) -> pathlib.Path:
+        return self.directory / 'obs.b8'
+
+    @property
+    def meta_path(self) -> pathlib.Path:
+        return self.directory / 'meta.json'
+
+    def dets(self) -> np.ndarray:
+        """Returns a read-only memory map of the bit packed detection events, shaped (shots, bytes)."""
+        return _memmap(self.dets_path, self.num_shots, self.num_dets)
+
+    def obs(self) -> np.ndarray:
+        """Returns a read-only memory map of the bit packed observable flips, shaped (shots, bytes)."""
+        return _memmap(self.obs_path, self.num_shots, self.num_obs)
+
+    @staticmethod
+    def open(directory: Union[str, pathlib.Path]) -> Optional['SyndromeStore']:
+        """Opens an existing store, or returns None if the directory doesn't contain one."""
+        directory = pathlib.Path(directory)
+        try:
+            with open(directory / 'meta.json') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        return SyndromeStore(
+            directory=directory,
+            num_shots=meta['num_shots'],
+            num_dets=meta['num_dets'],
+            num_obs=meta['num_obs'],
+            circuit_hash=meta['circuit_hash'],
+        )
+
+    def _write_meta(self) -> None:
+        tmp_path = self.meta_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'num_shots': self.num_shots,
+                'num_dets': self.num_dets,
+                'num_obs': self.num_obs,
+                'circuit_hash': self.circuit_hash,
+            }, f)
+        os.replace(tmp_path, self.meta_path)
+
+
+def _memmap(path: pathlib.Path, num_shots: int, num_bits: int) -> np.ndarray:
+    shape = (num_shots, math.ceil(num_bits / 8))
+    if num_shots == 0 or shape[1] == 0:
+        return np.zeros(shape, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r', shape=shape)
+
+
+def sample_syndromes(circuit: stim.Circuit,
+                     directory: Union[str, pathlib.Path],
+                     *,
+                     num_shots: int,
+                     seed: Optional[int] = None) -> SyndromeStore:
+    """Makes sure a store holds at least the given number of shots sampled from a circuit.
+
+    Shots already in the store are kept, and only the missing ones are sampled and appended. A
+    store sampled from a different circuit is discarded and resampled.
+
+    Args:
+        circuit: The noisy circuit to sample.
+        directory: The store's directory (e.g. out/syndromes/<circuit name>).
+        num_shots: The minimum number of shots the store should hold afterwards.
+        seed: Seeds the sampler. Each appended batch derives its own seed from this one.
+
+    Returns:
+        The store.
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    key = circuit_hash(circuit)
+    store = SyndromeStore.open(directory)
+    if store is None or store.circuit_hash != key:
+        store = SyndromeStore(
+            directory=directory,
+            num_shots=0,
+            num_dets=circuit.num_detectors,
+            num_obs=circuit.num_observables,
+            circuit_hash=key,
+        )
+        for path in [store.meta_path, store.dets_path, store.obs_path]:
+            path.unlink(missing_ok=True)
+        store.dets_path.touch()
+        store.obs_path.touch()
+    else:
+        # Drop any partial batch left behind by an interrupted run.
+        for path, num_bits in [(store.dets_path, store.num_dets), (store.obs_path, store.num_obs)]:
+            os.truncate(path, store.num_shots * math.ceil(num_bits / 8))
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        while store.num_shots < num_shots:
+            batch = min(num_shots - store.num_shots, _SAMPLE_BATCH_SIZE)
+            batch_seed = None if seed is None else seed + store.num_shots
+            dets_tmp = pathlib.Path(tmp_dir) / 'dets.b8'
+            obs_tmp = pathlib.Path(tmp_dir) / 'obs.b8'
+            with span('sample', shots=batch):
+                sampler = circuit.compile_detector_sampler(seed=batch_seed)
+                sampler.sample_write(
+                    batch,
+                    filepath=str(dets_tmp),
+                    format='b8',
+                    obs_out_filepath=str(obs_tmp),
+                    obs_out_format='b8',
+                )
+            for src, dst in [(dets_tmp, store.dets_path), (obs_tmp, store.obs_path)]:
+                with open(src, 'rb') as f_in, open(dst, 'ab') as f_out:
+                    f_out.write(f_in.read())
+            store.num_shots += batch
+            store._write_meta()
+    if not store.meta_path.exists():
+        store._write_meta()
+    return store
+
+
+def decode_syndromes(store: SyndromeStore,
+                     *,
+                     circuit: stim.Circuit,
+                     decoder: str,
+                     json_metadata: Any = None,
+                     detector_error_model: Optional[stim.DetectorErrorModel] = None) -> sinter.TaskStats:
+    """Decodes every shot in a store, and counts how often the decoder mispredicts the observables.
+
+    Args:
+        store: The shots to decode. Must have been sampled from the given circuit.
+        circuit: The circuit the shots were sampled from.
+        decoder: A key of `sinter.decoding.DECODER_METHODS`.
+        json_metadata: Metadata attached to the returned statistics.
+        detector_error_model: The error model given to the decoder. Defaults to deriving it from the
+            circuit the way `sinter collect` does.
+
+    Returns:
+        The statistics, with the same strong id `sinter collect` would give the task. The recorded
+        seconds only cover decoding, since sampling was paid for when the store was filled.
+    """
+    if store.circuit_hash != circuit_hash(circuit):
+        raise ValueError(f"The store at {store.directory} wasn't sampled from the given circuit.")
+    decode_method = DECODER_METHODS.get(decoder)
+    if decode_method is None:
+        raise NotImplementedError(f"Unrecognized decoder: {decoder!r}")
+    if detector_error_model is None:
+        detector_error_model = circuit.detector_error_model(**DEM_OPTIONS)
+    task = sinter.Task(
+        circuit=circuit,
+        decoder=decoder,
+        detector_error_model=detector_error_model,
+        json_metadata=json_metadata,
+    )
+
+    start_time = time.monotonic()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        predictions_path = pathlib.Path(tmp_dir) / 'predictions.b8'
+        with span('decode', decoder=decoder, num_detectors=store.num_dets, shots=store.num_shots):
+            decode_method(
+                num_shots=store.num_shots,
+                num_dets=store.num_dets,
+                num_obs=store.num_obs,
+                error_model=detector_error_model,
+                dets_b8_in_path=store.dets_path,
+                obs_predictions_b8_out_path=predictions_path,
+                tmp_dir=pathlib.Path(tmp_dir),
+            )
+        predictions = _memmap(predictions_path, store.num_shots, store.num_obs)
+        errors = int(np.count_nonzero(np.any(predictions != store.obs(), axis=1)))
+        del predictions
+
+    return sinter.TaskStats(
+        strong_id=task.strong_id(),
+        decoder=decoder,
+        json_metadata=json_metadata,
+        shots=store.num_shots,
+        errors=errors,
+        discards=0,
+        seconds=time.monotonic() - start_time,
+    )
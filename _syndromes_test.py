@@ -0,0 +1,39 @@
+import math
+import pathlib
+
+import numpy as np
+import pytest
+from sinter.decoding import DECODER_METHODS
+
+from _syndromes import SyndromeStore, decode_syndromes, sample_syndromes
+from main import make_noisy_heavy_hex_circuit
+
+
+def _predict_no_flips(*, num_shots, num_obs, obs_predictions_b8_out_path, **kwargs):
+    np.zeros((num_shots, math.ceil(num_obs / 8)), dtype=np.uint8).tofile(obs_predictions_b8_out_path)
+
+
+def test_sample_syndromes_appends_and_decodes_same_shots(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=3,
+        time_boundary_basis='Z',
+        rounds=3,
+        noise=1e-2,
+        gate_set='cx',
+    )
+    store = sample_syndromes(circuit, tmp_path / 'store', num_shots=300, seed=5)
+    first_dets = np.array(store.dets())
+    assert first_dets.shape == (300, math.ceil(circuit.num_detectors / 8))
+    assert np.any(first_dets)
+
+    store = sample_syndromes(circuit, tmp_path / 'store', num_shots=500, seed=5)
+    reopened = SyndromeStore.open(tmp_path / 'store')
+    assert reopened == store
+    assert reopened.num_shots == 500
+    np.testing.assert_array_equal(reopened.dets()[:300], first_dets)
+
+    monkeypatch.setitem(DECODER_METHODS, 'no_flips', _predict_no_flips)
+    stats = decode_syndromes(store, circuit=circuit, decoder='no_flips', json_metadata={'d': 3})
+    assert stats.shots == 500
+    assert stats.errors == np.count_nonzero(np.any(store.obs(), axis=1))
+    assert stats.errors > 0
@@ -0,0 +1,272 @@
+import collections
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import stim
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where spans are recorded without memory samples.
+    resource = None
+
+# Every process (including sinter's and the pipeline's workers) appends its spans to the trace
+# file named by this environment variable, if it's set.
+_TRACE_PATH_ENV = 'HEAVY_HEX_TRACE'
+# The json metadata keys of a sweep point (see main.py's circuit file names).
+SWEEP_KEYS = ('d', 'p', 'b', 'g', 'r')
+
+# How many error models each process remembers the labels of (see `model_labels`).
+_MAX_LABELLED_MODELS = 16
+
+_labels: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar('trace_labels', default={})
+_model_labels: List[Tuple[stim.DetectorErrorModel, Dict[str, Any]]] = []
+
+
+def enable_tracing(path: Union[str, pathlib.Path]) -> None:
+    """Makes this process, and processes it starts afterwards, append their spans to a trace file.
+
+    The file is in the Chrome trace event format (a json array whose closing bracket is left off,
+    so that it can be appended to), and can be opened in chrome://tracing or ui.perfetto.dev.
+    """
+    os.environ[_TRACE_PATH_ENV] = str(path)
+
+
+def _create_trace_file(path: str) -> None:
+    """Creates a trace file holding just the opening bracket of its json array, unless it exists.
+
+    The file only appears once its bracket is written (a filled in temporary file is linked into
+    place), so workers racing to record their first span can't write zero or several brackets.
+    """
+    if os.path.exists(path):
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.trace_')
+    try:
+        os.write(fd, b'[\n')
+        os.close(fd)
+        os.chmod(tmp_path, 0o644)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+
+
+def _append(events: List[Dict[str, Any]]) -> None:
+    path = os.environ.get(_TRACE_PATH_ENV)
+    _create_trace_file(path)
+    data = ''.join(json.dumps(event) + ',\n' for event in events).encode('utf8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        # A single append of a few hundred bytes doesn't interleave with other processes' appends.
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def _peak_memory_mb() -> Optional[float]:
+    """The process's peak resident memory so far, or None where it can't be measured."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _memory_mb() -> Dict[str, float]:
+    """The process's current and peak resident memory (whichever can be measured)."""
+    result = {}
+    peak = _peak_memory_mb()
+    if peak is not None:
+        result['peak_rss_mb'] = peak
+    try:
+        with open('/proc/self/statm') as f:
+            result['rss_mb'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (FileNotFoundError, ValueError, OSError):
+        pass
+    return result
+
+
+@contextlib.contextmanager
+def labels(**kwargs: Any):
+    """Attaches labels (e.g. a circuit's json metadata) to the spans recorded within the block."""
+    token = _labels.set({**_labels.get(), **kwargs})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **kwargs: Any):
+    """Records the wall time and memory use of a pipeline stage, when tracing is enabled.
+
+    The recorded event is labelled with the enclosing `labels` and the given keyword arguments.
+    Its memory samples are the resident memory at the end of the span, the process's peak so far,
+    and how much the span raised that peak. Does nothing when tracing isn't enabled.
+    """
+    if not os.environ.get(_TRACE_PATH_ENV):
+        yield
+        return
+    peak_before = _peak_memory_mb()
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        memory = _memory_mb()
+        pid = os.getpid()
+        tid = threading.get_native_id()
+        _append([
+            {
+                'name': name,
+                'cat': 'stage',
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': pid,
+                'tid': tid,
+                'args': {
+                    **_labels.get(),
+                    **kwargs,
+                    **memory,
+                    **({} if peak_before is None else {'peak_growth_mb': memory['peak_rss_mb'] - peak_before}),
+                },
+            },
+            {'name': 'memory', 'ph': 'C', 'ts': end * 1e6, 'pid': pid, 'args': memory},
+        ])
+
+
+def _model_labels_path() -> Optional[pathlib.Path]:
+    path = os.environ.get(_TRACE_PATH_ENV)
+    return pathlib.Path(path + '.labels') if path else None
+
+
+def _model_key(model: stim.DetectorErrorModel) -> str:
+    return hashlib.sha256(str(model).encode('utf8')).hexdigest()
+
+
+def record_model_labels(model: stim.DetectorErrorModel, **kwargs: Any) -> None:
+    """Notes the labels of a task's error model, for spans recorded where only the model is known.
+
+    Sinter's worker processes hand decoders the error model but not the task's metadata, so the
+    decoders' spans look their labels up by model (see `model_labels`). The labels are appended to
+    a file next to the trace. Does nothing when tracing isn't enabled.
+    """
+    path = _model_labels_path()
+    if path is None:
+        return
+    with open(path, 'a') as f:
+        print(json.dumps({'model': _model_key(model), 'labels': kwargs}), file=f)
+
+
+def model_labels(model: stim.DetectorErrorModel) -> Dict[str, Any]:
+    """Returns the labels recorded for an error model by `record_model_labels`, or {} if there are none.
+
+    Recently seen models are remembered (and compared by stim), so that each model is only hashed
+    once per process. Returns {} without doing anything when tracing isn't enabled.
+    """
+    path = _model_labels_path()
+    if path is None:
+        return {}
+    for k, (known, result) in enumerate(_model_labels):
+        if known.num_detectors == model.num_detectors and known == model:
+            _model_labels.append(_model_labels.pop(k))
+            return result
+    key = _model_key(model)
+    result = {}
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry['model'] == key:
+                        result = entry['labels']
+    _model_labels.append((model, result))
+    del _model_labels[:-_MAX_LABELLED_MODELS]
+    return result
+
+
+def read_trace(path: Union[str, pathlib.Path]) -> List[Dict[str, Any]]:
+    """Returns the spans (complete events) recorded in a trace file.
+
+    Every event is on a line of its own, so the file is read line by line. Bracket lines are
+    skipped wherever they are, so files whose array was closed (or opened twice) still read.
+    """
+    result = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line in ('', '[', ']'):
+                continue
+            event = json.loads(line)
+            if event.get('ph') == 'X':
+                result.append(event)
+    return result
+
+
+def _self_seconds(spans: List[Dict[str, Any]]) -> List[float]:
+    """Each span's duration minus that of the spans nested directly inside it (on the same thread)."""
+    result = [e['dur'] / 1e6 for e in spans]
+    by_thread = collections.defaultdict(list)
+    for k, e in enumerate(spans):
+        by_thread[(e['pid'], e['tid'])].append(k)
+    for indices in by_thread.values():
+        indices.sort(key=lambda k: (spans[k]['ts'], -spans[k]['dur']))
+        open_spans: List[int] = []
+        for k in indices:
+            start = spans[k]['ts']
+            while open_spans and spans[open_spans[-1]]['ts'] + spans[open_spans[-1]]['dur'] <= start:
+                open_spans.pop()
+            if open_spans:
+                result[open_spans[-1]] -= spans[k]['dur'] / 1e6
+            open_spans.append(k)
+    return result
+
+
+def summarize_trace(path: Union[str, pathlib.Path], *, top: Optional[int] = None) -> str:
+    """Ranks the stages, and the sweep points, of a trace by the time spent in them.
+
+    Stages are ranked by self time (excluding nested spans), so the stage times add up to the
+    traced time. Sweep points are the spans' d, p, b, g, r labels, and are ranked by their total
+    self time, with the stage they spent the most time in. Spans in parallel processes overlap,
+    so totals can exceed the wall time (which is reported separately).
+    """
+    spans = read_trace(path)
+    if not spans:
+        return 'no spans'
+    self_seconds = _self_seconds(spans)
+    wall = (max(e['ts'] + e['dur'] for e in spans) - min(e['ts'] for e in spans)) / 1e6
+
+    stages: Dict[str, List[float]] = collections.defaultdict(lambda: [0, 0, 0, 0])
+    points: Dict[tuple, Dict[str, float]] = collections.defaultdict(lambda: collections.defaultdict(float))
+    for e, seconds in zip(spans, self_seconds):
+        stage = stages[e['name']]
+        stage[0] += 1
+        stage[1] += e['dur'] / 1e6
+        stage[2] += seconds
+        stage[3] = max(stage[3], e['args'].get('peak_rss_mb', 0))
+        if all(key in e['args'] for key in SWEEP_KEYS):
+            points[tuple(e['args'][key] for key in SWEEP_KEYS)][e['name']] += seconds
+
+    lines = [f'wall_seconds={wall:.3f},traced_seconds={sum(self_seconds):.3f}', '']
+    lines.append('stage,spans,total_seconds,self_seconds,max_peak_rss_mb')
+    ranked_stages = sorted(stages.items(), key=lambda item: -item[1][2])
+    for name, (count, total, own, peak) in ranked_stages[:top]:
+        lines.append(f'{name},{count},{total:.3f},{own:.3f},{peak:.1f}')
+    if points:
+        lines.append('')
+        lines.append(','.join(SWEEP_KEYS) + ',self_seconds,top_stage,top_stage_seconds')
+        ranked_points = sorted(points.items(), key=lambda item: -sum(item[1].values()))
+        for key, per_stage in ranked_points[:top]:
+            top_stage = max(per_stage, key=per_stage.get)
+            lines.append(','.join(str(v) for v in key)
+                         + f',{sum(per_stage.values()):.3f},{top_stage},{per_stage[top_stage]:.3f}')
+    return '\n'.join(lines)
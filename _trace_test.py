@@ -0,0 +1,134 @@
+import json
+import math
+import multiprocessing
+import pathlib
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+import stim
+
+import _trace
+from _decoders import decode_using_cached_pymatching
+from _trace import enable_tracing, labels, model_labels, read_trace, record_model_labels, span, summarize_trace
+from main import make_noisy_heavy_hex_circuit
+
+
+def test_span_does_nothing_when_tracing_is_disabled(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delenv('HEAVY_HEX_TRACE', raising=False)
+    monkeypatch.chdir(tmp_path)
+    with span('stage'):
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spans_are_labelled_and_summarized(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    path = tmp_path / 'trace.json'
+    monkeypatch.setenv('HEAVY_HEX_TRACE', '')
+    enable_tracing(path)
+
+    with labels(d=3, p=0.001, b='Z', g='cx', r=9):
+        with span('outer', shots=5):
+            time.sleep(0.02)
+            with span('inner'):
+                time.sleep(0.05)
+    with labels(d=5, p=0.001, b='Z', g='cx', r=15):
+        with span('inner'):
+            time.sleep(0.01)
+
+    # The file is a Chrome trace (a json array missing its closing bracket).
+    events = json.loads(path.read_text().rstrip(',\n') + ']')
+    assert {e['ph'] for e in events} == {'X', 'C'}
+    spans = read_trace(path)
+    assert [e['name'] for e in spans] == ['inner', 'outer', 'inner']
+    assert spans[1]['args']['shots'] == 5
+    assert spans[0]['args']['d'] == 3
+    assert spans[2]['args']['d'] == 5
+    assert spans[0]['args']['peak_rss_mb'] > 0
+
+    lines = summarize_trace(path).splitlines()
+    # 'inner' has more self time than 'outer', whose time mostly went to the nested span.
+    stage_lines = lines[lines.index('stage,spans,total_seconds,self_seconds,max_peak_rss_mb') + 1:]
+    assert [line.split(',')[0] for line in stage_lines[:2]] == ['inner', 'outer']
+    outer = stage_lines[1].split(',')
+    assert float(outer[2]) >= 0.07
+    assert 0.015 <= float(outer[3]) < 0.05
+    point_lines = lines[lines.index('d,p,b,g,r,self_seconds,top_stage,top_stage_seconds') + 1:]
+    assert [line.split(',')[:5] for line in point_lines] == [['3', '0.001', 'Z', 'cx', '9'], ['5', '0.001', 'Z', 'cx', '15']]
+    assert point_lines[0].split(',')[6] == 'inner'
+
+
+def test_decoder_spans_are_labelled_by_their_model(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('HEAVY_HEX_TRACE', str(tmp_path / 'trace.json'))
+    circuit = make_noisy_heavy_hex_circuit(diam=3, time_boundary_basis='Z', rounds=3, noise=1e-3, gate_set='cx')
+    model = circuit.detector_error_model(decompose_errors=True)
+    other_model = make_noisy_heavy_hex_circuit(
+        diam=3, time_boundary_basis='Z', rounds=3, noise=2e-3, gate_set='cx').detector_error_model(decompose_errors=True)
+    record_model_labels(model, d=3, p=0.001, b='Z', g='cx', r=3)
+    assert model_labels(stim.DetectorErrorModel(str(model))) == {'d': 3, 'p': 0.001, 'b': 'Z', 'g': 'cx', 'r': 3}
+    assert model_labels(other_model) == {}
+
+    # Decode the way sinter's workers do, without any labels in scope.
+    dets = np.zeros((10, math.ceil(model.num_detectors / 8)), dtype=np.uint8)
+    dets.tofile(tmp_path / 'dets.b8')
+    decode_using_cached_pymatching(
+        num_shots=10,
+        num_dets=model.num_detectors,
+        num_obs=model.num_observables,
+        error_model=model,
+        dets_b8_in_path=tmp_path / 'dets.b8',
+        obs_predictions_b8_out_path=tmp_path / 'predictions.b8',
+        tmp_dir=tmp_path,
+    )
+    decode_span, = [e for e in read_trace(tmp_path / 'trace.json') if e['name'] == 'decode']
+    assert decode_span['args']['d'] == 3
+    assert decode_span['args']['decoder'] == 'pymatching_cached'
+
+
+def _record_first_span(barrier) -> None:
+    barrier.wait()
+    with span('first'):
+        pass
+
+
+def test_racing_first_spans_write_one_opening_bracket(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    path = tmp_path / 'trace.json'
+    monkeypatch.setenv('HEAVY_HEX_TRACE', str(path))
+    barrier = multiprocessing.Barrier(8)
+    processes = [multiprocessing.Process(target=_record_first_span, args=(barrier,)) for _ in range(8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    text = path.read_text()
+    assert text.startswith('[\n')
+    assert text.count('[\n') == 1
+    json.loads(text.rstrip(',\n') + ']')
+    assert len(read_trace(path)) == 8
+    assert [e.name for e in tmp_path.iterdir()] == ['trace.json']
+
+
+def test_read_trace_skips_stray_brackets(tmp_path: pathlib.Path):
+    path = tmp_path / 'trace.json'
+    event = json.dumps({'name': 'stage', 'ph': 'X', 'ts': 0, 'dur': 1, 'pid': 1, 'tid': 1, 'args': {}})
+    path.write_text(f'[\n[\n{event},\n[\n{event},\n]\n')
+    assert [e['name'] for e in read_trace(path)] == ['stage', 'stage']
+
+
+def test_tracing_works_without_the_resource_module(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    # Windows has no `resource` module, which mustn't stop circuits from being generated.
+    subprocess.run([sys.executable, '-c', "import sys; sys.modules['resource'] = None; import main"],
+                   check=True,
+                   cwd=pathlib.Path(__file__).parent)
+
+    monkeypatch.setattr(_trace, 'resource', None)
+    monkeypatch.setenv('HEAVY_HEX_TRACE', str(tmp_path / 'trace.json'))
+    with span('stage'):
+        pass
+    event, = read_trace(tmp_path / 'trace.json')
+    assert 'peak_rss_mb' not in event['args']
+    assert 'peak_growth_mb' not in event['args']
@@ -1,4 +1,9 @@
-from typing import List, Callable, Iterable, TypeVar, Any, Tuple, Dict
+from typing import List, Callable, Iterable, TypeVar, Any, Tuple, Dict, Optional
+
+import concurrent.futures
+import dataclasses
+import functools
+import os
 
 import numpy as np
 import stim
@@ -10,11 +15,50 @@ def complex_key(c: complex) -> Any:
     return c.real != int(c.real), c.real, c.imag
 
 
+def complex_int_key(c: complex) -> int:
+    """Encodes a point on the half-integer lattice as an int that sorts the same way as complex_key.
+
+    Raises:
+        ValueError: The point isn't on the half-integer lattice (or is absurdly far from the origin).
+    """
+    r = c.real * 2
+    i = c.imag * 2
+    ir = int(r)
+    ii = int(i)
+    if ir != r or ii != i or not (-2**31 <= ir < 2**31 and -2**31 <= ii < 2**31):
+        raise ValueError(f'Not a half-integer lattice point: {c!r}')
+    return ((ir & 1) << 64) | ((ir + 2**31) << 32) | (ii + 2**31)
+
+
 def sorted_complex(
         values: Iterable[TItem],
         *,
-        key: Callable[[TItem], Any] = lambda e: e) -> List[TItem]:
-    return sorted(values, key=lambda e: complex_key(key(e)))
+        key: Optional[Callable[[TItem], Any]] = None) -> List[TItem]:
+    """Sorts values by complex_key (of the value, or of the key applied to the value).
+
+    Numpy arrays of complex numbers are sorted (and returned) as numpy arrays.
+    """
+    if key is None and isinstance(values, np.ndarray):
+        not_int = np.real(values) != np.trunc(np.real(values))
+        return values[np.lexsort((np.imag(values), np.real(values), not_int))]
+    values = list(values)
+    try:
+        if key is None:
+            return sorted(values, key=complex_int_key)
+        return sorted(values, key=lambda e: complex_int_key(key(e)))
+    except ValueError:
+        if key is None:
+            return sorted(values, key=complex_key)
+        return sorted(values, key=lambda e: complex_key(key(e)))
+
+
+def sorted_complex_pairs(pairs: Iterable[Tuple[complex, complex]]) -> List[Tuple[complex, complex]]:
+    """Sorts pairs of complex numbers by the complex_key of their first item, then of their second item."""
+    pairs = list(pairs)
+    try:
+        return sorted(pairs, key=lambda e: (complex_int_key(e[0]) << 65) | complex_int_key(e[1]))
+    except ValueError:
+        return sorted(pairs, key=lambda e: (complex_key(e[0]), complex_key(e[1])))
 
 
 def not_nones(vs) -> List[Any]:
@@ -98,60 +142,295 @@ def circuit_has_unsigned_stabilizers(
     return True
 
 
-def score_binomial_line(*,
-                        min_x_lim: float,
-                        max_x_lim: float,
-                        min_p_lim: float,
-                        max_p_lim: float,
-                        xs: List[float],
-                        shots: List[int],
-                        errors: List[int],
-                        max_likelihood_factor: float,
-                        y_distortion: Callable[[float], float] = lambda e: e) -> Any:
+@dataclasses.dataclass
+class BinomialLineFit:
+    """The maximum likelihood line found by `fit_binomial_line`, and the candidate lines near it.
+
+    Lines are in (x, ln(p)) space: ln(p) = offset + slope * x.
+    """
+    best_offset: float
+    best_slope: float
+    max_log_likelihood: float
+    offsets: np.ndarray
+    slopes: np.ndarray
+
+
+def _boundary_points(*,
+                     min_x_lim: float,
+                     max_x_lim: float,
+                     min_y_lim: float,
+                     max_y_lim: float,
+                     n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the points on the top/left and bottom/right edges of the plot that candidate lines pass through.
+
+    The first n points of each result are on the horizontal edge, the last n are on the vertical edge.
+    """
+    xs = np.linspace(min_x_lim, max_x_lim, n)
+    ys = np.linspace(min_y_lim, max_y_lim, n)
+    top_left_points = np.concatenate([xs + 1j*max_y_lim, min_x_lim + 1j*ys]).astype(np.complex64)
+    bottom_right_points = np.concatenate([xs + 1j*min_y_lim, max_x_lim + 1j*ys]).astype(np.complex64)
+    return top_left_points, bottom_right_points
+
+
+def _score_lines(*,
+                 v1: np.ndarray,
+                 v2: np.ndarray,
+                 xs: List[float],
+                 shots: List[int],
+                 errors: List[int],
+                 log_factor: float) -> Optional[Tuple[int, float, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """Scores the lines from each top/left point in v1 to the corresponding bottom/right point in v2.
+
+    Returns:
+        None if none of the lines are reasonable. Otherwise a
+        (best_k, max_likelihood, indices, offsets, slopes, scores) tuple describing
+        the lines within `log_factor` of the best line amongst the given lines.
+        `indices` are positions in v1/v2 and best_k is a position in the returned
+        arrays.
+    """
     from sinter.probability_util import log_binomial
 
-    top_left_points = []
-    bottom_right_points = []
-    min_y_lim = np.log(min_p_lim)
-    max_y_lim = np.log(max_p_lim)
-    n = 2000
-    for x in np.linspace(min_x_lim, max_x_lim, n):
-        top_left_points.append(x + 1j*max_y_lim)
-        bottom_right_points.append(x + 1j*min_y_lim)
-    for y in np.linspace(min_y_lim, max_y_lim, n):
-        top_left_points.append(min_x_lim + 1j*y)
-        bottom_right_points.append(max_x_lim + 1j*y)
-
-    v1 = np.zeros(shape=(2*n, 2*n), dtype=np.complex64)
-    v2 = np.zeros(shape=(2*n, 2*n), dtype=np.complex64)
-    v1 += top_left_points
-    v2 += bottom_right_points
-    v2 = v2.transpose()
-    v1 = v1.flatten()
-    v2 = v2.flatten()
-    positive_slope = (np.real(v2) > np.real(v1)) & (np.imag(v2) < np.imag(v1))
-    v1 = np.copy(v1[positive_slope])
-    v2 = np.copy(v2[positive_slope])
+    indices = np.flatnonzero((np.real(v2) > np.real(v1)) & (np.imag(v2) < np.imag(v1)))
+    v1 = v1[indices]
+    v2 = v2[indices]
     dv = v2 - v1
-    di = np.imag(dv)
-    dr = np.real(dv)
-    possible_slopes = di / dr
+    possible_slopes = np.imag(dv) / np.real(dv)
     possible_offsets = v1.imag - possible_slopes * v1.real
+    del v1, v2, dv
     reasonable_offsets = possible_offsets < 100
+    indices = indices[reasonable_offsets]
     possible_slopes = possible_slopes[reasonable_offsets].astype(np.float64)
     possible_offsets = possible_offsets[reasonable_offsets].astype(np.float64)
+    if len(possible_offsets) == 0:
+        return None
 
     scores = np.zeros(possible_offsets.shape, dtype=np.float64)
     for k in range(len(xs)):
         p = np.exp(possible_offsets + possible_slopes * xs[k])
         scores += log_binomial(p=p, n=shots[k], hits=errors[k])
-    best_k = np.argmax(scores)
-    best_offset = possible_offsets[best_k]
-    best_slope = possible_slopes[best_k]
+    best_k = int(np.argmax(scores))
     max_likelihood = scores[best_k]
-    kept = scores >= max_likelihood - np.log(max_likelihood_factor)
-    possible_offsets = np.copy(possible_offsets[kept])
-    possible_slopes = np.copy(possible_slopes[kept])
+    kept = scores >= max_likelihood - log_factor
+    best_k = int(np.count_nonzero(kept[:best_k]))
+    return best_k, max_likelihood, indices[kept], possible_offsets[kept], possible_slopes[kept], scores[kept]
+
+
+def _search_lines(*,
+                  top_left_points: np.ndarray,
+                  bottom_right_points: np.ndarray,
+                  pair_ids: Optional[np.ndarray],
+                  xs: List[float],
+                  shots: List[int],
+                  errors: List[int],
+                  log_factor: float,
+                  max_memory_bytes: int,
+                  num_threads: int) -> Tuple[BinomialLineFit, np.ndarray]:
+    """Scores candidate lines in memory-bounded chunks, spread over a thread pool.
+
+    Args:
+        pair_ids: The candidate lines to score. Line `i * len(top_left_points) + j` goes
+            from top_left_points[j] to bottom_right_points[i]. None means every pair.
+
+    Returns:
+        The fit, and the pair ids of the lines within its likelihood band.
+    """
+    m = len(top_left_points)
+    num_candidates = m * len(bottom_right_points) if pair_ids is None else len(pair_ids)
+
+    # Rough count of the bytes of temporaries held per candidate line while scoring it.
+    bytes_per_candidate = 96
+    chunk_size = max(1, max_memory_bytes // (bytes_per_candidate * num_threads))
+
+    def score(start: int):
+        stop = min(start + chunk_size, num_candidates)
+        if pair_ids is None:
+            ids = np.arange(start, stop, dtype=np.int64)
+        else:
+            ids = pair_ids[start:stop]
+        result = _score_lines(
+            v1=top_left_points[ids % m],
+            v2=bottom_right_points[ids // m],
+            xs=xs,
+            shots=shots,
+            errors=errors,
+            log_factor=log_factor,
+        )
+        if result is None:
+            return None
+        best_k, max_likelihood, indices, offsets, slopes, scores = result
+        return best_k, max_likelihood, ids[indices], offsets, slopes, scores
+
+    best = None
+    chunks = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for chunk in pool.map(score, range(0, num_candidates, chunk_size)):
+            if chunk is None:
+                continue
+            chunks.append(chunk)
+            if best is None or chunk[1] > best[1]:
+                best = chunk
+    if best is None:
+        raise ValueError("No candidate lines intersect the plot area.")
+
+    best_k, max_likelihood, _, best_offsets, best_slopes, _ = best
+    threshold = max_likelihood - log_factor
+    kept_ids = []
+    kept_offsets = []
+    kept_slopes = []
+    for _, _, ids, offsets, slopes, scores in chunks:
+        kept = scores >= threshold
+        kept_ids.append(ids[kept])
+        kept_offsets.append(offsets[kept])
+        kept_slopes.append(slopes[kept])
+    fit = BinomialLineFit(
+        best_offset=best_offsets[best_k],
+        best_slope=best_slopes[best_k],
+        max_log_likelihood=max_likelihood,
+        offsets=np.concatenate(kept_offsets),
+        slopes=np.concatenate(kept_slopes),
+    )
+    return fit, np.concatenate(kept_ids)
+
+
+def _refined_pair_ids(*, pair_ids: np.ndarray, n: int, old_stride: int, new_stride: int) -> np.ndarray:
+    """Returns the pairs of finer boundary points that are near the given pairs of coarser boundary points.
+
+    Boundary point indices are into the full resolution boundary (2n points, n per edge).
+    Neighbors are only taken along the same edge.
+    """
+    m = 2 * n
+    reach = -(-old_stride // new_stride)
+    steps = np.arange(-reach, reach + 1) * new_stride
+
+    def neighbors(indices: np.ndarray) -> np.ndarray:
+        edge_start = (indices // n) * n
+        result = indices[:, np.newaxis] + steps[np.newaxis, :]
+        return np.clip(result, edge_start[:, np.newaxis], edge_start[:, np.newaxis] + n - 1)
+
+    rows = neighbors(pair_ids // m)
+    cols = neighbors(pair_ids % m)
+    result = rows[:, :, np.newaxis] * m + cols[:, np.newaxis, :]
+    return np.unique(result)
+
+
+def fit_binomial_line(*,
+                      min_x_lim: float,
+                      max_x_lim: float,
+                      min_p_lim: float,
+                      max_p_lim: float,
+                      xs: List[float],
+                      shots: List[int],
+                      errors: List[int],
+                      max_likelihood_factor: float,
+                      max_memory_bytes: int = 2**28,
+                      num_threads: Optional[int] = None,
+                      resolution: int = 2000,
+                      adaptive: bool = False,
+                      coarse_resolution: int = 64,
+                      refine_ratio: int = 4) -> BinomialLineFit:
+    """Finds the line through (x, ln(p)) space that maximizes the likelihood of the given binomial data.
+
+    Candidate lines are the lines between pairs of points on the boundary of the plot
+    area. Instead of materializing every candidate at once, the candidates are scored in
+    chunks spread over a thread pool.
+
+    Args:
+        min_x_lim: Left side of the plot area.
+        max_x_lim: Right side of the plot area.
+        min_p_lim: Bottom of the plot area.
+        max_p_lim: Top of the plot area.
+        xs: The x coordinate of each data point.
+        shots: The number of shots taken at each data point.
+        errors: The number of errors seen at each data point.
+        max_likelihood_factor: Lines whose likelihood is within this factor of the best
+            line's likelihood are included in the result.
+        max_memory_bytes: Approximate limit on the working memory used by all chunks that
+            are being scored at the same time.
+        num_threads: Number of threads to score chunks with. Defaults to the CPU count.
+        resolution: Number of boundary points per edge of the plot area.
+        adaptive: When False, every pair of boundary points is scored. When True, pairs
+            of boundary points at `coarse_resolution` are scored first, and then only
+            pairs near the high likelihood lines are scored at successively finer
+            resolutions (by `refine_ratio` each time) until reaching `resolution`.
+            Intermediate levels keep lines within the square of max_likelihood_factor,
+            so the band isn't lost to coarse sampling.
+        coarse_resolution: Number of boundary points per edge in the first adaptive level.
+        refine_ratio: How much finer each adaptive level is than the previous one.
+
+    Returns:
+        The best line, and the candidate lines within the likelihood band.
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    n = resolution
+    top_left_points, bottom_right_points = _boundary_points(
+        min_x_lim=min_x_lim,
+        max_x_lim=max_x_lim,
+        min_y_lim=np.log(min_p_lim),
+        max_y_lim=np.log(max_p_lim),
+        n=n,
+    )
+    log_factor = np.log(max_likelihood_factor)
+    search = functools.partial(
+        _search_lines,
+        top_left_points=top_left_points,
+        bottom_right_points=bottom_right_points,
+        xs=xs,
+        shots=shots,
+        errors=errors,
+        max_memory_bytes=max_memory_bytes,
+        num_threads=num_threads,
+    )
+    if not adaptive:
+        fit, _ = search(pair_ids=None, log_factor=log_factor)
+        return fit
+
+    if refine_ratio < 2:
+        raise ValueError(f'{refine_ratio=} < 2')
+    stride = max(1, -(-(n - 1) // max(1, coarse_resolution - 1)))
+    edge_indices = np.unique(np.append(np.arange(0, n, stride), n - 1))
+    indices = np.concatenate([edge_indices, edge_indices + n])
+    pair_ids = (indices[:, np.newaxis] * 2 * n + indices[np.newaxis, :]).ravel()
+    while True:
+        if stride == 1:
+            fit, _ = search(pair_ids=pair_ids, log_factor=log_factor)
+            return fit
+        _, kept_ids = search(pair_ids=pair_ids, log_factor=log_factor * 2)
+        new_stride = max(1, stride // refine_ratio)
+        pair_ids = _refined_pair_ids(pair_ids=kept_ids, n=n, old_stride=stride, new_stride=new_stride)
+        stride = new_stride
+
+
+def score_binomial_line(*,
+                        min_x_lim: float,
+                        max_x_lim: float,
+                        min_p_lim: float,
+                        max_p_lim: float,
+                        xs: List[float],
+                        shots: List[int],
+                        errors: List[int],
+                        max_likelihood_factor: float,
+                        y_distortion: Callable[[float], float] = lambda e: e,
+                        max_memory_bytes: int = 2**28,
+                        num_threads: Optional[int] = None,
+                        resolution: int = 2000,
+                        adaptive: bool = False) -> Any:
+    fit = fit_binomial_line(
+        min_x_lim=min_x_lim,
+        max_x_lim=max_x_lim,
+        min_p_lim=min_p_lim,
+        max_p_lim=max_p_lim,
+        xs=xs,
+        shots=shots,
+        errors=errors,
+        max_likelihood_factor=max_likelihood_factor,
+        max_memory_bytes=max_memory_bytes,
+        num_threads=num_threads,
+        resolution=resolution,
+        adaptive=adaptive,
+    )
+    best_offset = fit.best_offset
+    best_slope = fit.best_slope
     xs2, ys = outline(
         min_x=min_x_lim,
         max_x=max_x_lim,
@@ -159,8 +438,8 @@ def score_binomial_line(*,
         max_y=np.log(max_p_lim),
         best_offset=best_offset,
         best_slope=best_slope,
-        offsets=possible_offsets,
-        slopes=possible_slopes,
+        offsets=fit.offsets,
+        slopes=fit.slopes,
     )
     ys = [y_distortion(e) for e in np.exp(ys)]
 
@@ -182,6 +461,92 @@ def score_binomial_line(*,
     return [x1, x2], [np.exp(y1), np.exp(y2)], xs2, ys
 
 
+def _lower_hull_candidates(xs: np.ndarray, ys: np.ndarray, *, num_directions: int = 8) -> np.ndarray:
+    """Returns a mask that keeps (at least) every point on the lower convex hull of the given points.
+
+    A few points that are certainly on the lower hull are found by minimizing along some
+    directions. They form a convex chain, and every point above that chain is dropped.
+    """
+    if len(xs) <= 2:
+        return np.ones(len(xs), dtype=np.bool_)
+    spread = np.ptp(ys) / max(np.ptp(xs), 1e-300)
+    indices = [np.argmin(ys + xs * spread * np.tan(angle))
+               for angle in np.linspace(-np.pi / 2, np.pi / 2, num_directions + 2)[1:-1]]
+    for x in [np.min(xs), np.max(xs)]:
+        at_x = np.flatnonzero(xs == x)
+        indices.append(at_x[np.argmin(ys[at_x])])
+    chain_xs, first = np.unique(xs[indices], return_index=True)
+    chain_ys = ys[indices][first]
+    limit = np.interp(xs, chain_xs, chain_ys)
+    return ys <= limit + 1e-9 * (1 + np.abs(limit))
+
+
+def _lower_hull(xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the vertices of the lower convex hull of the given points, sorted by x."""
+    candidates = _lower_hull_candidates(xs, ys)
+    xs = xs[candidates]
+    ys = ys[candidates]
+    order = np.lexsort((ys, xs))
+    xs = xs[order]
+    ys = ys[order]
+    # Only the lowest point at each x can be on the lower hull.
+    first = np.ones(len(xs), dtype=np.bool_)
+    first[1:] = xs[1:] != xs[:-1]
+    xs = xs[first]
+    ys = ys[first]
+
+    # Drop every point that isn't strictly below the segment between its neighbors, until none are dropped.
+    while len(xs) > 2:
+        dx1 = xs[1:-1] - xs[:-2]
+        dy1 = ys[1:-1] - ys[:-2]
+        dx2 = xs[2:] - xs[1:-1]
+        dy2 = ys[2:] - ys[1:-1]
+        keep = np.ones(len(xs), dtype=np.bool_)
+        keep[1:-1] = dx1 * dy2 - dy1 * dx2 > 0
+        if np.all(keep):
+            break
+        xs = xs[keep]
+        ys = ys[keep]
+    return xs, ys
+
+
+def _lower_envelope(*,
+                    offsets: np.ndarray,
+                    slopes: np.ndarray,
+                    min_x: float,
+                    max_x: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the exact vertices of min(offsets + slopes * x) over min_x <= x <= max_x.
+
+    The lines that are lowest at some x are exactly the lines whose (slope, offset)
+    points are on the lower convex hull of all the (slope, offset) points, and the
+    envelope bends where consecutive hull lines cross.
+    """
+    hull_slopes, hull_offsets = _lower_hull(slopes, offsets)
+    crossings = -np.diff(hull_offsets) / np.diff(hull_slopes)
+    crossings = crossings[(min_x < crossings) & (crossings < max_x)]
+    xs = np.concatenate([[min_x], np.sort(crossings), [max_x]])
+    ys = np.min(hull_offsets[np.newaxis, :] + hull_slopes[np.newaxis, :] * xs[:, np.newaxis], axis=1)
+    return xs, ys
+
+
+def _sampled_envelope(*,
+                      offsets: np.ndarray,
+                      slopes: np.ndarray,
+                      xs: np.ndarray,
+                      max_memory_bytes: int) -> np.ndarray:
+    """Returns min(offsets + slopes * x) at each of the given xs, broadcasting the xs against blocks of lines."""
+    keep = _lower_hull_candidates(slopes, offsets)
+    offsets = offsets[keep]
+    slopes = slopes[keep]
+    block_size = max(1, max_memory_bytes // (len(xs) * 8))
+    result = np.full(len(xs), np.inf)
+    for start in range(0, len(offsets), block_size):
+        vs = xs[:, np.newaxis] * slopes[np.newaxis, start:start + block_size]
+        vs += offsets[np.newaxis, start:start + block_size]
+        np.minimum(result, np.min(vs, axis=1), out=result)
+    return result
+
+
 def outline(*,
             min_y: float,
             max_y: float,
@@ -190,7 +555,33 @@ def outline(*,
             best_offset: float,
             best_slope: float,
             offsets: np.ndarray,
-            slopes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            slopes: np.ndarray,
+            num_samples: int = 128,
+            max_memory_bytes: int = 2**22,
+            exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns a polygon around the region covered by the given lines, within the plot area.
+
+    The lines are rotated so the best line is horizontal, then bounded below and above.
+
+    Args:
+        min_y: Bottom of the plot area.
+        max_y: Top of the plot area.
+        min_x: Left side of the plot area.
+        max_x: Right side of the plot area.
+        best_offset: Offset of the best line.
+        best_slope: Slope of the best line.
+        offsets: Offsets of the lines to enclose.
+        slopes: Slopes of the lines to enclose.
+        num_samples: Number of x positions to bound the lines at, when not exact.
+        max_memory_bytes: Approximate limit on the memory used when evaluating blocks of
+            lines at all the sample positions.
+        exact: When True, the envelopes are computed from the convex hulls of the lines
+            instead of sampled, so the polygon has a vertex exactly wherever the envelope
+            bends (and num_samples is ignored).
+
+    Returns:
+        The xs and ys of the polygon's vertices.
+    """
     in1s = offsets * 1j
     in2s = 1 + (offsets + slopes) * 1j
     ref = 1 + best_slope * 1j
@@ -209,14 +600,28 @@ def outline(*,
     corners *= ref.conjugate()
     rot_slopes = (in2s.imag - in1s.imag) / (in2s.real - in1s.real)
     rot_offsets = in1s.imag - rot_slopes * in1s.real
+    rot_min_x = np.min(np.real(corners))
+    rot_max_x = np.max(np.real(corners))
 
-    outs1 = []
-    outs2 = []
-    for x in np.linspace(np.min(np.real(corners)), np.max(np.real(corners)), 128):
-        vs = rot_offsets + rot_slopes * x
-        outs1.append(x + 1j*np.min(vs))
-        outs2.append(x + 1j*np.max(vs))
-    outs = np.array(outs1 + outs2[::-1], dtype=np.complex128)
+    if exact:
+        xs1, lows = _lower_envelope(offsets=rot_offsets, slopes=rot_slopes, min_x=rot_min_x, max_x=rot_max_x)
+        xs2, neg_highs = _lower_envelope(offsets=-rot_offsets, slopes=-rot_slopes, min_x=rot_min_x, max_x=rot_max_x)
+        highs = -neg_highs
+    else:
+        xs1 = xs2 = np.linspace(rot_min_x, rot_max_x, num_samples)
+        lows = _sampled_envelope(
+            offsets=rot_offsets,
+            slopes=rot_slopes,
+            xs=xs1,
+            max_memory_bytes=max_memory_bytes,
+        )
+        highs = -_sampled_envelope(
+            offsets=-rot_offsets,
+            slopes=-rot_slopes,
+            xs=xs1,
+            max_memory_bytes=max_memory_bytes,
+        )
+    outs = np.concatenate([xs1 + 1j*lows, (xs2 + 1j*highs)[::-1]]).astype(np.complex128)
     outs *= ref
     outs += best_offset * 1j
     return np.real(outs), np.imag(outs)
@@ -0,0 +1,62 @@
+import numpy as np
+
+from _util import fit_binomial_line, _lower_envelope, complex_key, sorted_complex
+
+
+FIT_KWARGS = dict(
+    min_x_lim=0,
+    max_x_lim=20,
+    min_p_lim=1e-8,
+    max_p_lim=1,
+    xs=[3, 5, 7, 9],
+    shots=[10**5, 10**5, 10**5, 10**5],
+    errors=[2000, 300, 40, 6],
+    max_likelihood_factor=1000,
+)
+
+
+def test_fit_binomial_line_chunking_does_not_change_result():
+    whole = fit_binomial_line(**FIT_KWARGS, max_memory_bytes=2**40, num_threads=1)
+    chunked = fit_binomial_line(**FIT_KWARGS, max_memory_bytes=2**20, num_threads=4)
+
+    assert whole.best_offset == chunked.best_offset
+    assert whole.best_slope == chunked.best_slope
+    assert whole.max_log_likelihood == chunked.max_log_likelihood
+    np.testing.assert_array_equal(whole.offsets, chunked.offsets)
+    np.testing.assert_array_equal(whole.slopes, chunked.slopes)
+    assert -1.2 < whole.best_slope < -0.8
+
+
+def test_fit_binomial_line_adaptive_finds_same_band():
+    full = fit_binomial_line(**FIT_KWARGS)
+    adaptive = fit_binomial_line(**FIT_KWARGS, adaptive=True)
+
+    assert adaptive.best_offset == full.best_offset
+    assert adaptive.best_slope == full.best_slope
+    assert adaptive.max_log_likelihood == full.max_log_likelihood
+    assert np.min(adaptive.slopes) == np.min(full.slopes)
+    assert np.max(adaptive.slopes) == np.max(full.slopes)
+    assert np.min(adaptive.offsets) == np.min(full.offsets)
+    assert np.max(adaptive.offsets) == np.max(full.offsets)
+
+
+def test_lower_envelope_matches_brute_force():
+    rng = np.random.default_rng(2)
+    offsets = rng.normal(0, 1, 10000)
+    slopes = rng.normal(0, 0.1, 10000)
+    xs, ys = _lower_envelope(offsets=offsets, slopes=slopes, min_x=-10, max_x=10)
+
+    assert xs[0] == -10 and xs[-1] == 10
+    samples = np.linspace(-10, 10, 1001)
+    brute = np.min(offsets[:, np.newaxis] + slopes[:, np.newaxis] * samples[np.newaxis, :], axis=0)
+    np.testing.assert_allclose(np.interp(samples, xs, ys), brute, rtol=1e-9, atol=1e-9)
+
+
+def test_sorted_complex_matches_complex_key_order():
+    rng = np.random.default_rng(3)
+    values = [complex(a / 2, b / 2) for a, b in rng.integers(-30, 30, size=(500, 2))]
+    expected = sorted(values, key=complex_key)
+
+    assert sorted_complex(values) == expected
+    assert sorted_complex(values + [0.25j]) == sorted(values + [0.25j], key=complex_key)
+    assert sorted_complex(np.array(values)).tolist() == expected
@@ -1,10 +1,18 @@
 import base64
 import collections
 import dataclasses
+import hashlib
+import io
+import json
+import multiprocessing
+import multiprocessing.connection
+import pathlib
 import random
 import sys
-from typing import Tuple, Dict, List, Set, Optional, Union, Iterable
+import time
+from typing import Tuple, Dict, List, Set, Optional, Union, Iterable, TextIO
 
+import numpy as np
 import stim
 
 PITCH = 32 * 4
@@ -80,16 +88,87 @@ def tag_str(tag, *, content: Union[bool, str] = False, **kwargs) -> str:
     return instr
 
 
+def write_tag(out: TextIO, tag, *, content: Union[bool, str] = False, **kwargs) -> None:
+    out.write(tag_str(tag, content=content, **kwargs))
+
+
+class _Base64Writer:
+    """Base64 encodes the utf-8 text written into it, forwarding the encoded text to another stream."""
+
+    def __init__(self, out: TextIO):
+        self.out = out
+        self.pending = b''
+
+    def write(self, text: str) -> None:
+        data = self.pending + text.encode('utf-8')
+        n = len(data) - len(data) % 3
+        self.out.write(base64.standard_b64encode(data[:n]).decode('ascii'))
+        self.pending = data[n:]
+
+    def close(self) -> None:
+        self.out.write(base64.standard_b64encode(self.pending).decode('ascii'))
+        self.pending = b''
+
+
+@dataclasses.dataclass
+class _RepeatBlock:
+    """A REPEAT block whose body is drawn once, with per-iteration labels filled in by the viewer."""
+    index: int
+    repeat_count: int
+    first_layer: int
+    first_tick: int
+    first_detector: int
+    first_measurement: int
+    ticks_per_iteration: int = 0
+    detectors_per_iteration: int = 0
+    measurements_per_iteration: int = 0
+    # (observable index or None, detector offset within the iteration, record position relative to the block).
+    pending_marks: List[Tuple[Optional[int], int, int]] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass(frozen=True)
+class _MeasurementRef:
+    layer: int
+    key: int
+    block: Optional[_RepeatBlock] = None
+    iteration: int = 0
+
+
+@dataclasses.dataclass(frozen=True)
+class _Mark:
+    layer: int
+    x: float
+    y: float
+    slot: int
+    prefix: str
+    base: int
+    stride: int
+    iterations: Optional[Tuple[int, int]]
+
+
+def _iteration_attributes(first: int, last: int) -> Dict[str, Union[int, str]]:
+    result = {'data_first': first, 'data_last': last}
+    if not first <= 0 <= last:
+        result['display'] = 'none'
+    return result
+
+
 class _SvgLayer:
     def __init__(self):
-        self.svg_instructions: List[str] = []
+        self.block: Optional[_RepeatBlock] = None
+        # Utf-8 encoded markup, one line per element, kept compact until it's written out.
+        self.svg_instructions = bytearray()
         self.q2i_dict: Dict[int, Tuple[float, float]] = {}
         self.used_indices: Set[int] = set()
         self.used_positions: Set[Tuple[float, float]] = set()
         self.measurement_positions: Dict[int, Tuple[float, float]] = {}
 
     def add(self, tag, *, content: Union[bool, str] = False, **kwargs) -> None:
-        self.svg_instructions.append("    " + tag_str(tag, content=content, **kwargs))
+        self.svg_instructions += b"\n    "
+        self.svg_instructions += tag_str(tag, content=content, **kwargs).encode('utf-8')
+
+    def is_empty(self) -> bool:
+        return not self.svg_instructions
 
     def bounds(self) -> Tuple[float, float, float, float]:
         min_y = min(e for _, e in self.used_positions)
@@ -106,6 +185,9 @@ class _SvgLayer:
         for x, y in all_used_positions - self.used_positions:
             self.add("circle", cx=x, cy=y, r=5, fill="gray", stroke="black")
         self.used_positions |= all_used_positions
+        self.add_axis_labels()
+
+    def add_axis_labels(self):
         min_x, min_y, max_x, max_y = self.bounds()
         xs = {e for e, _ in self.used_positions}
         ys = {e for _, e in self.used_positions}
@@ -136,49 +218,63 @@ class _SvgLayer:
                      alignment_baseline="middle",
                      font_size=24)
 
+    def write_svg(self, out: TextIO, *, html_id: Optional[str] = None, **attributes) -> None:
+        min_x, min_y, max_x, max_y = self.bounds()
+        kwargs = {} if html_id is None else {'id': html_id}
+        write_tag(out,
+                  "svg",
+                  xmlns="http://www.w3.org/2000/svg",
+                  viewBox=f"{min_x} {min_y} {max_x - min_x} {max_y - min_y}",
+                  content=True,
+                  **kwargs,
+                  **attributes)
+        out.write(self.svg_instructions.decode('utf-8'))
+        out.write("\n</svg>")
+
     def svg(self,
             *,
             html_id: Optional[str] = None,
             as_img_with_data_uri: bool = False,
             width: int,
-            height: int) -> str:
-        min_x, min_y, max_x, max_y = self.bounds()
-        kwargs = {} if html_id is None or as_img_with_data_uri else {'id': html_id}
-        svg = "\n".join([
-            tag_str("svg",
-                    xmlns="http://www.w3.org/2000/svg",
-                    viewBox=f"{min_x} {min_y} {max_x - min_x} {max_y - min_y}",
-                    content=True,
-                    **kwargs),
-            *self.svg_instructions,
-            "</svg>",
-        ])
+            height: int,
+            **attributes) -> str:
+        out = io.StringIO()
         if as_img_with_data_uri:
             kwargs = {} if html_id is None else {'id': html_id}
-            svg = tag_str("img",
-                          width=width,
-                          height=height,
-                          **kwargs,
-                          src="data:image/svg+xml;base64," + base64.standard_b64encode(svg.encode('utf-8')).decode('utf-8'))
-            svg = svg.replace("/>", ">")
-        return svg
+            img = tag_str("img", width=width, height=height, **kwargs, src="data:image/svg+xml;base64,")
+            # Stream the encoded image into the src attribute, before its closing quote.
+            out.write(img[:-len("' />")])
+            encoder = _Base64Writer(out)
+            self.write_svg(encoder, **attributes)
+            encoder.close()
+            out.write("' >")
+        else:
+            self.write_svg(out, html_id=html_id, **attributes)
+        return out.getvalue()
 
 
 class _SvgState:
     def __init__(self):
         self.layers: List[_SvgLayer] = [_SvgLayer()]
         self.coord_shift: List[int] = [0, 0]
-        self.measurement_layer_indices: List[int] = []
+        self.measurements: List[_MeasurementRef] = []
         self.detector_index = 0
+        self.tick_count = 0
         self.detector_coords = {}
         self.measurement_marks = collections.Counter()
         self.highlighted_detectors = set()
         self.highlighted_errors: List[Tuple[int, int, str]] = []
+        self.highlighted_error_ticks: List[Tuple[int, int, str]] = []
         self.noted_errors: List[Tuple[int, int, str]] = []
+        self.blocks: List[_RepeatBlock] = []
+        self.collapsing: Optional[_RepeatBlock] = None
+        self.marks: List[_Mark] = []
 
     def tick(self) -> None:
         self.layers.append(_SvgLayer())
         self.layers[-1].q2i_dict = dict(self.layers[-2].q2i_dict)
+        self.layers[-1].block = self.collapsing
+        self.tick_count += 1
 
     def q2i(self, i: int) -> Tuple[float, float]:
         x, y = self.layers[-1].q2i_dict.setdefault(i, (i, 0))
@@ -203,46 +299,211 @@ class _SvgState:
 
     def add_measurement(self, target: stim.GateTarget) -> None:
         assert target.is_qubit_target or target.is_x_target or target.is_y_target or target.is_z_target
-        m_index = len(self.measurement_layer_indices)
-        self.measurement_layer_indices.append(len(self.layers) - 1)
+        m_index = len(self.measurements)
+        self.measurements.append(_MeasurementRef(layer=len(self.layers) - 1, key=m_index, block=self.collapsing))
         self.layers[-1].measurement_positions[m_index] = self.q2i(target.value)
 
     def mark_measurements(self, targets: List[stim.GateTarget], obs_index: Optional[int] = None) -> None:
+        detector = self.detector_index
         if obs_index is None:
-            name = f"D{self.detector_index}"
-            # if self.detector_index in self.detector_coords:
-            #     name += str(self.detector_coords[self.detector_index])
-            color = "black"
-            if self.detector_index in self.highlighted_detectors:
-                color = "#FF8000"
             self.detector_index += 1
-        else:
-            color = "blue"
-            name = f"L{obs_index}"
+        block = self.collapsing
         for t in targets:
-            m_index = len(self.measurement_layer_indices) + t.value
+            m_index = len(self.measurements) + t.value
             if m_index < 0:
                 print("Attempted to mark a measurement before the beginning of time.\n"
                       "Skipping this mark.", file=sys.stderr)
                 continue
-            assert m_index >= 0, m_index
             assert t.is_measurement_record_target
-            layer = self.layers[self.measurement_layer_indices[m_index]]
-            x, y = layer.measurement_positions[m_index]
-            if color == "#FF8000":
+            if block is not None:
+                block.pending_marks.append((obs_index, detector - block.first_detector, m_index - block.first_measurement))
+            else:
+                self._add_mark(self.measurements[m_index], obs_index=obs_index, detector=detector)
+
+    def _add_mark(self,
+                  measurement: _MeasurementRef,
+                  *,
+                  obs_index: Optional[int],
+                  detector: int,
+                  stride: int = 0,
+                  iterations: Optional[Tuple[int, int]] = None) -> None:
+        """Records a label on a measurement, for a detector or observable that depends on it.
+
+        Args:
+            measurement: The marked measurement.
+            obs_index: The marking observable, or None if the mark is for a detector.
+            detector: The marking detector's index when the block containing the measurement is at
+                iteration 0 (ignored for observables).
+            stride: How much the detector index increases per iteration of the block containing the
+                measurement.
+            iterations: The range of iterations (inclusive) where the mark is visible. Defaults to
+                always visible, or only visible at the measurement's own iteration if it's in a block.
+        """
+        if iterations is None and measurement.block is not None:
+            iterations = (measurement.iteration, measurement.iteration)
+        if obs_index is None:
+            prefix, base = "D", detector
+        else:
+            prefix, base, stride = "L", obs_index, 0
+        x, y = self.layers[measurement.layer].measurement_positions[measurement.key]
+        self.marks.append(_Mark(
+            layer=measurement.layer,
+            x=x,
+            y=y,
+            slot=self.measurement_marks[measurement.key],
+            prefix=prefix,
+            base=base,
+            stride=stride,
+            iterations=iterations,
+        ))
+        self.measurement_marks[measurement.key] += 1
+
+    def draw_marks(self) -> None:
+        """Draws the recorded measurement labels, now that the highlighted detectors are known."""
+        for mark in self.marks:
+            self._draw_mark(mark)
+        self.marks.clear()
+
+    def _draw_mark(self, mark: _Mark) -> None:
+        layer = self.layers[mark.layer]
+        x, y = mark.x, mark.y
+        text_x = x + RAD + 1
+        text_y = y - RAD + mark.slot * 15
+        prefix, base, stride = mark.prefix, mark.base, mark.stride
+        is_detector = prefix == "D"
+        color = "black" if is_detector else "blue"
+
+        if mark.iterations is None:
+            if is_detector and base in self.highlighted_detectors:
+                color = "#FF8000"
                 layer.add("rect", x=x - RAD, y=y - RAD, width=DIAM, height=DIAM, fill=color, stroke="black")
-            x += RAD + 1
-            y -= RAD
-            y += self.measurement_marks[m_index] * 15
-            self.measurement_marks[m_index] += 1
             layer.add("text",
-                      x=x,
-                      y=y,
+                      x=text_x,
+                      y=text_y,
                       fill=color,
-                      content=name,
+                      content=f"{prefix}{base}",
                       text_anchor="left",
                       alignment_baseline="hanging",
                       font_size=16)
+            return
+
+        first, last = mark.iterations
+        if is_detector:
+            for highlighted in sorted(self.highlighted_detectors):
+                if stride == 0:
+                    hits = range(first, last + 1) if highlighted == base else ()
+                elif (highlighted - base) % stride == 0 and first <= (highlighted - base) // stride <= last:
+                    hits = [(highlighted - base) // stride]
+                else:
+                    hits = ()
+                for k in hits:
+                    layer.add("rect",
+                              x=x - RAD,
+                              y=y - RAD,
+                              width=DIAM,
+                              height=DIAM,
+                              fill="#FF8000",
+                              stroke="black",
+                              **_iteration_attributes(k, k))
+        layer.add("text",
+                  x=text_x,
+                  y=text_y,
+                  fill=color,
+                  content=f"{prefix}{base + stride * first}",
+                  text_anchor="left",
+                  alignment_baseline="hanging",
+                  font_size=16,
+                  data_prefix=prefix,
+                  data_base=base,
+                  data_stride=stride,
+                  **_iteration_attributes(first, last))
+
+    def can_collapse(self, block: stim.CircuitRepeatBlock, body: stim.Circuit) -> bool:
+        """Determines if a REPEAT block's iterations can share one set of drawn layers.
+
+        The block must start on a fresh layer and its body must end with a TICK, so that each
+        iteration covers the same whole layers. Blocks nested inside a collapsed block are unrolled.
+        """
+        if self.collapsing is not None or block.repeat_count < 2 or len(body) == 0:
+            return False
+        last = body[-1]
+        if not isinstance(last, stim.CircuitInstruction) or last.name != "TICK":
+            return False
+        layer_index = len(self.layers) - 1
+        if not self.layers[-1].is_empty() or self.layers[-1].measurement_positions:
+            return False
+        return not any(e[1] == layer_index for e in self.highlighted_errors[-1:] + self.noted_errors[-1:])
+
+    def begin_repeat_block(self, repeat_count: int) -> _RepeatBlock:
+        block = _RepeatBlock(
+            index=len(self.blocks),
+            repeat_count=repeat_count,
+            first_layer=len(self.layers) - 1,
+            first_tick=self.tick_count,
+            first_detector=self.detector_index,
+            first_measurement=len(self.measurements),
+        )
+        self.blocks.append(block)
+        self.layers[-1].block = block
+        self.collapsing = block
+        return block
+
+    def end_repeat_block(self, block: _RepeatBlock, coord_shift_before: List[float]) -> None:
+        """Accounts for the iterations of a block after the first one, which was drawn."""
+        self.collapsing = None
+        self.layers[-1].block = None
+        n = block.repeat_count
+        block.ticks_per_iteration = self.tick_count - block.first_tick
+        block.detectors_per_iteration = self.detector_index - block.first_detector
+        block.measurements_per_iteration = len(self.measurements) - block.first_measurement
+        iteration_measurements = self.measurements[block.first_measurement:]
+        for k in range(1, n):
+            self.measurements.extend(dataclasses.replace(m, iteration=k) for m in iteration_measurements)
+        self.tick_count += (n - 1) * block.ticks_per_iteration
+        self.detector_index += (n - 1) * block.detectors_per_iteration
+        for axis in range(2):
+            self.coord_shift[axis] += (n - 1) * (self.coord_shift[axis] - coord_shift_before[axis])
+
+        stride = block.detectors_per_iteration
+        period = block.measurements_per_iteration
+        for obs_index, offset, position in block.pending_marks:
+            if position >= 0:
+                lag = 0
+            elif period == 0:
+                lag = n
+            else:
+                lag = min(n, -(position // period))
+            # Early iterations can refer back to measurements from before the block.
+            for k in range(lag):
+                m_index = block.first_measurement + k * period + position
+                if m_index < 0:
+                    print("Attempted to mark a measurement before the beginning of time.\n"
+                          "Skipping this mark.", file=sys.stderr)
+                    continue
+                self._add_mark(self.measurements[m_index],
+                               obs_index=obs_index,
+                               detector=block.first_detector + k * stride + offset)
+            # Later iterations refer to measurements from `lag` iterations before them.
+            if lag < n:
+                self._add_mark(self.measurements[block.first_measurement + position + lag * period],
+                               obs_index=obs_index,
+                               detector=block.first_detector + lag * stride + offset,
+                               stride=stride,
+                               iterations=(0, n - 1 - lag))
+        block.pending_marks.clear()
+
+    def layer_of_tick(self, tick: int) -> Tuple[int, Optional[int]]:
+        """Returns the drawn layer showing a tick, and the block iteration the tick is in (if any)."""
+        skipped = 0
+        for block in self.blocks:
+            if tick < block.first_tick:
+                break
+            span = block.ticks_per_iteration * block.repeat_count
+            if tick < block.first_tick + span:
+                iteration, offset = divmod(tick - block.first_tick, block.ticks_per_iteration)
+                return block.first_layer + offset, iteration
+            skipped += span - block.ticks_per_iteration
+        return tick - skipped, None
 
 
 def _draw_endpoint(x: float, y: float, style: str, *, out: _SvgState) -> None:
@@ -363,12 +624,18 @@ def _draw_1q(instruction: stim.CircuitInstruction, *, out: _SvgState):
         out.add_box(x, y, style.label, fill=style.fill_color, text_color=style.text_color)
 
 
-def _stim_circuit_to_svg_helper(circuit: stim.Circuit, state: _SvgState) -> None:
+def _stim_circuit_to_svg_helper(circuit: stim.Circuit, state: _SvgState, *, collapse_repeat_blocks: bool) -> None:
     for instruction in circuit:
         if isinstance(instruction, stim.CircuitRepeatBlock):
             body = instruction.body_copy()
-            for _ in range(instruction.repeat_count):
-                _stim_circuit_to_svg_helper(body, state)
+            if collapse_repeat_blocks and state.can_collapse(instruction, body):
+                coord_shift_before = list(state.coord_shift)
+                block = state.begin_repeat_block(instruction.repeat_count)
+                _stim_circuit_to_svg_helper(body, state, collapse_repeat_blocks=False)
+                state.end_repeat_block(block, coord_shift_before)
+            else:
+                for _ in range(instruction.repeat_count):
+                    _stim_circuit_to_svg_helper(body, state, collapse_repeat_blocks=collapse_repeat_blocks)
         elif isinstance(instruction, stim.CircuitInstruction):
             targets: List[stim.GateTarget] = instruction.targets_copy()
             if instruction.name == "QUBIT_COORDS":
@@ -405,48 +672,238 @@ def _stim_circuit_to_svg_helper(circuit: stim.Circuit, state: _SvgState) -> None
             raise NotImplementedError(repr(instruction))
 
 
+def _summarize_known_error(
+        known_error: Iterable[stim.ExplainedError]) -> Tuple[List[Tuple[int, int, str]], List[int]]:
+    """Extracts the (qubit, tick, basis) flips and the detectors of an error that get highlighted."""
+    errors = []
+    detectors = []
+    for product in known_error:
+        loc = next(iter(product.circuit_error_locations))
+        for flipped in loc.flipped_pauli_product:
+            if flipped.gate_target.is_x_target:
+                b = 'X'
+            elif flipped.gate_target.is_y_target:
+                b = 'Y'
+            elif flipped.gate_target.is_z_target:
+                b = 'Z'
+            else:
+                raise NotImplementedError(repr(loc))
+            errors.append((flipped.gate_target.value, loc.tick_offset, b))
+        for term in product.dem_error_terms:
+            target = term.dem_target
+            if target.is_relative_detector_id():
+                detectors.append(target.val)
+    return errors, detectors
+
+
+def _shortest_error_worker(circuit_text: str, connection: multiprocessing.connection.Connection) -> None:
+    circuit = stim.Circuit(circuit_text)
+    # noinspection PyBroadException
+    try:
+        summary = _summarize_known_error(circuit.shortest_graphlike_error(
+            ignore_ungraphlike_errors=True,
+            canonicalize_circuit_errors=True,
+        ))
+    except Exception:
+        summary = None
+    connection.send(summary)
+    connection.close()
+
+
+def _summary_from_json(data: Optional[dict]) -> Optional[Tuple[List[Tuple[int, int, str]], List[int]]]:
+    if data is None:
+        return None
+    return [(q, t, b) for q, t, b in data['errors']], data['detectors']
+
+
+class _ShortestErrorSearch:
+    """Finds a circuit's shortest graphlike error in a worker process, or recalls it from a cache."""
+
+    def __init__(self,
+                 circuit: stim.Circuit,
+                 *,
+                 timeout: Optional[float],
+                 cache_dir: Optional[Union[str, pathlib.Path]]):
+        circuit_text = str(circuit)
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.cache_path = None
+        self.summary = None
+        self.process = None
+        if cache_dir is not None:
+            key = hashlib.sha256(circuit_text.encode('utf8')).hexdigest()
+            self.cache_path = pathlib.Path(cache_dir) / f"shortest_error_{key}.json"
+            if self.cache_path.exists():
+                with open(self.cache_path) as f:
+                    self.summary = _summary_from_json(json.load(f))
+                return
+        self.connection, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_shortest_error_worker, args=(circuit_text, sender), daemon=True)
+        self.process.start()
+        sender.close()
+
+    def _write_cache(self) -> None:
+        if self.cache_path is None:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, 'w') as f:
+            json.dump(None if self.summary is None else dict(errors=self.summary[0], detectors=self.summary[1]), f)
+
+    def wait(self) -> Optional[Tuple[List[Tuple[int, int, str]], List[int]]]:
+        if self.process is None:
+            return self.summary
+        remaining = None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+        if self.connection.poll(remaining):
+            try:
+                self.summary = self.connection.recv()
+            except EOFError:
+                # The worker died without answering (e.g. it ran out of memory), which says nothing
+                # about the circuit, so there's nothing to cache.
+                print("The shortest graphlike error search crashed. No error will be highlighted.", file=sys.stderr)
+                self.summary = None
+            else:
+                self._write_cache()
+        else:
+            print(f"Gave up on finding the shortest graphlike error after {self.timeout}s. "
+                  f"No error will be highlighted.", file=sys.stderr)
+            self.process.terminate()
+        self.process.join()
+        self.connection.close()
+        self.process = None
+        return self.summary
+
+
+def _capped_repeat_blocks(circuit: stim.Circuit, max_repetitions: int) -> stim.Circuit:
+    result = stim.Circuit()
+    for instruction in circuit:
+        if isinstance(instruction, stim.CircuitRepeatBlock):
+            body = _capped_repeat_blocks(instruction.body_copy(), max_repetitions)
+            result += body * min(instruction.repeat_count, max_repetitions)
+        else:
+            result.append(instruction)
+    return result
+
+
+def crumble_url(circuit: stim.Circuit,
+                *,
+                max_repetitions: Optional[int] = None,
+                keep_repeat_blocks: bool = False) -> str:
+    """Returns a link that opens a circuit in crumble, as served by a local JetBrains IDE.
+
+    Args:
+        circuit: The circuit to open.
+        max_repetitions: Caps the repetition count of REPEAT blocks. None means no cap.
+        keep_repeat_blocks: Leaves REPEAT blocks in the circuit instead of flattening it.
+
+    Returns:
+        The url.
+    """
+    if max_repetitions is not None:
+        circuit = _capped_repeat_blocks(circuit, max_repetitions)
+    if keep_repeat_blocks:
+        lines = [line.strip() for line in str(circuit).splitlines()]
+    else:
+        lines = [str(inst) for inst in circuit.flattened()]
+    circuit_coords = [line for line in lines if line.startswith("QUBIT_COORDS")]
+    circuit_rest = [line for line in lines if not line.startswith("QUBIT_COORDS")]
+
+    escaped = ';'.join(circuit_coords + circuit_rest).replace(' ', '_')
+
+    return f"""http://localhost:63342/crumble/crumble.html#circuit={escaped}"""
+
+
 def stim_circuit_html_viewer(circuit: stim.Circuit,
                              *,
                              width: int = 500,
                              height: int = 500,
-                             known_error: Optional[Iterable[stim.ExplainedError]] = None) -> str:
+                             known_error: Optional[Iterable[stim.ExplainedError]] = None,
+                             collapse_repeat_blocks: bool = True,
+                             layer_dir: Optional[Union[str, pathlib.Path]] = None,
+                             shared_background: bool = True,
+                             crumble_link: bool = True,
+                             crumble_max_repetitions: Optional[int] = None,
+                             crumble_keep_repeat_blocks: bool = False,
+                             highlight_shortest_error: bool = True,
+                             shortest_error_timeout: Optional[float] = 30,
+                             shortest_error_cache_dir: Optional[Union[str, pathlib.Path]] = None,
+                             out: Optional[TextIO] = None) -> Optional[str]:
+    """Creates an html page that steps through the layers of a circuit.
+
+    Args:
+        circuit: The circuit to show.
+        width: Width of the viewing area, in pixels.
+        height: Height of the layer images.
+        known_error: An error to highlight. Defaults to the circuit's shortest graphlike error, if
+            `highlight_shortest_error` is set.
+        collapse_repeat_blocks: When set, the layers of a REPEAT block's body are drawn once instead of
+            once per iteration. The page gets an iteration selector that relabels the detectors and
+            highlights of the block, and an option to step through every iteration in turn.
+        layer_dir: When set, layer images are written into this directory as separate svg files
+            instead of being embedded into the page, and the page only loads the layers near the
+            one being viewed. The page refers to the files by the directory's name, so it should be
+            saved into the directory's parent (see `write_stim_circuit_html_viewer`).
+        shared_background: When set, idle qubits and axis labels are drawn into one background
+            image shown behind every layer, instead of being drawn into each layer.
+        crumble_link: Whether to include a link that opens the circuit in crumble. When `layer_dir`
+            is set, the circuit is written into a separate page in that directory that forwards
+            to crumble, instead of being put into the viewer page's link.
+        crumble_max_repetitions: Caps the repetition count of REPEAT blocks in the circuit given
+            to crumble. None means no cap.
+        crumble_keep_repeat_blocks: Give crumble the circuit with its REPEAT blocks, instead of
+            flattening them.
+        highlight_shortest_error: Whether to search for the shortest graphlike error when no
+            `known_error` is given. The search runs in a worker process while the layers are drawn.
+        shortest_error_timeout: Seconds to allow the search, after which it's abandoned and no error
+            is highlighted. None means no limit.
+        shortest_error_cache_dir: When set, search results are stored in this directory, keyed by a
+            hash of the circuit, and reused when the same circuit is viewed again.
+        out: When set, the html is written into this stream as it's produced, instead of being
+            returned.
+
+    Returns:
+        The html text, or None if it was written to `out`.
+    """
+    buffer = None
+    if out is None:
+        buffer = out = io.StringIO()
+    search = None
+    if known_error is None and highlight_shortest_error:
+        search = _ShortestErrorSearch(circuit, timeout=shortest_error_timeout, cache_dir=shortest_error_cache_dir)
     state = _SvgState()
     state.detector_coords = circuit.get_detector_coordinates()
-    if known_error is None:
-        # noinspection PyBroadException
-        try:
-            known_error = circuit.shortest_graphlike_error(
-                ignore_ungraphlike_errors=True,
-                canonicalize_circuit_errors=True,
-            )
-        except Exception:
-            pass
+    _stim_circuit_to_svg_helper(circuit, state, collapse_repeat_blocks=collapse_repeat_blocks)
+
+    summary = None
     if known_error is not None:
-        for product in known_error:
-            loc = next(iter(product.circuit_error_locations))
-            for flipped in loc.flipped_pauli_product:
-                if flipped.gate_target.is_x_target:
-                    b = 'X'
-                elif flipped.gate_target.is_y_target:
-                    b = 'Y'
-                elif flipped.gate_target.is_z_target:
-                    b = 'Z'
-                else:
-                    raise NotImplementedError(repr(loc))
-                state.highlighted_errors.append((flipped.gate_target.value, loc.tick_offset, b))
-            for term in product.dem_error_terms:
-                target = term.dem_target
-                if target.is_relative_detector_id():
-                    state.highlighted_detectors.add(target.val)
-
-    _stim_circuit_to_svg_helper(circuit, state)
+        summary = _summarize_known_error(known_error)
+    elif search is not None:
+        summary = search.wait()
+    if summary is not None:
+        state.highlighted_error_ticks, detectors = summary
+        state.highlighted_detectors = set(detectors)
+    state.draw_marks()
+
     all_pos = {pt for layer in state.layers for pt in layer.used_positions}
-    while state.layers and not state.layers[-1].svg_instructions:
+    while state.layers and state.layers[-1].is_empty():
         state.layers.pop()
-    for layer in state.layers:
-        layer.add_idles(all_pos)
+    background = None
+    if shared_background:
+        # Every layer covers the same area, so the idle qubits and axis labels are drawn once
+        # underneath all of them instead of into each one.
+        background = _SvgLayer()
+        background.add_idles(all_pos)
+        for layer in state.layers:
+            layer.used_positions = all_pos
+    else:
+        for layer in state.layers:
+            layer.add_idles(all_pos)
 
-    for qubit, time, basis in state.highlighted_errors:
+    highlights = []
+    for qubit, tick, basis in state.highlighted_error_ticks:
+        time, iteration = state.layer_of_tick(tick)
+        highlights.append((qubit, time, basis, {} if iteration is None else _iteration_attributes(iteration, iteration)))
+    highlights.extend((qubit, time, basis, {}) for qubit, time, basis in state.highlighted_errors)
+    for qubit, time, basis, attributes in highlights:
         layer = state.layers[time]
         x, y = state.q2i(qubit)
         layer.add("text",
@@ -456,7 +913,8 @@ def stim_circuit_html_viewer(circuit: stim.Circuit,
                   content=basis,
                   text_anchor="middle",
                   dominant_baseline="middle",
-                  font_size=64)
+                  font_size=64,
+                  **attributes)
     for qubit, time, basis in set(state.noted_errors):
         layer = state.layers[time]
         x, y = state.q2i(qubit)
@@ -469,35 +927,145 @@ def stim_circuit_html_viewer(circuit: stim.Circuit,
                   dominant_baseline="middle",
                   font_size=12)
 
-    svg_image_tags = []
-    for k, layer in enumerate(state.layers):
-        svg = layer.svg(html_id=f"layer{k}", width=width, height=height)
-        data = base64.standard_b64encode(svg.encode('utf-8')).decode('utf-8')
-        svg_image_tags.append(
-            f'<img style="max-width: 95%; max-height: 95%; display: none" '
-            f'id=layer{k} '
-            f'src="data:image/svg+xml;base64,{data}" />'
-        )
-    all_svg_image_tags = '\n'.join(svg_image_tags)
+    if layer_dir is not None:
+        layer_dir = pathlib.Path(layer_dir)
+        layer_dir.mkdir(parents=True, exist_ok=True)
+    block_controls = ""
+    if state.blocks:
+        block_controls = """
+    <label>Iteration <input id="iteration" type="number" min="1" value="1" disabled></label>
+    <label><input id="chkExpand" type="checkbox"> Expand REPEAT blocks</label>"""
+    blocks_json = json.dumps([
+        {
+            'first': block.first_layer,
+            'last': min(block.first_layer + block.ticks_per_iteration, len(state.layers)) - 1,
+            'count': block.repeat_count,
+        }
+        for block in state.blocks
+    ])
 
-    flattened = circuit.flattened()
-    circuit_coords = [str(inst) for inst in flattened if inst.name == "QUBIT_COORDS"]
-    circuit_rest = [str(inst) for inst in flattened if inst.name != "QUBIT_COORDS"]
+    crumble_anchor = ""
+    if crumble_link:
+        url = crumble_url(circuit,
+                          max_repetitions=crumble_max_repetitions,
+                          keep_repeat_blocks=crumble_keep_repeat_blocks)
+        if layer_dir is not None:
+            # Keep the (potentially huge) circuit out of the page itself.
+            with open(layer_dir / "crumble.html", 'w') as f:
+                print(f'<script>window.location.replace({json.dumps(url)});</script>', file=f)
+            url = f"{layer_dir.name}/crumble.html"
+        crumble_anchor = f"""
+    <a href="{url}">Open in Crumble</a>"""
+
+    _write_layer_pages(out,
+                       state.layers,
+                       width=width,
+                       height=height,
+                       background=background,
+                       layer_dir=layer_dir,
+                       controls=block_controls + crumble_anchor,
+                       blocks_json=blocks_json)
+
+    if buffer is not None:
+        return buffer.getvalue()
+    return None
 
-    escaped = ';'.join(circuit_coords + circuit_rest).replace(' ', '_')
 
-    jetbrains_local_server_crumble_url = f"""http://localhost:63342/crumble/crumble.html#circuit={escaped}"""
+def write_stim_circuit_html_viewer(circuit: stim.Circuit,
+                                   path: Union[str, pathlib.Path],
+                                   **kwargs) -> None:
+    """Writes a viewer page, with its layer images in a `<name>_layers` directory next to it.
 
-    return (
-            f"""<div id="step">Loading...</div>
-    <button id="btnPrev">Previous Layer (hotkey: a)</button>
-    <button id="btnNext">Next Layer (hotkey: d)</button>
-    <a href="{jetbrains_local_server_crumble_url}">Open in Crumble</a>
+    Args:
+        circuit: The circuit to show.
+        path: Where to write the html page.
+        **kwargs: Forwarded to `stim_circuit_html_viewer`.
+    """
+    path = pathlib.Path(path)
+    with open(path, 'w') as f:
+        stim_circuit_html_viewer(circuit, layer_dir=path.parent / f"{path.stem}_layers", out=f, **kwargs)
+        f.write("\n")
+
+
+def _write_layer_pages(out: TextIO,
+                       layers: List[_SvgLayer],
+                       *,
+                       width: int,
+                       height: int,
+                       background: Optional[_SvgLayer],
+                       layer_dir: Optional[pathlib.Path],
+                       controls: str = "",
+                       blocks_json: str = "[]",
+                       layer_name: str = "Layer") -> None:
+    """Writes html that shows one layer at a time, with buttons and hotkeys for stepping between them.
+
+    Args:
+        out: Where to write the html.
+        layers: The layers to show. Layers belonging to a collapsed REPEAT block are drawn inline.
+        width: Width of the viewing area, in pixels.
+        height: Height of the layer images.
+        background: Drawn behind every layer, if set.
+        layer_dir: When set, layer images are written into this (existing) directory and loaded
+            on demand, instead of being embedded.
+        controls: Extra html placed after the stepping buttons.
+        blocks_json: The layer ranges, and repetition counts, of collapsed REPEAT blocks.
+        layer_name: What a layer is called in the stepping controls.
+    """
+    layer_class = ''
+    background_style = ''
+    if background is not None:
+        layer_class = 'class="viewer-layer" '
+        svg = background.svg(width=width, height=height)
+        if layer_dir is not None:
+            with open(layer_dir / "background.svg", 'w') as f:
+                print(svg, file=f)
+            url = f"{layer_dir.name}/background.svg"
+        else:
+            url = "data:image/svg+xml;base64," + base64.standard_b64encode(svg.encode('utf-8')).decode('utf-8')
+        background_style = f"""
+    <style>
+        .viewer-layer {{
+            background-image: url("{url}");
+            background-size: 100% 100%;
+        }}
+    </style>"""
+    out.write(f"""{background_style}<div id="step">Loading...</div>
+    <button id="btnPrev">Previous {layer_name} (hotkey: a)</button>
+    <button id="btnNext">Next {layer_name} (hotkey: d)</button>{controls}
     <div id="viewer" style="border: 1px solid black; margin-bottom: 50px; width: {width}px; 
              resize: both; overflow: auto">
-        """
-            + all_svg_image_tags
-            + """
+        """)
+    for k, layer in enumerate(layers):
+        if k:
+            out.write("\n")
+        if layer.block is not None:
+            # Drawn inline, so that the script can relabel it for each iteration of its block.
+            layer.write_svg(out,
+                            html_id=f"layer{k}",
+                            style="max-width: 95%; max-height: 95%; display: none",
+                            data_block=layer.block.index,
+                            **({} if background is None else {'class': 'viewer-layer'}))
+            continue
+        if layer_dir is not None:
+            with open(layer_dir / f"layer{k}.svg", 'w') as f:
+                layer.write_svg(f, html_id=f"layer{k}")
+                f.write("\n")
+            out.write(
+                f'<img style="max-width: 95%; max-height: 95%; display: none" '
+                f'{layer_class}id=layer{k} '
+                f'data-src="{layer_dir.name}/layer{k}.svg" />'
+            )
+            continue
+        out.write(
+            f'<img style="max-width: 95%; max-height: 95%; display: none" '
+            f'{layer_class}id=layer{k} '
+            f'src="data:image/svg+xml;base64,'
+        )
+        encoder = _Base64Writer(out)
+        layer.write_svg(encoder, html_id=f"layer{k}")
+        encoder.close()
+        out.write('" />')
+    out.write("""
 </div>
 <script>
     let layer_index = 0;
@@ -509,6 +1077,33 @@ def stim_circuit_html_viewer(circuit: stim.Circuit,
         }
         layers.push(svg);
     }
+    let blocks = """)
+    out.write(blocks_json)
+    out.write(";\n    let layerTitle = ")
+    out.write(json.dumps(layer_name))
+    out.write(""";
+    let iterations = blocks.map(() => 0);
+    let iterationInput = document.getElementById('iteration');
+    let expandCheckbox = document.getElementById('chkExpand');
+
+    function blockOf(k) {
+        let b = layers[k].dataset.block;
+        return b === undefined ? null : parseInt(b);
+    }
+
+    function applyIteration(b) {
+        let block = blocks[b];
+        let iteration = iterations[b];
+        for (let k = block.first; k <= block.last; k++) {
+            for (let e of layers[k].querySelectorAll('[data-first]')) {
+                let visible = +e.dataset.first <= iteration && iteration <= +e.dataset.last;
+                e.setAttribute('display', visible ? 'inline' : 'none');
+                if (visible && e.dataset.prefix !== undefined) {
+                    e.textContent = e.dataset.prefix + (+e.dataset.base + +e.dataset.stride * iteration);
+                }
+            }
+        }
+    }
 
     function handleLayerIndexChange() {
         if (layer_index < 0) {
@@ -519,7 +1114,25 @@ def stim_circuit_html_viewer(circuit: stim.Circuit,
         }
 
         let layerName = layer_index + 1;
-        document.getElementById('step').innerHTML = "Layer: " + layerName + "/" + layers.length;
+        let text = layerTitle + ": " + layerName + "/" + layers.length;
+        let b = blockOf(layer_index);
+        if (b !== null) {
+            text += " (REPEAT " + blocks[b].count + "&times;, iteration " + (iterations[b] + 1) + "/" + blocks[b].count + ")";
+        }
+        if (iterationInput !== null) {
+            iterationInput.disabled = b === null;
+            if (b !== null) {
+                iterationInput.max = blocks[b].count;
+                iterationInput.value = iterations[b] + 1;
+            }
+        }
+        document.getElementById('step').innerHTML = text;
+        for (let k = Math.max(layer_index - 2, 0); k < Math.min(layer_index + 3, layers.length); k++) {
+            let src = layers[k].dataset.src;
+            if (src !== undefined && !layers[k].hasAttribute('src')) {
+                layers[k].src = src;
+            }
+        }
         for (let k = 0; k < layers.length; k++) {
             let svg = layers[k];
             if (layer_index === k) {
@@ -529,26 +1142,238 @@ def stim_circuit_html_viewer(circuit: stim.Circuit,
             }
         }
     }
-    document.getElementById("btnPrev").addEventListener("click", ev => {
-        layer_index -= 1;
+
+    function stepLayer(delta) {
+        let b = blockOf(layer_index);
+        if (b !== null && expandCheckbox.checked) {
+            let block = blocks[b];
+            if (delta > 0 && layer_index === block.last && iterations[b] < block.count - 1) {
+                iterations[b] += 1;
+                applyIteration(b);
+                layer_index = block.first;
+                handleLayerIndexChange();
+                return;
+            }
+            if (delta < 0 && layer_index === block.first && iterations[b] > 0) {
+                iterations[b] -= 1;
+                applyIteration(b);
+                layer_index = block.last;
+                handleLayerIndexChange();
+                return;
+            }
+        }
+        layer_index += delta;
         handleLayerIndexChange();
+    }
+
+    if (iterationInput !== null) {
+        iterationInput.addEventListener("change", ev => {
+            let b = blockOf(layer_index);
+            if (b === null) {
+                return;
+            }
+            let iteration = parseInt(iterationInput.value) - 1;
+            if (!(iteration >= 0)) {
+                iteration = 0;
+            }
+            iterations[b] = Math.min(iteration, blocks[b].count - 1);
+            applyIteration(b);
+            handleLayerIndexChange();
+        });
+    }
+    document.getElementById("btnPrev").addEventListener("click", ev => {
+        stepLayer(-1);
     });
     document.getElementById("btnNext").addEventListener("click", ev => {
-        layer_index += 1;
-        handleLayerIndexChange();
+        stepLayer(+1);
     });
     document.addEventListener('keydown', ev => {
+        if (ev.target.tagName === "INPUT") {
+            return;
+        }
         if (ev.code == "KeyA" && !ev.getModifierState("Control")) {
-            layer_index -= 1;
             ev.preventDefault();
-            handleLayerIndexChange();
+            stepLayer(-1);
         } else if (ev.code == "KeyD") {
-            layer_index += 1;
             ev.preventDefault();
-            handleLayerIndexChange();
+            stepLayer(+1);
         }
     });
 
     handleLayerIndexChange();
-</script>"""
-    )
+</script>""")
+
+
+def _dem_graphlike_errors(model: stim.DetectorErrorModel) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """Lists the graphlike components of the errors in a detector error model.
+
+    REPEAT blocks are listed once and then tiled, instead of being iterated.
+
+    Returns:
+        A tuple (dets1, dets2, probabilities, detector_shift). The detector arrays give the ends of
+        each component's edge (relative to the start of the model), with -1 in dets2 for boundary
+        edges. detector_shift is how far the model shifts detector ids.
+    """
+    parts1, parts2, parts_p = [], [], []
+    dets1, dets2, probabilities = [], [], []
+    offset = 0
+    for instruction in model:
+        if isinstance(instruction, stim.DemRepeatBlock):
+            body1, body2, body_p, shift = _dem_graphlike_errors(instruction.body_copy())
+            starts = offset + shift * np.arange(instruction.repeat_count, dtype=np.int64)[:, np.newaxis]
+            parts1.append((body1[np.newaxis, :] + starts).ravel())
+            parts2.append(np.where(body2[np.newaxis, :] < 0, -1, body2[np.newaxis, :] + starts).ravel())
+            parts_p.append(np.tile(body_p, instruction.repeat_count))
+            offset += shift * instruction.repeat_count
+        elif instruction.type == 'shift_detectors':
+            offset += instruction.targets_copy()[0]
+        elif instruction.type == 'error':
+            p = instruction.args_copy()[0]
+            component = []
+            for t in instruction.targets_copy() + [stim.DemTarget.separator()]:
+                if t.is_separator():
+                    # Components with more than two detectors aren't edges of the matching graph.
+                    if 1 <= len(component) <= 2:
+                        dets1.append(offset + component[0])
+                        dets2.append(offset + component[1] if len(component) == 2 else -1)
+                        probabilities.append(p)
+                    component = []
+                elif t.is_relative_detector_id():
+                    component.append(t.val)
+    parts1.append(np.array(dets1, dtype=np.int64))
+    parts2.append(np.array(dets2, dtype=np.int64))
+    parts_p.append(np.array(probabilities, dtype=np.float64))
+    return np.concatenate(parts1), np.concatenate(parts2), np.concatenate(parts_p), offset
+
+
+def dem_matching_graph(dem: stim.DetectorErrorModel) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Determines the edges of a detector error model's matching graph.
+
+    Args:
+        dem: The detector error model. Errors should be decomposed into graphlike components (e.g.
+            made with `decompose_errors=True`); components with more than two detectors are ignored.
+
+    Returns:
+        A tuple (dets1, dets2, probabilities), with one entry per edge. dets1 < dets2 except for
+        boundary edges, which have dets2 = -1. Parallel components are merged into one edge whose
+        probability is the chance that an odd number of them occurred.
+    """
+    dets1, dets2, probabilities, _ = _dem_graphlike_errors(dem)
+    lo = np.where(dets2 < 0, dets1, np.minimum(dets1, dets2))
+    hi = np.where(dets2 < 0, -1, np.maximum(dets1, dets2))
+    edges, inverse = np.unique(np.stack([lo, hi], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    with np.errstate(divide='ignore'):
+        log_parity = np.zeros(len(edges))
+        np.add.at(log_parity, inverse, np.log(np.abs(1 - 2 * probabilities)))
+    return edges[:, 0], edges[:, 1], (1 - np.exp(log_parity)) / 2
+
+
+def dem_matching_graph_html_viewer(dem: stim.DetectorErrorModel,
+                                   *,
+                                   width: int = 500,
+                                   height: int = 500,
+                                   layer_dir: Optional[Union[str, pathlib.Path]] = None,
+                                   out: Optional[TextIO] = None) -> Optional[str]:
+    """Creates an html page that steps through the time slices of a detector error model's matching graph.
+
+    Detectors are drawn at their (x, y) coordinates, with one page per distinct t coordinate. Each
+    page shows the edges touching its detectors. Edges within the time slice are solid, edges to
+    other time slices are dashed lines towards the other detector's position, and boundary edges
+    are red stubs pointing away from the middle of the patch. Likelier edges are drawn thicker, and
+    hovering over an edge or detector shows its details.
+
+    Args:
+        dem: The detector error model, e.g. from `circuit.detector_error_model(decompose_errors=True)`.
+        width: Width of the viewing area, in pixels.
+        height: Height of the page images.
+        layer_dir: When set, page images are written into this directory as separate svg files
+            and loaded on demand (see `stim_circuit_html_viewer`).
+        out: When set, the html is written into this stream instead of being returned.
+
+    Returns:
+        The html text, or None if it was written to `out`.
+    """
+    buffer = None
+    if out is None:
+        buffer = out = io.StringIO()
+
+    num_detectors = dem.num_detectors
+    coords = np.full((num_detectors, 3), np.nan)
+    for k, c in dem.get_detector_coordinates().items():
+        c = list(c)[:3]
+        coords[k, :len(c)] = c
+    coords[np.isnan(coords)] = 0
+    pos = coords[:, :2] * PITCH
+    times, slices = np.unique(coords[:, 2], return_inverse=True)
+    slices = slices.ravel()
+
+    dets1, dets2, probabilities = dem_matching_graph(dem)
+    boundary = dets2 < 0
+    other = np.where(boundary, dets1, dets2)
+    with np.errstate(divide='ignore'):
+        weights = np.log((1 - probabilities) / probabilities)
+    finite = np.isfinite(weights)
+    min_w = np.min(weights[finite], initial=0)
+    max_w = np.max(weights[finite], initial=1)
+    stroke_widths = 2 + 8 * (max_w - np.clip(weights, min_w, max_w)) / max(max_w - min_w, 1e-9)
+
+    # Boundary edges stick out of their detector, away from the middle of the patch.
+    center = np.mean(pos, axis=0) if num_detectors else np.zeros(2)
+    outward = pos[dets1] - center
+    norms = np.linalg.norm(outward, axis=1, keepdims=True)
+    outward = np.where(norms > 0, outward / np.where(norms > 0, norms, 1), np.array([0.0, -1.0]))
+    ends = np.where(boundary[:, np.newaxis], pos[dets1] + outward * PITCH / 2, pos[other])
+
+    all_pos = {(float(x), float(y)) for x, y in pos}
+    all_pos |= {(float(x), float(y)) for x, y in ends}
+    layers = [_SvgLayer() for _ in times]
+    for layer in layers:
+        layer.used_positions = all_pos
+
+    slice1 = slices[dets1]
+    slice2 = slices[other]
+    for e in np.argsort(stroke_widths, kind='stable'):
+        a, b = int(dets1[e]), int(dets2[e])
+        (x1, y1), (x2, y2) = pos[a], ends[e]
+        title = f"D{a}-{'boundary' if b < 0 else f'D{b}'} p={probabilities[e]:.3g} w={weights[e]:.3g}"
+        kwargs = dict(x1=x1, y1=y1, x2=x2, y2=y2, stroke_width=f"{stroke_widths[e]:.2f}")
+        if b < 0:
+            layers[slice1[e]].add("line", stroke="red", **kwargs, content=f"<title>{title}</title>")
+        elif slice1[e] == slice2[e]:
+            layers[slice1[e]].add("line", stroke="black", **kwargs, content=f"<title>{title}</title>")
+        else:
+            for s, (xa, ya, xb, yb) in [(slice1[e], (x1, y1, x2, y2)), (slice2[e], (x2, y2, x1, y1))]:
+                layers[s].add("line",
+                              x1=xa,
+                              y1=ya,
+                              x2=xb,
+                              y2=yb,
+                              stroke="blue",
+                              stroke_width=f"{stroke_widths[e]:.2f}",
+                              stroke_dasharray="8,8",
+                              content=f"<title>{title}</title>")
+    for d in range(num_detectors):
+        x, y = pos[d]
+        layers[slices[d]].add("circle",
+                              cx=x,
+                              cy=y,
+                              r=RAD / 2,
+                              fill="white",
+                              stroke="black",
+                              content=f"<title>D{d} {tuple(coords[d])}</title>")
+
+    if layer_dir is not None:
+        layer_dir = pathlib.Path(layer_dir)
+        layer_dir.mkdir(parents=True, exist_ok=True)
+    _write_layer_pages(out,
+                       layers,
+                       width=width,
+                       height=height,
+                       background=None,
+                       layer_dir=layer_dir,
+                       layer_name="Time Slice")
+
+    if buffer is not None:
+        return buffer.getvalue()
+    return None
@@ -0,0 +1,155 @@
+import base64
+import collections
+import pathlib
+import re
+import xml.etree.ElementTree
+from typing import Dict, List, Optional
+
+import numpy as np
+import pytest
+import stim
+
+import _viewer
+from _viewer import _ShortestErrorSearch, dem_matching_graph, stim_circuit_html_viewer
+from main import make_noisy_heavy_hex_circuit
+
+REPEAT_CIRCUIT = stim.Circuit("""
+    QUBIT_COORDS(0, 0) 0
+    QUBIT_COORDS(1, 0) 1
+    R 0 1
+    TICK
+    REPEAT 3 {
+        CX 0 1
+        TICK
+        M 1
+        DETECTOR(1, 0) rec[-1]
+        TICK
+    }
+    M 0
+    DETECTOR(0, 0) rec[-1] rec[-2]
+""")
+
+
+def _layer_svgs(html: str, page_dir: Optional[pathlib.Path] = None) -> List[xml.etree.ElementTree.Element]:
+    """Extracts the layer images of a viewer page, whether inline, embedded or in separate files."""
+    svgs: Dict[int, str] = {}
+    for svg, k in re.findall(r"(<svg [^>]*id='layer(\d+)'.*?</svg>)", html, re.DOTALL):
+        svgs[int(k)] = svg
+    for k, data in re.findall(r'id=layer(\d+) src="data:image/svg\+xml;base64,([^"]*)"', html):
+        svgs[int(k)] = base64.standard_b64decode(data).decode('utf8')
+    for k, src in re.findall(r'id=layer(\d+) data-src="([^"]*)"', html):
+        svgs[int(k)] = (page_dir / src).read_text()
+    assert sorted(svgs) == list(range(len(svgs)))
+    return [xml.etree.ElementTree.fromstring(svgs[k]) for k in range(len(svgs))]
+
+
+def _drawn(layer: xml.etree.ElementTree.Element, iteration: Optional[int] = None) -> collections.Counter:
+    """The elements of a layer, as shown at an iteration of its REPEAT block (as the page's script shows them)."""
+    result = collections.Counter()
+    for e in layer:
+        text = e.text
+        if 'data-first' in e.attrib:
+            if not int(e.attrib['data-first']) <= iteration <= int(e.attrib['data-last']):
+                continue
+            if 'data-prefix' in e.attrib:
+                text = e.attrib['data-prefix'] + str(int(e.attrib['data-base']) + int(e.attrib['data-stride']) * iteration)
+        attributes = {k: v for k, v in e.attrib.items() if not k.startswith('data-') and k != 'display'}
+        result[(e.tag.split('}')[-1], tuple(sorted(attributes.items())), text)] += 1
+    return result
+
+
+def test_dem_matching_graph_tiles_repeat_blocks():
+    circuit = make_noisy_heavy_hex_circuit(
+        diam=3,
+        time_boundary_basis='X',
+        rounds=6,
+        noise=1e-3,
+        gate_set='cx',
+    )
+    dets1, dets2, probabilities = dem_matching_graph(circuit.detector_error_model(decompose_errors=True))
+    flat1, flat2, flat_probabilities = dem_matching_graph(
+        circuit.flattened().detector_error_model(decompose_errors=True))
+
+    np.testing.assert_array_equal(dets1, flat1)
+    np.testing.assert_array_equal(dets2, flat2)
+    np.testing.assert_allclose(probabilities, flat_probabilities, rtol=1e-9)
+    assert np.any(dets2 == -1)
+    assert np.all((dets1 < dets2) | (dets2 == -1))
+
+
+def test_collapsed_repeat_blocks_match_unrolled_layers():
+    kwargs = dict(highlight_shortest_error=False, crumble_link=False)
+    collapsed = _layer_svgs(stim_circuit_html_viewer(REPEAT_CIRCUIT, **kwargs))
+    unrolled = _layer_svgs(stim_circuit_html_viewer(REPEAT_CIRCUIT, collapse_repeat_blocks=False, **kwargs))
+    assert len(collapsed) == 4
+    assert len(unrolled) == 8
+    assert [layer.get('data-block') for layer in collapsed] == [None, '0', '0', None]
+
+    assert _drawn(collapsed[0]) == _drawn(unrolled[0])
+    assert _drawn(collapsed[3]) == _drawn(unrolled[7])
+    for iteration in range(3):
+        for offset in range(2):
+            assert _drawn(collapsed[1 + offset], iteration) == _drawn(unrolled[1 + 2 * iteration + offset])
+    # The final detector compares against the block's last measurement, so only shows up in the last iteration.
+    labels = [text for (tag, _, text) in _drawn(collapsed[2], 2) if tag == 'text']
+    assert sorted(labels) == ['D2', 'D3', 'M']
+
+
+def test_layer_dir_pages_load_the_same_layers_from_files(tmp_path: pathlib.Path):
+    kwargs = dict(highlight_shortest_error=False, collapse_repeat_blocks=False)
+    embedded = stim_circuit_html_viewer(REPEAT_CIRCUIT, **kwargs)
+    paged = stim_circuit_html_viewer(REPEAT_CIRCUIT, layer_dir=tmp_path / 'page_layers', **kwargs)
+
+    assert 'base64' not in paged
+    assert 'page_layers/crumble.html' in paged
+    assert 'page_layers/background.svg' in paged
+    assert sorted(e.name for e in (tmp_path / 'page_layers').iterdir()) == sorted(
+        ['background.svg', 'crumble.html'] + [f'layer{k}.svg' for k in range(8)])
+    # Layers are only loaded once they're near the viewed one.
+    assert ' src=' not in paged.split('<script>')[0]
+    assert ([xml.etree.ElementTree.tostring(e) for e in _layer_svgs(paged, tmp_path)]
+            == [xml.etree.ElementTree.tostring(e) for e in _layer_svgs(embedded)])
+
+
+def test_shared_background_holds_the_idles_and_axis_labels_of_every_layer():
+    kwargs = dict(highlight_shortest_error=False, crumble_link=False, collapse_repeat_blocks=False)
+    shared_html = stim_circuit_html_viewer(REPEAT_CIRCUIT, **kwargs)
+    separate_html = stim_circuit_html_viewer(REPEAT_CIRCUIT, shared_background=False, **kwargs)
+    assert 'viewer-layer' not in separate_html
+    background_data, = re.findall(r'url\("data:image/svg\+xml;base64,([^"]*)"\)', shared_html)
+    background = _drawn(xml.etree.ElementTree.fromstring(base64.standard_b64decode(background_data)))
+    idles = collections.Counter({e: n for e, n in background.items() if e[0] == 'circle'})
+    assert sum(idles.values()) == 2
+
+    shared = _layer_svgs(shared_html)
+    separate = _layer_svgs(separate_html)
+    assert len(shared) == len(separate)
+    num_idles = []
+    for shared_layer, separate_layer in zip(shared, separate):
+        shared_drawn = _drawn(shared_layer)
+        separate_drawn = _drawn(separate_layer)
+        assert not shared_drawn & background
+        # Drawing into each layer adds the axis labels, and the idles of the qubits the layer doesn't use.
+        extra = separate_drawn - shared_drawn
+        assert shared_drawn + extra == separate_drawn
+        assert extra - idles == background - idles
+        num_idles.append(sum((extra & idles).values()))
+    # Only the measurement layers leave a qubit idle.
+    assert num_idles == [0, 0, 1, 0, 1, 0, 1, 1]
+
+
+def _crashing_shortest_error_worker(circuit_text, connection) -> None:
+    connection.close()
+
+
+def test_shortest_error_search_only_caches_answers(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    circuit = make_noisy_heavy_hex_circuit(diam=3, time_boundary_basis='Z', rounds=3, noise=1e-3, gate_set='cx')
+    with monkeypatch.context() as m:
+        m.setattr(_viewer, '_shortest_error_worker', _crashing_shortest_error_worker)
+        assert _ShortestErrorSearch(circuit, timeout=None, cache_dir=tmp_path).wait() is None
+    assert list(tmp_path.iterdir()) == []
+
+    summary = _ShortestErrorSearch(circuit, timeout=None, cache_dir=tmp_path).wait()
+    assert summary is not None
+    assert len(list(tmp_path.iterdir())) == 1
+    assert _ShortestErrorSearch(circuit, timeout=None, cache_dir=tmp_path).wait() == summary
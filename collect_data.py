@@ -0,0 +1,152 @@
+import argparse
+import itertools
+import pathlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import sinter
+import stim
+
+from _decoders import register_decoders, summarize_decoder_timings
+from _dem_cache import DemCache, DEFAULT_DEM_CACHE_DIR
+from _schedule import Allocation, plan_round, sweep_points
+from _stats import load_stats
+from _trace import labels, record_model_labels
+
+register_decoders()
+
+
+def iter_tasks(circuit_paths: List[pathlib.Path],
+               dem_cache: DemCache,
+               *,
+               decoder: Optional[str] = None,
+               allocations: Optional[Dict[Tuple, Allocation]] = None) -> Iterator[sinter.Task]:
+    """Yields a sinter task per circuit, with its error model read from the cache instead of rederived.
+
+    When allocations are given, only circuits with an allocation for the decoder are yielded, with
+    the allocation as their collection budget.
+    """
+    for path in circuit_paths:
+        metadata = sinter.comma_separated_key_values(str(path))
+        options = sinter.CollectionOptions()
+        if allocations is not None:
+            allocation = allocations.get((metadata['b'], metadata['g'], decoder, metadata['d'], metadata['p'], metadata['r']))
+            if allocation is None:
+                continue
+            options = sinter.CollectionOptions(max_shots=allocation.max_shots, max_errors=allocation.max_errors)
+        circuit = stim.Circuit.from_file(path)
+        with labels(**metadata):
+            model = dem_cache.detector_error_model(circuit)
+        record_model_labels(model, **metadata)
+        yield sinter.Task(
+            circuit=circuit,
+            detector_error_model=model,
+            json_metadata=metadata,
+            collection_options=options,
+        )
+
+
+def collect_to_target_precision(*,
+                                circuit_paths: List[pathlib.Path],
+                                decoders: List[str],
+                                dem_cache: DemCache,
+                                num_workers: int,
+                                save_resume_filepath: pathlib.Path,
+                                target_relative_error: float,
+                                round_shots: int,
+                                max_shots: int,
+                                max_errors: int) -> None:
+    """Collects in rounds, giving each round's shots to the points that most tighten the fits.
+
+    Before each round the statistics saved so far are reloaded and `_schedule.plan_round` decides
+    every point's budget. Stops once every point has reached the target relative error on its
+    per round logical error rate (or run out of budget).
+    """
+    sweep = [sinter.comma_separated_key_values(str(path)) for path in circuit_paths]
+    for round_index in itertools.count():
+        table = load_stats(save_resume_filepath) if save_resume_filepath.exists() else None
+        allocations = plan_round(
+            sweep_points(sweep, decoders, table),
+            target_relative_error=target_relative_error,
+            round_shots=round_shots,
+            max_shots=max_shots,
+            max_errors=max_errors,
+        )
+        if not allocations:
+            break
+        print(f"round {round_index}: collecting {len(allocations)} points below the target precision")
+        for decoder in decoders:
+            tasks = list(iter_tasks(circuit_paths, dem_cache, decoder=decoder, allocations=allocations))
+            if not tasks:
+                continue
+            sinter.collect(
+                num_workers=num_workers,
+                tasks=tasks,
+                decoders=[decoder],
+                save_resume_filepath=save_resume_filepath,
+                print_progress=True,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collects statistics like `sinter collect`, reusing cached detector error models.")
+    parser.add_argument('--circuits', type=pathlib.Path, nargs='+', required=True)
+    parser.add_argument('--decoders', type=str, nargs='+', required=True)
+    parser.add_argument('--processes', type=int, required=True)
+    parser.add_argument('--max_shots', type=int, required=True)
+    parser.add_argument('--max_errors', type=int, required=True)
+    parser.add_argument('--target_relative_error',
+                        type=float,
+                        default=None,
+                        help='Instead of giving every circuit the same budget, collect in rounds until each '
+                             'point\'s logical error rate per round has this relative standard error, '
+                             'prioritizing the points that most tighten the line and threshold fits. '
+                             '--max_shots and --max_errors then cap each point. Requires '
+                             '--save_resume_filepath.')
+    parser.add_argument('--round_shots',
+                        type=int,
+                        default=1_000_000,
+                        help='Shots split between the points of each round, when using --target_relative_error.')
+    parser.add_argument('--save_resume_filepath', type=pathlib.Path, default=None)
+    parser.add_argument('--dem_cache_dir', type=pathlib.Path, default=DEFAULT_DEM_CACHE_DIR)
+    parser.add_argument('--decoder_timings',
+                        type=pathlib.Path,
+                        default=None,
+                        help='Appends the build and decode time of every decoding call (of decoders '
+                             'defined in this repository) to this file, and prints a summary at the end.')
+    args = parser.parse_args()
+    if args.target_relative_error is not None and args.save_resume_filepath is None:
+        parser.error('--target_relative_error requires --save_resume_filepath')
+    if args.decoder_timings is not None:
+        register_decoders(timings_path=args.decoder_timings)
+
+    dem_cache = DemCache(args.dem_cache_dir)
+    if args.target_relative_error is not None:
+        collect_to_target_precision(
+            circuit_paths=args.circuits,
+            decoders=args.decoders,
+            dem_cache=dem_cache,
+            num_workers=args.processes,
+            save_resume_filepath=args.save_resume_filepath,
+            target_relative_error=args.target_relative_error,
+            round_shots=args.round_shots,
+            max_shots=args.max_shots,
+            max_errors=args.max_errors,
+        )
+    else:
+        sinter.collect(
+            num_workers=args.processes,
+            tasks=iter_tasks(args.circuits, dem_cache),
+            hint_num_tasks=len(args.circuits),
+            decoders=args.decoders,
+            max_shots=args.max_shots,
+            max_errors=args.max_errors,
+            save_resume_filepath=args.save_resume_filepath,
+            print_progress=True,
+        )
+    if args.decoder_timings is not None and args.decoder_timings.exists():
+        print(summarize_decoder_timings(args.decoder_timings))
+
+
+if __name__ == '__main__':
+    main()
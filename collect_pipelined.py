@@ -0,0 +1,66 @@
+import argparse
+import pathlib
+import sys
+
+import sinter
+
+from _decoders import register_decoders
+from _dem_cache import DEFAULT_DEM_CACHE_DIR
+from _pipeline import collect_pipelined
+
+register_decoders()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collects statistics like `sinter collect`, but with separate pools of sampling and "
+                    "decoding processes that hand shots over through shared memory.")
+    parser.add_argument('--circuits', type=pathlib.Path, nargs='+', required=True)
+    parser.add_argument('--decoders', type=str, nargs='+', required=True)
+    parser.add_argument('--max_shots', type=int, required=True)
+    parser.add_argument('--max_errors', type=int, required=True)
+    parser.add_argument('--samplers', type=int, required=True, help='Number of sampling processes.')
+    parser.add_argument('--decoder_processes', type=int, required=True, help='Number of decoding processes.')
+    parser.add_argument('--slots_per_sampler',
+                        type=int,
+                        default=4,
+                        help='Batches each sampler can have waiting to be decoded before it pauses.')
+    parser.add_argument('--save_resume_filepath',
+                        type=pathlib.Path,
+                        default=None,
+                        help='Csv file the statistics are appended to (and counted towards the budgets). '
+                             'Defaults to printing them to stdout.')
+    parser.add_argument('--dem_cache_dir', type=pathlib.Path, default=DEFAULT_DEM_CACHE_DIR)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    existing = []
+    if args.save_resume_filepath is not None and args.save_resume_filepath.exists():
+        existing = sinter.stats_from_csv_files(args.save_resume_filepath)
+        out = open(args.save_resume_filepath, 'a')
+    else:
+        out = sys.stdout if args.save_resume_filepath is None else open(args.save_resume_filepath, 'w')
+        print(sinter.CSV_HEADER, file=out, flush=True)
+    try:
+        totals = collect_pipelined(
+            circuit_paths=args.circuits,
+            decoders=args.decoders,
+            max_shots=args.max_shots,
+            max_errors=args.max_errors,
+            num_samplers=args.samplers,
+            num_decoder_workers=args.decoder_processes,
+            dem_cache_dir=args.dem_cache_dir,
+            existing_stats=existing,
+            slots_per_sampler=args.slots_per_sampler,
+            seed=args.seed,
+            on_stats=lambda stats: print(stats.to_csv_line(), file=out, flush=True),
+        )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    for stats in totals.values():
+        print(f"{stats.decoder} {stats.json_metadata}: {stats.errors} errors in {stats.shots} shots", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
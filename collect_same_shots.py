@@ -0,0 +1,89 @@
+import argparse
+import concurrent.futures
+import pathlib
+import sys
+from typing import List, Optional, Tuple
+
+import sinter
+import stim
+
+from _decoders import register_decoders
+from _dem_cache import DemCache
+from _syndromes import SyndromeStore, decode_syndromes, sample_syndromes
+from _trace import labels
+
+register_decoders()
+
+
+def _sample_job(circuit_path: pathlib.Path, store_dir: pathlib.Path, num_shots: int, seed: Optional[int]) -> str:
+    circuit = stim.Circuit.from_file(circuit_path)
+    with labels(**sinter.comma_separated_key_values(str(circuit_path))):
+        store = sample_syndromes(circuit, store_dir, num_shots=num_shots, seed=seed)
+    return f'{store.num_shots} shots of {circuit_path.name}'
+
+
+def _decode_job(circuit_path: pathlib.Path, store_dir: pathlib.Path, decoder: str) -> sinter.TaskStats:
+    circuit = stim.Circuit.from_file(circuit_path)
+    store = SyndromeStore.open(store_dir)
+    metadata = sinter.comma_separated_key_values(str(circuit_path))
+    with labels(**metadata):
+        return decode_syndromes(
+            store,
+            circuit=circuit,
+            decoder=decoder,
+            json_metadata=metadata,
+            detector_error_model=DemCache().detector_error_model(circuit),
+        )
+
+
+def _run_all(jobs: List[Tuple], func, num_workers: int):
+    if num_workers <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+        yield from pool.map(func, *zip(*jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Samples each circuit once, then decodes the same shots with every decoder.")
+    parser.add_argument('--circuits', type=pathlib.Path, nargs='+', required=True)
+    parser.add_argument('--decoders', type=str, nargs='+', required=True)
+    parser.add_argument('--shots', type=int, required=True)
+    parser.add_argument('--syndrome_dir',
+                        type=pathlib.Path,
+                        default=pathlib.Path('out/syndromes'),
+                        help='Where the sampled shots are stored, one sub directory per circuit.')
+    parser.add_argument('--out',
+                        type=pathlib.Path,
+                        default=None,
+                        help='Csv file the statistics are written to. Defaults to stdout.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='Seeds the samplers. The k-th circuit is sampled with seed + k.')
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    store_dirs = {path: args.syndrome_dir / path.stem for path in args.circuits}
+    sample_jobs = [
+        (path, store_dirs[path], args.shots, None if args.seed is None else args.seed + k)
+        for k, path in enumerate(args.circuits)
+    ]
+    for message in _run_all(sample_jobs, _sample_job, args.processes):
+        print("sampled", message, file=sys.stderr)
+
+    decode_jobs = [(path, store_dirs[path], decoder) for path in args.circuits for decoder in args.decoders]
+    out = sys.stdout if args.out is None else open(args.out, 'w')
+    try:
+        print(sinter.CSV_HEADER, file=out)
+        for stats in _run_all(decode_jobs, _decode_job, args.processes):
+            print(stats.to_csv_line(), file=out, flush=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import argparse
+import pathlib
+
+from _stats import load_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Folds new rows of the collected statistics into their aggregated columnar store.")
+    parser.add_argument('--in', dest='in_path', type=pathlib.Path, default=pathlib.Path('out/stats.csv'))
+    parser.add_argument('--out',
+                        type=pathlib.Path,
+                        default=None,
+                        help='Where the store is kept. Defaults to the input path with an .npz extension.')
+    args = parser.parse_args()
+
+    table = load_stats(args.in_path, store_path=args.out)
+    print(f"{len(table)} tasks, {int(table['shots'].sum())} shots, {table.source_bytes} bytes of csv absorbed")
+
+
+if __name__ == '__main__':
+    main()
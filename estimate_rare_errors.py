@@ -0,0 +1,91 @@
+import argparse
+import csv
+import dataclasses
+import pathlib
+import sys
+
+import sinter
+import stim
+
+from _decoders import register_decoders
+from _dem_cache import DemCache
+from _importance import ImportanceEstimate, importance_sample_logical_error_rate, suggest_biased_noise
+from _trace import labels
+from main import make_noisy_heavy_hex_circuit
+
+register_decoders()
+
+CSV_COLUMNS = ['d', 'p', 'b', 'g', 'r', 'decoder', 'biased_p'] + [
+    field.name for field in dataclasses.fields(ImportanceEstimate)
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimates low logical error rates by sampling the same circuits at a larger noise "
+                    "strength and reweighting the shots by likelihood ratio.")
+    parser.add_argument('--circuits',
+                        type=pathlib.Path,
+                        nargs='+',
+                        required=True,
+                        help='Circuits written by main.py (their file names give the parameters).')
+    parser.add_argument('--decoders', type=str, nargs='+', required=True)
+    parser.add_argument('--shots', type=int, required=True)
+    parser.add_argument('--biased_p',
+                        type=float,
+                        default=None,
+                        help='Noise strength to sample at. Defaults to one that adds about (d+1)/2 faults per shot.')
+    parser.add_argument('--target_fraction',
+                        type=float,
+                        default=0.25,
+                        help='Fraction of shots sampled at the circuit\'s own noise strength.')
+    parser.add_argument('--out',
+                        type=pathlib.Path,
+                        default=None,
+                        help='Csv file the estimates are written to. Defaults to stdout.')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    dem_cache = DemCache()
+    out = sys.stdout if args.out is None else open(args.out, 'w')
+    try:
+        writer = csv.DictWriter(out, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        for path in args.circuits:
+            metadata = sinter.comma_separated_key_values(str(path))
+            with labels(**metadata):
+                target_model = dem_cache.detector_error_model(stim.Circuit.from_file(path))
+                biased_p = args.biased_p
+                if biased_p is None:
+                    biased_p = suggest_biased_noise(target_model=target_model, noise=metadata['p'], distance=metadata['d'])
+                biased_circuit = make_noisy_heavy_hex_circuit(
+                    diam=metadata['d'],
+                    time_boundary_basis=metadata['b'],
+                    rounds=metadata['r'],
+                    noise=biased_p,
+                    gate_set=metadata['g'],
+                )
+                biased_model = dem_cache.detector_error_model(biased_circuit)
+                for decoder in args.decoders:
+                    estimate = importance_sample_logical_error_rate(
+                        target_model=target_model,
+                        biased_model=biased_model,
+                        decoder=decoder,
+                        shots=args.shots,
+                        target_fraction=args.target_fraction,
+                        seed=args.seed,
+                    )
+                    writer.writerow({
+                        **{key: metadata[key] for key in 'dpbgr'},
+                        'decoder': decoder,
+                        'biased_p': biased_p,
+                        **dataclasses.asdict(estimate),
+                    })
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import collections
+import concurrent.futures
+import csv
+import dataclasses
+import hashlib
+import json
+import math
+import pathlib
+from typing import List, Dict, Tuple, Optional, Any
+
+import numpy as np
+import sinter
+
+from _stats import load_stats
+from _util import fit_binomial_line
+
+# How each kind of line is fit. The x coordinate of a data point is derived from its
+# metadata. Lines must slope downward, so the physical error rate enters as -ln(p).
+FIT_AXES = {
+    'd': dict(min_x_lim=0, max_x_lim=20, min_p_lim=1e-30, max_p_lim=1),
+    'p': dict(min_x_lim=-math.log(0.05), max_x_lim=-math.log(1e-5), min_p_lim=1e-30, max_p_lim=1),
+}
+MAX_LIKELIHOOD_FACTOR = 1000
+
+
+@dataclasses.dataclass(frozen=True)
+class LineGroup:
+    """Data points that a line is fit to.
+
+    For axis 'd', the points are different patch diameters at a fixed physical error rate.
+    For axis 'p', the points are different physical error rates at a fixed patch diameter.
+    In both cases the number of rounds per diameter is fixed too (sweeps scale the rounds with the
+    diameter), so data taken at other round counts gets lines of its own.
+    """
+    axis: str
+    b: str
+    g: str
+    decoder: str
+    fixed: float
+    rounds_per_diameter: float
+    xs: Tuple[float, ...]
+    shots: Tuple[int, ...]
+    errors: Tuple[int, ...]
+
+    @property
+    def key(self) -> str:
+        return f'{self.axis},{self.b},{self.g},{self.decoder},{self.fixed},{self.rounds_per_diameter}'
+
+    def data_hash(self) -> str:
+        text = json.dumps([self.xs, self.shots, self.errors, FIT_AXES[self.axis], MAX_LIKELIHOOD_FACTOR])
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+@dataclasses.dataclass(frozen=True)
+class LineFit:
+    """A fit line ln(logical error rate) = offset + slope * x, with the ranges covered by its likelihood band."""
+    axis: str
+    b: str
+    g: str
+    decoder: str
+    fixed: float
+    rounds_per_diameter: float
+    num_points: int
+    slope: float
+    offset: float
+    min_slope: float
+    max_slope: float
+    min_offset: float
+    max_offset: float
+    log_likelihood: float
+
+
+@dataclasses.dataclass(frozen=True)
+class ThresholdEstimate:
+    """Physical error rates where the p-axis lines of consecutive patch diameters cross."""
+    b: str
+    g: str
+    decoder: str
+    rounds_per_diameter: float
+    threshold: float
+    min_threshold: float
+    max_threshold: float
+    num_crossings: int
+
+
+def line_groups(stats_path: pathlib.Path) -> List[LineGroup]:
+    """Loads the collected statistics once, and splits them into every group that gets a line fit."""
+    table = load_stats(stats_path)
+    totals: Dict[tuple, List[int]] = collections.defaultdict(lambda: [0, 0])
+    for b, g, p, d, r, decoder, shots, discards, errors in zip(
+            table['b'], table['g'], table['p'], table['d'], table['r'], table['decoder'],
+            table['shots'], table['discards'], table['errors']):
+        total = totals[(str(b), str(g), float(p), int(d), int(r), str(decoder))]
+        total[0] += int(shots - discards)
+        total[1] += int(errors)
+    points = []
+    for (b, g, p, d, r, decoder), (shots, errors) in totals.items():
+        if shots:
+            points.append(dict(b=b, g=g, p=p, d=d, r=r, decoder=decoder, shots=shots, errors=errors))
+
+    result = []
+    for axis in FIT_AXES:
+        fixed_key = 'p' if axis == 'd' else 'd'
+        grouped = sinter.group_by(points, key=lambda e: (e['b'], e['g'], e['decoder'], e[fixed_key], e['r'] / e['d']))
+        for (b, g, decoder, fixed, rounds_per_diameter), group_points in sorted(grouped.items()):
+            xs = [float(e['d']) if axis == 'd' else -math.log(e['p']) for e in group_points]
+            order = np.argsort(xs, kind='stable')
+            result.append(LineGroup(
+                axis=axis,
+                b=b,
+                g=g,
+                decoder=decoder,
+                fixed=fixed,
+                rounds_per_diameter=rounds_per_diameter,
+                xs=tuple(xs[k] for k in order),
+                shots=tuple(int(group_points[k]['shots']) for k in order),
+                errors=tuple(int(group_points[k]['errors']) for k in order),
+            ))
+    return result
+
+
+def fit_group(group: LineGroup) -> Optional[LineFit]:
+    """Fits a line to a group's data points. Returns None if the group can't constrain a line."""
+    if len(group.xs) < 2 or not any(group.errors):
+        return None
+    fit = fit_binomial_line(
+        **FIT_AXES[group.axis],
+        xs=list(group.xs),
+        shots=list(group.shots),
+        errors=list(group.errors),
+        max_likelihood_factor=MAX_LIKELIHOOD_FACTOR,
+        adaptive=True,
+        num_threads=1,
+    )
+    return LineFit(
+        axis=group.axis,
+        b=group.b,
+        g=group.g,
+        decoder=group.decoder,
+        fixed=group.fixed,
+        rounds_per_diameter=group.rounds_per_diameter,
+        num_points=len(group.xs),
+        slope=float(fit.best_slope),
+        offset=float(fit.best_offset),
+        min_slope=float(np.min(fit.slopes)),
+        max_slope=float(np.max(fit.slopes)),
+        min_offset=float(np.min(fit.offsets)),
+        max_offset=float(np.max(fit.offsets)),
+        log_likelihood=float(fit.max_log_likelihood),
+    )
+
+
+def fit_groups(groups: List[LineGroup],
+               *,
+               cache_path: Optional[pathlib.Path],
+               num_workers: Optional[int]) -> List[LineFit]:
+    """Fits every group, reusing cached fits for groups whose data hasn't changed since they were fit.
+
+    Groups that need fitting are spread over a process pool. The cache is rewritten to
+    contain exactly the given groups.
+    """
+    cache = {}
+    if cache_path is not None and cache_path.exists():
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    hashes = {group.key: group.data_hash() for group in groups}
+    fits: Dict[str, Optional[LineFit]] = {}
+    stale = []
+    for group in groups:
+        entry = cache.get(group.key)
+        if entry is not None and entry['hash'] == hashes[group.key]:
+            fits[group.key] = None if entry['fit'] is None else LineFit(**entry['fit'])
+        else:
+            stale.append(group)
+
+    if stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for group, fit in zip(stale, pool.map(fit_group, stale)):
+                fits[group.key] = fit
+        print(f"fit {len(stale)} groups ({len(groups) - len(stale)} unchanged)")
+
+    if cache_path is not None:
+        new_cache = {
+            key: {'hash': hashes[key], 'fit': None if fit is None else dataclasses.asdict(fit)}
+            for key, fit in fits.items()
+        }
+        with open(cache_path, 'w') as f:
+            json.dump(new_cache, f, indent=1)
+
+    return [fits[group.key] for group in groups if fits[group.key] is not None]
+
+
+def estimate_thresholds(fits: List[LineFit]) -> List[ThresholdEstimate]:
+    """Estimates thresholds from where the p-axis lines of consecutive patch diameters cross."""
+    grouped = sinter.group_by([fit for fit in fits if fit.axis == 'p'],
+                              key=lambda e: (e.b, e.g, e.decoder, e.rounds_per_diameter))
+    result = []
+    for (b, g, decoder, rounds_per_diameter), group in sorted(grouped.items()):
+        group = sorted(group, key=lambda e: e.fixed)
+        crossings = []
+        for f1, f2 in zip(group, group[1:]):
+            if f1.slope == f2.slope:
+                continue
+            x = (f2.offset - f1.offset) / (f1.slope - f2.slope)
+            crossings.append(math.exp(-x))
+        if not crossings:
+            continue
+        result.append(ThresholdEstimate(
+            b=b,
+            g=g,
+            decoder=decoder,
+            rounds_per_diameter=rounds_per_diameter,
+            threshold=float(np.median(crossings)),
+            min_threshold=min(crossings),
+            max_threshold=max(crossings),
+            num_crossings=len(crossings),
+        ))
+    return result
+
+
+def write_table(path: pathlib.Path, rows: List[Any]) -> None:
+    with open(path, 'w', newline='') as f:
+        if not rows:
+            return
+        writer = csv.DictWriter(f, fieldnames=[field.name for field in dataclasses.fields(rows[0])])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dataclasses.asdict(row))
+    print("wrote", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fits lines to every group of collected statistics.")
+    parser.add_argument('--in', dest='in_path', type=pathlib.Path, default=pathlib.Path('out/stats.csv'))
+    parser.add_argument('--out_dir', type=pathlib.Path, default=pathlib.Path('out'))
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--no_cache', action='store_true')
+    args = parser.parse_args()
+
+    groups = line_groups(args.in_path)
+    fits = fit_groups(
+        groups,
+        cache_path=None if args.no_cache else args.out_dir / 'fits_cache.json',
+        num_workers=args.processes,
+    )
+    write_table(args.out_dir / 'fits.csv', fits)
+    write_table(args.out_dir / 'thresholds.csv', estimate_thresholds(fits))
+
+
+if __name__ == '__main__':
+    main()
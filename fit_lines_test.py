@@ -0,0 +1,53 @@
+import math
+import pathlib
+
+import pytest
+
+from fit_lines import fit_groups, line_groups
+
+HEADER = '     shots,    errors,  discards, seconds,decoder,strong_id,json_metadata\n'
+
+
+def _row(shots: int, errors: int, d: int, p: float, r: int) -> str:
+    strong_id = f'd{d}p{p}r{r}'
+    return f'{shots},{errors},0,1.5,pymatching,{strong_id},"{{""b"":""X"",""d"":{d},""g"":""cx"",""p"":{p},""r"":{r}}}"\n'
+
+
+def _write_stats(path: pathlib.Path, extra_d5_errors: int = 0) -> None:
+    path.write_text(HEADER + ''.join([
+        _row(10_000, 300, 3, 0.002, 9),
+        _row(10_000, 100, 3, 0.001, 9),
+        _row(10_000, 200 + extra_d5_errors, 5, 0.002, 15),
+        _row(10_000, 40, 5, 0.001, 15),
+        # Rounds scaling data, which mustn't end up on the lines of the r=3d sweep.
+        _row(10_000, 900, 3, 0.002, 30),
+    ]))
+
+
+def test_line_groups_keep_round_counts_apart(tmp_path: pathlib.Path):
+    _write_stats(tmp_path / 'stats.csv')
+    groups = {(e.axis, e.fixed, e.rounds_per_diameter): e for e in line_groups(tmp_path / 'stats.csv')}
+    assert groups[('p', 3, 3)].xs == pytest.approx((-math.log(0.002), -math.log(0.001)))
+    assert groups[('d', 0.002, 3)].xs == (3.0, 5.0)
+    assert groups[('d', 0.002, 10)].errors == (900,)
+
+
+def test_fit_groups_only_refits_changed_groups(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture):
+    stats_path = tmp_path / 'stats.csv'
+    cache_path = tmp_path / 'fits_cache.json'
+    _write_stats(stats_path)
+    groups = line_groups(stats_path)
+    first = fit_groups(groups, cache_path=cache_path, num_workers=1)
+    assert f'fit {len(groups)} groups (0 unchanged)' in capsys.readouterr().out
+    assert {(e.axis, e.fixed) for e in first} == {('p', 3), ('p', 5), ('d', 0.001), ('d', 0.002)}
+
+    # Unchanged data is read back from the cache, without fitting anything.
+    assert fit_groups(line_groups(stats_path), cache_path=cache_path, num_workers=1) == first
+    assert 'fit ' not in capsys.readouterr().out
+
+    # More errors at d=5, p=0.002 change the p line of d=5 and the d line of p=0.002, and nothing else.
+    _write_stats(stats_path, extra_d5_errors=50)
+    refit = fit_groups(line_groups(stats_path), cache_path=cache_path, num_workers=1)
+    assert f'fit 2 groups ({len(groups) - 2} unchanged)' in capsys.readouterr().out
+    changed = {(e.axis, e.fixed) for e, f in zip(refit, first) if e != f}
+    assert changed == {('p', 5), ('d', 0.002)}
@@ -5,7 +5,9 @@ from typing import List, FrozenSet, Optional
 
 import stim
 from _builder import Builder, AtLayer
+from _dem_cache import DemCache
 from _noise import NoiseModel, NoiseRule
+from _trace import labels, span
 from _viewer import stim_circuit_html_viewer
 
 
@@ -465,19 +467,22 @@ def make_noisy_heavy_hex_circuit(
         noise: float,
         gate_set: str,
 ) -> stim.Circuit:
-    ideal_circuit = make_heavy_hex_circuit(
-        diam=diam,
-        time_boundary_basis=time_boundary_basis,
-        rounds=rounds,
-        gate_set=gate_set,
-    )
+    with span('make_heavy_hex_circuit'):
+        ideal_circuit = make_heavy_hex_circuit(
+            diam=diam,
+            time_boundary_basis=time_boundary_basis,
+            rounds=rounds,
+            gate_set=gate_set,
+        )
     noise_model = make_noise_model(noise, allow_mpp=gate_set=='mpp')
-    return noise_model.noisy_circuit(ideal_circuit)
+    with span('noisy_circuit'):
+        return noise_model.noisy_circuit(ideal_circuit)
 
 
 def main():
     circuits_dir = pathlib.Path('out/circuits')
     circuits_dir.mkdir(exist_ok=True, parents=True)
+    dem_cache = DemCache()
 
     for basis in 'XZ':
         for diam in [3, 5, 7, 9, 11, 13, 15]:
@@ -496,19 +501,20 @@ def main():
             ]:
                 for gate_set in ['cx', 'cx_noflags']:
                     rounds = diam * 3
-                    noisy_circuit = make_noisy_heavy_hex_circuit(
-                        diam=diam,
-                        time_boundary_basis=basis,
-                        rounds=rounds,
-                        noise=noise,
-                        gate_set=gate_set,
-                    )
-
-                    # Verify workable
-                    noisy_circuit.detector_error_model(decompose_errors=True)
-                    path = circuits_dir / f'd={diam},p={noise},b={basis},g={gate_set},r={rounds}.stim'
-                    with open(path, 'w') as f:
-                        print(noisy_circuit, file=f)
+                    with labels(d=diam, p=noise, b=basis, g=gate_set, r=rounds):
+                        noisy_circuit = make_noisy_heavy_hex_circuit(
+                            diam=diam,
+                            time_boundary_basis=basis,
+                            rounds=rounds,
+                            noise=noise,
+                            gate_set=gate_set,
+                        )
+
+                        # Verify workable (and cache the error model for the later steps).
+                        dem_cache.detector_error_model(noisy_circuit)
+                        path = circuits_dir / f'd={diam},p={noise},b={basis},g={gate_set},r={rounds}.stim'
+                        with span('write_circuit'), open(path, 'w') as f:
+                            print(noisy_circuit, file=f)
                     print("wrote", path)
 
 
@@ -0,0 +1,155 @@
+import argparse
+import concurrent.futures
+import dataclasses
+import pathlib
+from typing import Any, Callable, Dict, List, Optional
+
+import matplotlib
+
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import sinter
+
+from _stats import load_stats
+
+
+@dataclasses.dataclass(frozen=True)
+class PlotAxis:
+    """How the curves of a plot are laid out along its x axis."""
+    file_part: str
+    x_label: str
+    log_x: bool
+    x_func: Callable[[sinter.TaskStats], Any]
+    group_func: Callable[[sinter.TaskStats], Any]
+
+
+def _diam_x(stat: sinter.TaskStats) -> Any:
+    return stat.json_metadata['d']
+
+
+def _diam_group(stat: sinter.TaskStats) -> Any:
+    m = stat.json_metadata
+    return f'''p={m['p']} b={m['b']} g={m['g']} r/d={m['r'] / m['d']}'''
+
+
+def _noise_x(stat: sinter.TaskStats) -> Any:
+    return stat.json_metadata['p']
+
+
+def _noise_group(stat: sinter.TaskStats) -> Any:
+    m = stat.json_metadata
+    return f'''d={m['d']} b={m['b']} g={m['g']} r={m['r']}'''
+
+
+PLOT_AXES = {
+    'd': PlotAxis(
+        file_part='diam_vs_logical_error_rate',
+        x_label='Patch Diameter',
+        log_x=False,
+        x_func=_diam_x,
+        group_func=_diam_group,
+    ),
+    'p': PlotAxis(
+        file_part='physical_noise_vs_logical_error_rate',
+        x_label='Physical Error Rate',
+        log_x=True,
+        x_func=_noise_x,
+        group_func=_noise_group,
+    ),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class PlotSpec:
+    """One of the plots shown in the readme."""
+    axis: str
+    b: str
+    correlated: bool
+    flags: bool
+
+    @property
+    def file_name(self) -> str:
+        prefix = 'correlated' if self.correlated else 'uncorrelated'
+        suffix = '' if self.flags else '_no_flags'
+        return f'{prefix}_{PLOT_AXES[self.axis].file_part}_{self.b}{suffix}.png'
+
+
+def plot_variant(stat: sinter.TaskStats) -> tuple:
+    """Determines which plots (of each axis) a data point belongs to."""
+    return stat.json_metadata['b'], 'correlated' in stat.decoder, 'noflags' not in stat.json_metadata['g']
+
+
+def plot_specs(stats: List[sinter.TaskStats]) -> Dict[PlotSpec, List[sinter.TaskStats]]:
+    """Splits the statistics between every plot, in one pass over them."""
+    result = {}
+    for (b, correlated, flags), group in sorted(sinter.group_by(stats, key=plot_variant).items()):
+        for axis in PLOT_AXES:
+            result[PlotSpec(axis=axis, b=b, correlated=correlated, flags=flags)] = group
+    return result
+
+
+def render_plot(spec: PlotSpec, stats: List[sinter.TaskStats], out_path: pathlib.Path) -> pathlib.Path:
+    """Draws a plot the same way `sinter plot` does, and saves it."""
+    axis = PLOT_AXES[spec.axis]
+    fig, ax = plt.subplots(1, 1)
+    sinter.plot_error_rate(
+        ax=ax,
+        stats=stats,
+        x_func=axis.x_func,
+        group_func=axis.group_func,
+        highlight_max_likelihood_factor=1000,
+    )
+    min_y = min((stat.errors / (stat.shots - stat.discards) for stat in stats if stat.errors), default=1e-4)
+    low_d = 4
+    while 10**-low_d > min_y * 0.9 and low_d < 10:
+        low_d += 1
+    ax.set_ylim(10**-low_d, 1e-0)
+    ax.set_ylabel("Logical Error Probability (per shot)")
+    ax.grid()
+    ax.legend()
+    if axis.log_x:
+        ax.loglog()
+    else:
+        ax.semilogy()
+    ax.set_xlabel(axis.x_label)
+    ax.set_title('Logical Error Rate vs ' + axis.x_label)
+    fig.set_size_inches(10, 10)
+    fig.set_dpi(100)
+    fig.tight_layout()
+    fig.savefig(out_path)
+    plt.close(fig)
+    return out_path
+
+
+def render_plots(specs: Dict[PlotSpec, List[sinter.TaskStats]],
+                 *,
+                 out_dir: pathlib.Path,
+                 num_workers: Optional[int]) -> None:
+    """Renders every plot, spreading the rasterization over a process pool when num_workers > 1."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(spec, stats, out_dir / spec.file_name) for spec, stats in specs.items()]
+    if num_workers is not None and num_workers <= 1:
+        for job in jobs:
+            print("wrote", render_plot(*job))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for path in pool.map(render_plot, *zip(*jobs)):
+            print("wrote", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders every plot of the collected statistics.")
+    parser.add_argument('--in', dest='in_path', type=pathlib.Path, default=pathlib.Path('out/stats.csv'))
+    parser.add_argument('--out_dir', type=pathlib.Path, default=pathlib.Path('out/plots'))
+    parser.add_argument('--processes',
+                        type=int,
+                        default=1,
+                        help='Worker processes used to draw the plots. Defaults to drawing in this process.')
+    args = parser.parse_args()
+
+    specs = plot_specs(load_stats(args.in_path).task_stats())
+    render_plots(specs, out_dir=args.out_dir, num_workers=args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
 #!/bin/bash
 
-# Oof, no open source correlated decoder to reproduce the correlated stats...
-sinter collect \
+# The existing internal/internal_correlated rows came from a closed source decoder. These are the open
+# source equivalents: pymatching (reusing matching graphs across batches) and pymatching's two-pass
+# correlated matching. See _decoders.py.
+#
+# Shots are scheduled in rounds (see _schedule.py) until every point's logical error rate per round is
+# known to 10%, favoring the points that most tighten the line and threshold fits.
+python collect_data.py \
     --circuits out/circuits/* \
-    --decoders pymatching \
+    --decoders pymatching_cached pymatching_correlated \
     --processes 4 \
-    --max_shots 100_000 \
-    --max_errors 100 \
-    --save_resume_filepath out/stats.csv \
-    --metadata_func "sinter.comma_separated_key_values(path)"
+    --target_relative_error 0.1 \
+    --round_shots 1_000_000 \
+    --max_shots 10_000_000 \
+    --max_errors 1000 \
+    --save_resume_filepath out/stats.csv
+
+python compact_stats.py --in out/stats.csv
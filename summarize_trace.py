@@ -0,0 +1,18 @@
+import argparse
+import pathlib
+
+from _trace import summarize_trace
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ranks the pipeline stages and sweep points recorded in a trace file (written by any step "
+                    "run with the HEAVY_HEX_TRACE environment variable set) by the time spent in them.")
+    parser.add_argument('--trace', type=pathlib.Path, required=True)
+    parser.add_argument('--top', type=int, default=20, help='How many stages and sweep points to list.')
+    args = parser.parse_args()
+    print(summarize_trace(args.trace, top=args.top))
+
+
+if __name__ == '__main__':
+    main()